@@ -5,6 +5,7 @@ Sử dụng Tavily search + Gemini để thu thập và phân tích data thị t
 from crewai import Agent
 from crewai_tools import SerperDevTool
 from config import CREWAI_LLM_FAST, CREWAI_LLM_PRO, TAVILY_API_KEY
+from tools.llm_backend import backend
 
 try:
     from tavily import TavilyClient
@@ -28,12 +29,17 @@ def create_tavily_search_tool():
         api_key: str = Field(default="")
 
         def _run(self, query: str) -> str:
-            client = TavilyClient(api_key=self.api_key)
-            response = client.search(
-                query=query,
-                search_depth="advanced",
-                max_results=10,
-                include_answer=True,
+            # Đi qua LLM backend → record/replay được như các call Gemini
+            response = backend.call(
+                "tavily", {"query": query},
+                lambda: TavilyClient(api_key=self.api_key).search(
+                    query=query,
+                    search_depth="advanced",
+                    max_results=10,
+                    include_answer=True,
+                ),
+                lambda data: data,
+                lambda: {"answer": "", "results": []},
             )
             results = []
             if response.get("answer"):
@@ -1,17 +1,14 @@
 """
 Business Deep Research — FastAPI Backend
 ASGI server with async SSE streaming for pipeline execution.
+Pipeline runs go through a bounded job queue (jobs.py); streams can re-attach by job ID.
 
 Usage: python app.py
 """
 import json
 import os
-import sys
-import queue
 import threading
 import asyncio
-import io
-import re
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
@@ -29,7 +26,7 @@ load_dotenv()
 BASE_DIR = Path(__file__).parent
 WEB_DIR = BASE_DIR / "web" / "out"
 KNOWLEDGE_DIR = BASE_DIR / "knowledge"
-OUTPUT_DIR = BASE_DIR / "output"
+OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", str(BASE_DIR / "output")))
 SETTINGS_FILE = BASE_DIR / ".settings.json"
 
 # === App ===
@@ -53,6 +50,9 @@ class PipelineRequest(BaseModel):
     industry: str = "tech_startup"
     market: str = "vietnam"
     context: dict = {}
+    priority: int = 0  # Nhỏ hơn = chạy trước
+    resume: Optional[str] = None  # Run ID cũ → chạy tiếp từ checkpoint
+    base_run: Optional[str] = None  # Run ID cũ → rerun với context mới, chỉ tính lại step bị ảnh hưởng
 
 class SettingsUpdate(BaseModel):
     api_provider: Optional[str] = None
@@ -90,31 +90,17 @@ def save_settings(settings: dict):
     SETTINGS_FILE.write_text(json.dumps(settings, indent=2, ensure_ascii=False), encoding="utf-8")
 
 
-# === Stream Capture (redirect print → queue) ===
-class StreamCapture(io.TextIOBase):
-    def __init__(self, q: queue.Queue, original):
-        self.q = q
-        self.original = original
-
-    def write(self, text):
-        if self.original:
-            self.original.write(text)
-        if text.strip():
-            step_match = re.match(r'.*STEP (\d+)/(\d+):\s+(.*)', text.strip())
-            if step_match:
-                self.q.put({
-                    "event": "step",
-                    "step": int(step_match.group(1)),
-                    "total": int(step_match.group(2)),
-                    "name": step_match.group(3).strip()
-                })
-            else:
-                self.q.put({"event": "log", "message": text.strip()})
-        return len(text)
-
-    def flush(self):
-        if self.original:
-            self.original.flush()
+# === Event Stream (pipeline events → SSE queue) ===
+def event_to_message(event) -> dict:
+    """Serialize pipeline event cho SSE. Event nào có text hiển thị thì kèm `message`."""
+    from tools.events import format_event
+
+    msg = event.to_dict()
+    if "message" not in msg:
+        line = format_event(event)
+        if line:
+            msg["message"] = line.strip()
+    return msg
 
 
 # ══════════════════════════════════════
@@ -164,84 +150,108 @@ async def update_settings_endpoint(data: SettingsUpdate):
 
 
 # ══════════════════════════════════════
-# API: Pipeline Runner (SSE)
+# API: Pipeline Runner (Job Queue + SSE)
 # ══════════════════════════════════════
 
-@app.post("/api/run")
-async def run_pipeline_endpoint(req: PipelineRequest):
-    if not req.idea.strip():
-        raise HTTPException(400, "Cần nhập ý tưởng kinh doanh")
-
-    q: queue.Queue = queue.Queue()
+def run_pipeline_job(job):
+    """Worker: chạy pipeline cho 1 job, ghi mọi event vào buffer của job."""
+    from pipeline import run_pipeline
+    from config import INDUSTRY_FRAMEWORKS
+    from tools.gemini_search import patch_report_when_resolved
+    from tools.events import EventBus, ConsolePrinter, RunSummary
+    from tools.rate_limits import call_priority
+    from utils import stale_cache_metadata
+
+    req = job.request
+
+    # Event bus riêng cho run này — không đụng tới sys.stdout
+    bus = EventBus(run_id=job.id)
+    bus.subscribe(lambda event: job.append_event(event_to_message(event)))
+    bus.subscribe(ConsolePrinter(prefix=f"[{bus.run_id}] "))
+    summary = RunSummary()
+    bus.subscribe(summary)
+
+    # Priority của job áp dụng luôn cho hàng đợi rate limiter của mọi API call trong run
+    with call_priority(job.priority):
+        result = run_pipeline(
+            business_idea=req["idea"],
+            industry=req["industry"],
+            market=req["market"],
+            context=req.get("context") or None,
+            interactive=False,
+            events=bus,
+            resume=req.get("resume"),
+            base_run=req.get("base_run"),
+        )
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"business_plan_{req['industry']}_{timestamp}.md"
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    filepath = OUTPUT_DIR / filename
 
-    def pipeline_thread():
-        old_stdout = sys.stdout
-        sys.stdout = StreamCapture(q, old_stdout)
-        try:
-            from pipeline import run_pipeline
-            from config import INDUSTRY_FRAMEWORKS
-
-            ctx_file = None
-            if req.context:
-                ctx_path = BASE_DIR / "_temp_context.json"
-                ctx_path.write_text(json.dumps(req.context, ensure_ascii=False), encoding="utf-8")
-                ctx_file = str(ctx_path)
-
-            result = run_pipeline(
-                business_idea=req.idea,
-                industry=req.industry,
-                market=req.market,
-                context_file=ctx_file,
-                interactive=False,
-            )
-
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"business_plan_{req.industry}_{timestamp}.md"
-            OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-            filepath = OUTPUT_DIR / filename
-
-            header = f"""---
-title: Business Plan - {req.idea}
-industry: {req.industry}
-market: {req.market}
+    header = f"""---
+title: Business Plan - {req['idea']}
+industry: {req['industry']}
+market: {req['market']}
 generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 engine: Gemini API + Google Search Grounding
-frameworks: {", ".join(INDUSTRY_FRAMEWORKS.get(req.industry, []))}
+frameworks: {", ".join(INDUSTRY_FRAMEWORKS.get(req['industry'], []))}
 philosophy: AI tạo sản phẩm, con người vận hành dịch vụ
----
+{stale_cache_metadata(summary.stale_cache)}---
 
 """
-            filepath.write_text(header + result, encoding="utf-8")
+    filepath.write_text(header + result, encoding="utf-8")
+    patch_report_when_resolved(filepath)
+
+    job.result = result
+    job.filename = filename
+    job.append_event({
+        "event": "result",
+        "content": result,
+        "filename": filename,
+        "stale_cache": summary.stale_cache,
+    })
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
 
-            q.put({
-                "event": "result",
-                "content": result,
-                "filename": filename,
-            })
 
-            temp = BASE_DIR / "_temp_context.json"
-            if temp.exists():
-                temp.unlink()
+def get_job_manager():
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            from jobs import JobManager
+            from config import JOB_WORKERS, JOB_QUEUE_LIMIT
+            _job_manager = JobManager(run_pipeline_job, workers=JOB_WORKERS, max_pending=JOB_QUEUE_LIMIT)
+    return _job_manager
 
-        except Exception as e:
-            q.put({"event": "error", "message": str(e)})
-        finally:
-            sys.stdout = old_stdout
-            q.put({"event": "done"})
 
-    thread = threading.Thread(target=pipeline_thread, daemon=True)
-    thread.start()
+def submit_job(req: PipelineRequest):
+    from jobs import QueueFullError
 
+    if not req.idea.strip():
+        raise HTTPException(400, "Cần nhập ý tưởng kinh doanh")
+    try:
+        return get_job_manager().submit(req.model_dump(exclude={"priority"}), priority=req.priority)
+    except QueueFullError as e:
+        raise HTTPException(429, str(e), headers={"Retry-After": "60"})
+
+
+def stream_job_events(job, offset: int = 0) -> StreamingResponse:
+    """SSE replay từ offset rồi follow event mới cho tới khi job xong."""
     async def event_generator():
+        cursor = max(0, offset)
         while True:
-            try:
-                msg = q.get(timeout=0.5)
-                yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
-                if msg.get("event") == "done":
-                    break
-            except queue.Empty:
+            messages = job.events_since(cursor)
+            for msg in messages:
+                yield f"id: {msg['offset']}\ndata: {json.dumps(msg, ensure_ascii=False)}\n\n"
+                cursor = msg["offset"] + 1
+            if job.finished and cursor >= job.next_offset:
+                break
+            if not messages:
                 yield f"data: {json.dumps({'event': 'ping'})}\n\n"
-                await asyncio.sleep(0.1)
+                await asyncio.sleep(0.5)
 
     return StreamingResponse(
         event_generator(),
@@ -254,6 +264,58 @@ philosophy: AI tạo sản phẩm, con người vận hành dịch vụ
     )
 
 
+@app.post("/api/run")
+async def run_pipeline_endpoint(req: PipelineRequest):
+    """Submit job và stream luôn events (event đầu tiên chứa job_id để attach lại)."""
+    job = submit_job(req)
+    return stream_job_events(job)
+
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(req: PipelineRequest):
+    job = submit_job(req)
+    return job.to_dict(position=get_job_manager().position(job.id))
+
+
+@app.get("/api/jobs")
+async def list_jobs():
+    manager = get_job_manager()
+    return {
+        "jobs": [j.to_dict() for j in manager.list()],
+        "pending": manager.pending_count(),
+        "workers": manager.workers,
+        "queue_limit": manager.max_pending,
+    }
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    return job.to_dict(position=manager.position(job_id))
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def get_job_events(job_id: str, request: Request, offset: int = 0):
+    job = get_job_manager().get(job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    # EventSource tự gửi Last-Event-ID khi reconnect
+    last_id = request.headers.get("last-event-id")
+    if last_id and last_id.isdigit():
+        offset = max(offset, int(last_id) + 1)
+    return stream_job_events(job, offset)
+
+
+@app.get("/api/limits")
+async def get_rate_limits():
+    """Metric limiter pool (hàng đợi + thời gian chờ theo (key, model)) + trạng thái circuit breaker."""
+    from tools.gemini_search import _breakers, _limiters
+    return {"buckets": _limiters.stats(), "breakers": [b.stats() for b in _breakers.values()]}
+
+
 # ══════════════════════════════════════
 # API: Knowledge CRUD
 # ══════════════════════════════════════
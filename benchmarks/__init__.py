@@ -0,0 +1 @@
+# Business Deep Research Agent - Benchmarks Package
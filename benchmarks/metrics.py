@@ -0,0 +1,111 @@
+"""
+Metrics Collector — subscriber của event bus (hoặc đọc SSE message của /api/run) cho benchmark.
+- Thời gian từng step, critical path theo DAG của pipeline
+- Search / cache hit / retry, cộng với số call backend, thời gian chờ limiter và peak RSS
+"""
+import sys
+import threading
+
+# DAG của pipeline (step → các step phụ thuộc), khớp với Stage trong pipeline._execute_pipeline
+STEP_DEPS = {
+    1: [],
+    2: [1],
+    3: [1],
+    4: [1, 2, 3],
+    5: [1, 2, 3, 4],
+}
+
+
+class MetricsCollector:
+    """Gom event của 1 hoặc nhiều run (event object hoặc dict dạng event.to_dict())."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps: dict[tuple[str, int], dict] = {}  # (run_id, step) → {name, start, duration}
+        self.searches = 0
+        self.cache_hits = 0
+        self.similar_hits = 0  # Cache hit nhờ khớp query gần trùng
+        self.retries = 0
+        self.rate_limited = 0
+
+    def __call__(self, event):
+        self.add(event.to_dict() if hasattr(event, "to_dict") else event)
+
+    def add(self, msg: dict):
+        kind = msg.get("event")
+        with self.lock:
+            if kind == "step":
+                self.steps[(msg.get("run_id", ""), msg["step"])] = {"name": msg["name"], "start": msg["ts"]}
+            elif kind == "step_end":
+                step = self.steps.setdefault((msg.get("run_id", ""), msg["step"]), {"name": msg["name"]})
+                step["duration"] = msg["duration"]
+            elif kind == "search":
+                self.searches += 1
+            elif kind == "cache_hit":
+                self.cache_hits += 1
+                if msg.get("matched"):
+                    self.similar_hits += 1
+            elif kind == "retry":
+                self.retries += 1
+            elif kind == "rate_limit":
+                self.rate_limited += 1
+
+    def runs(self) -> dict[str, dict[int, dict]]:
+        by_run: dict[str, dict[int, dict]] = {}
+        with self.lock:
+            for (run_id, step), info in self.steps.items():
+                by_run.setdefault(run_id, {})[step] = info
+        return by_run
+
+    def summary(self) -> dict:
+        runs = self.runs()
+        step_times: dict[str, list[float]] = {}
+        critical = []
+        for steps in runs.values():
+            for info in steps.values():
+                if "duration" in info:
+                    step_times.setdefault(info["name"], []).append(info["duration"])
+            critical.append(critical_path({s: i.get("duration", 0.0) for s, i in steps.items()}))
+        lookups = self.searches + self.cache_hits
+        return {
+            "steps": {name: round(sum(v) / len(v), 3) for name, v in step_times.items()},
+            "critical_path": round(sum(critical) / len(critical), 3) if critical else None,
+            "searches": self.searches,
+            "cache_hits": self.cache_hits,
+            "similar_hits": self.similar_hits,
+            "cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else None,
+            "retries": self.retries,
+            "rate_limited_waits": self.rate_limited,
+        }
+
+
+def critical_path(durations: dict[int, float]) -> float:
+    """Đường dài nhất qua DAG (giây) = thời gian tối thiểu nếu song song hoàn hảo."""
+    finish: dict[int, float] = {}
+    for step in sorted(STEP_DEPS):
+        start = max((finish[d] for d in STEP_DEPS[step] if d in finish), default=0.0)
+        finish[step] = start + durations.get(step, 0.0)
+    return max(finish.values(), default=0.0)
+
+
+def peak_rss_mb() -> float | None:
+    """Peak RSS của process hiện tại (MB); None nếu platform không hỗ trợ."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KB, macOS: bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def backend_metrics() -> dict:
+    """Số call backend (theo kind), 429 giả lập, tổng thời gian chờ limiter."""
+    from tools.gemini_search import _limiters
+    from tools.llm_backend import backend
+
+    return {
+        "api_calls": dict(backend.calls),
+        "api_calls_total": sum(backend.calls.values()),
+        "injected_429": backend.injected_429,
+        "limiter_wait_total": round(sum(b["total_wait"] for b in _limiters.stats()), 3),
+    }
@@ -0,0 +1,20 @@
+"""
+Latency profiles cho benchmark — mỗi profile mô phỏng 1 kiểu backend (replay, không network).
+- latency: phân phối latency / call (xem tools.llm_backend: "0.5", "0.2-1.5", "lognormal:median,sigma")
+- rpm: giới hạn request/phút mỗi (key, model) — đi qua limiter pool thật
+- keys: số API key giả lập
+- error_rate: tỉ lệ call bị 429 giả lập
+"""
+
+PROFILES = {
+    # Orchestration thuần: latency nhỏ, không bị limit → đo overhead + độ song song
+    "fast": {"latency": "0.02-0.1", "rpm": 600, "keys": 1, "error_rate": 0.0},
+    # Gần API thật: đuôi dài, vài 429
+    "realistic": {"latency": "lognormal:1.5,0.5", "rpm": 30, "keys": 1, "error_rate": 0.02},
+    # Free tier: RPM thấp → rate limiter chiếm phần lớn thời gian
+    "throttled": {"latency": "lognormal:1.5,0.5", "rpm": 8, "keys": 1, "error_rate": 0.05},
+    # Như throttled nhưng 3 key → limiter pool chia tải
+    "multi_key": {"latency": "lognormal:1.5,0.5", "rpm": 8, "keys": 3, "error_rate": 0.05},
+}
+
+DEFAULT_IDEA = "Ứng dụng đặt lịch spa cho phụ nữ văn phòng tại TP.HCM"
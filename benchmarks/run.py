@@ -0,0 +1,241 @@
+"""
+Benchmark end-to-end: chạy run_pipeline hoặc /api/run trên backend giả lập (LLM_BACKEND=replay,
+REPLAY_ON_MISS=synthetic) với latency / RPM / 429 theo profile — không cần API key, không network.
+
+Mỗi lần chạy là 1 subprocess riêng (cache, checkpoint, output ở thư mục tạm → luôn cold,
+peak RSS không lẫn giữa các run). Import module (genai, openai, fastapi...) đo riêng ở
+import_time, không tính vào wall_time. Kết quả ghi JSON để so sánh giữa các lần chạy.
+
+Usage:
+    python -m benchmarks.run                                  # profile fast, target pipeline
+    python -m benchmarks.run --profile realistic throttled --repeat 3
+    python -m benchmarks.run --target api --jobs 4            # 4 job đồng thời qua /api/run
+    python -m benchmarks.run --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+RESULT_MARKER = "BENCH_RESULT "
+
+# Metric so sánh ở --compare / bảng tóm tắt (nhỏ hơn = tốt hơn, trừ cache_hit_rate)
+SUMMARY_METRICS = [
+    "wall_time", "import_time", "critical_path", "api_calls_total", "limiter_wait_total",
+    "cache_hit_rate", "retries", "peak_rss_mb",
+]
+
+
+# ═══════════════════════════════════════════════
+# CHILD — chạy trong subprocess với env của profile
+# ═══════════════════════════════════════════════
+
+def _pipeline_target():
+    """Import pipeline (ngoài phần đo wall_time) → hàm chạy `jobs` run đồng thời."""
+    from pipeline import run_pipeline
+    from tools.events import EventBus
+
+    def _run(idea: str, industry: str, market: str, jobs: int, collector) -> None:
+        def _one(i: int):
+            bus = EventBus()
+            bus.subscribe(collector)
+            run_pipeline(f"{idea} #{i}" if jobs > 1 else idea, industry, market, interactive=False, events=bus)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(_one, range(jobs)))
+
+    return _run
+
+
+def _api_target():
+    """Import app + dựng TestClient (ngoài phần đo wall_time) → hàm gọi /api/run `jobs` lần đồng thời."""
+    from fastapi.testclient import TestClient
+    from app import app
+
+    client = TestClient(app)
+
+    def _run(idea: str, industry: str, market: str, jobs: int, collector) -> None:
+        def _one(i: int):
+            payload = {"idea": f"{idea} #{i}" if jobs > 1 else idea, "industry": industry, "market": market}
+            with client.stream("POST", "/api/run", json=payload) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line.startswith("data: "):
+                        collector.add(json.loads(line[len("data: "):]))
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(_one, range(jobs)))
+
+    return _run
+
+
+def child_main(args) -> dict:
+    from benchmarks.metrics import MetricsCollector, backend_metrics, peak_rss_mb
+
+    collector = MetricsCollector()
+    imported = time.time()
+    target = _api_target() if args.target == "api" else _pipeline_target()
+    started = time.time()
+    target(args.idea, args.industry, args.market, args.jobs, collector)
+    wall = time.time() - started
+    return {
+        "wall_time": round(wall, 3),
+        "import_time": round(started - imported, 3),
+        **collector.summary(),
+        **backend_metrics(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# ═══════════════════════════════════════════════
+# PARENT — dựng env, chạy subprocess, gom kết quả
+# ═══════════════════════════════════════════════
+
+def profile_env(profile: dict, workdir: Path, seed: int) -> dict:
+    """Env cho subprocess: replay + profile + thư mục tạm. Ghi đè mọi giá trị .env liên quan."""
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "replay",
+        "REPLAY_ON_MISS": "synthetic",
+        "REPLAY_LATENCY": profile["latency"],
+        "REPLAY_RATE_LIMIT_RATE": str(profile["error_rate"]),
+        "REPLAY_SEED": str(seed),
+        "GEMINI_API_KEYS": ",".join(f"bench-key-{i}" for i in range(profile["keys"])),
+        "GEMINI_DEFAULT_RPM": str(profile["rpm"]),
+        "MODEL_RATE_LIMITS": "",
+        "PROXY_API_KEY": "",          # Luôn đi đường direct (qua limiter pool)
+        "RETRY_BASE_DELAY": "1",      # 429 giả lập có retryDelay 1s
+        "CACHE_DIR": str(workdir / "cache"),
+        "CHECKPOINT_DIR": str(workdir / "checkpoints"),
+        "OUTPUT_DIR": str(workdir / "output"),
+        "PYTHONIOENCODING": "utf-8",
+    })
+    return env
+
+
+def run_one(name: str, profile: dict, args, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="bdr-bench-") as tmp:
+        cmd = [
+            sys.executable, "-m", "benchmarks.run", "--child",
+            "--target", args.target, "--jobs", str(args.jobs),
+            "--idea", args.idea, "--industry", args.industry, "--market", args.market,
+        ]
+        proc = subprocess.run(cmd, cwd=BASE_DIR, env=profile_env(profile, Path(tmp), args.seed + repeat),
+                              capture_output=True, text=True, encoding="utf-8")
+    lines = [l for l in proc.stdout.splitlines() if l.startswith(RESULT_MARKER)]
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(f"Benchmark {name}#{repeat} lỗi (exit {proc.returncode}):\n{proc.stderr[-2000:]}")
+    return {
+        "profile": name,
+        "target": args.target,
+        "repeat": repeat,
+        "jobs": args.jobs,
+        "config": profile,
+        "metrics": json.loads(lines[-1][len(RESULT_MARKER):]),
+    }
+
+
+def summarize(results: list[dict]) -> dict:
+    """Median mỗi metric theo (profile, target)."""
+    groups: dict[str, list[dict]] = {}
+    for r in results:
+        groups.setdefault(f"{r['profile']}/{r['target']}", []).append(r["metrics"])
+    summary = {}
+    for key, runs in groups.items():
+        summary[key] = {}
+        for metric in SUMMARY_METRICS:
+            values = [m[metric] for m in runs if m.get(metric) is not None]
+            summary[key][metric] = round(statistics.median(values), 3) if values else None
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_summary(summary: dict):
+    print(f"\n{'profile/target':<24}" + "".join(f"{m:>20}" for m in SUMMARY_METRICS))
+    for key, metrics in summary.items():
+        print(f"{key:<24}" + "".join(f"{str(metrics[m]):>20}" for m in SUMMARY_METRICS))
+
+
+def compare(old_path: Path, new_path: Path):
+    """In chênh lệch median giữa 2 file kết quả."""
+    old = json.loads(old_path.read_text(encoding="utf-8"))["summary"]
+    new = json.loads(new_path.read_text(encoding="utf-8"))["summary"]
+    for key in sorted(set(old) & set(new)):
+        print(f"\n{key}")
+        for metric in SUMMARY_METRICS:
+            a, b = old[key].get(metric), new[key].get(metric)
+            if a is None or b is None:
+                continue
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            print(f"  {metric:<20} {a:>12} → {b:<12} {change}")
+
+
+def main():
+    from benchmarks.profiles import DEFAULT_IDEA, PROFILES
+
+    parser = argparse.ArgumentParser(description="Benchmark pipeline trên backend giả lập")
+    parser.add_argument("--profile", nargs="+", default=["fast"], choices=sorted(PROFILES))
+    parser.add_argument("--target", choices=["pipeline", "api"], default="pipeline")
+    parser.add_argument("--jobs", type=int, default=1, help="Số run đồng thời trong 1 lần đo")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--idea", default=DEFAULT_IDEA)
+    parser.add_argument("--industry", default="tech_startup")
+    parser.add_argument("--market", default="vietnam")
+    parser.add_argument("--output", type=Path, help="File JSON kết quả (mặc định benchmarks/results/<ts>.json)")
+    parser.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"))
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child:
+        print(RESULT_MARKER + json.dumps(child_main(args)), flush=True)
+        return
+
+    results = []
+    for name in args.profile:
+        for repeat in range(args.repeat):
+            print(f"⏱️  {name}/{args.target} #{repeat + 1}/{args.repeat} ...", flush=True)
+            result = run_one(name, PROFILES[name], args, repeat)
+            print(f"   wall {result['metrics']['wall_time']}s, "
+                  f"{result['metrics']['api_calls_total']} calls", flush=True)
+            results.append(result)
+
+    summary = summarize(results)
+    print_summary(summary)
+    output = args.output or RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+        "summary": summary,
+    }, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n📄 {output}")
+
+
+if __name__ == "__main__":
+    main()
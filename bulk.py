@@ -0,0 +1,146 @@
+"""
+Bulk Runner — chạy nhiều ý tưởng trong 1 process (main.py --ideas-file).
+- Input JSONL: mỗi dòng 1 ý tưởng {"idea", "industry"?, "market"?, "context"?}
+- Các pipeline chạy song song (giới hạn `concurrency`) nhưng dùng chung
+  rate limiter + search cache của process → không vượt quota/phút
+- Mỗi ý tưởng 1 report + summary.csv (verdict, thời gian, token, lỗi)
+"""
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from config import INDUSTRIES, MARKETS, OUTPUT_DIR
+from tools.events import EventBus, ConsolePrinter, RunSummary, TokenUsage
+from utils import extract_verdict, format_report_header, save_output
+
+SUMMARY_FIELDS = [
+    "index", "idea", "industry", "market", "status", "verdict",
+    "duration_s", "input_tokens", "output_tokens", "report", "error",
+]
+
+
+def load_ideas_file(path: str, industry: str = "tech_startup", market: str = "vietnam") -> list[dict]:
+    """Đọc file JSONL. Dòng trống / bắt đầu bằng '#' được bỏ qua; thiếu industry/market → dùng mặc định."""
+    ideas = []
+    for line_no, line in enumerate(Path(path).read_text(encoding="utf-8").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}:{line_no}: JSON không hợp lệ ({e})")
+        if not isinstance(item, dict) or not str(item.get("idea", "")).strip():
+            raise ValueError(f"{path}:{line_no}: thiếu trường 'idea'")
+        item.setdefault("industry", industry)
+        item.setdefault("market", market)
+        if item["industry"] not in INDUSTRIES:
+            raise ValueError(f"{path}:{line_no}: industry không hợp lệ: {item['industry']}")
+        if item["market"] not in MARKETS:
+            raise ValueError(f"{path}:{line_no}: market không hợp lệ: {item['market']}")
+        ideas.append(item)
+    return ideas
+
+
+class _TokenCounter:
+    """Subscriber cộng dồn token usage của 1 pipeline."""
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if isinstance(event, TokenUsage):
+            with self.lock:
+                self.input_tokens += event.input_tokens
+                self.output_tokens += event.output_tokens
+
+
+def _run_one(index: int, item: dict, out_dir: Path) -> dict:
+    from pipeline import run_pipeline
+    from tools.gemini_search import patch_report_when_resolved
+
+    stats = _TokenCounter()
+    bus = EventBus()
+    bus.subscribe(stats)
+    summary = RunSummary()
+    bus.subscribe(summary)
+    bus.subscribe(ConsolePrinter(prefix=f"[#{index:03d}] "))
+
+    row = {
+        "index": index,
+        "idea": item["idea"],
+        "industry": item["industry"],
+        "market": item["market"],
+        "status": "failed",
+        "verdict": "",
+        "report": "",
+        "error": "",
+    }
+    started = time.time()
+    try:
+        plan = run_pipeline(
+            business_idea=item["idea"],
+            industry=item["industry"],
+            market=item["market"],
+            context=item.get("context"),
+            interactive=False,
+            events=bus,
+        )
+        filename = f"{index:03d}_business_plan_{item['industry']}.md"
+        header = format_report_header(item["idea"], item["industry"], item["market"],
+                                      stale_cache=summary.stale_cache)
+        patch_report_when_resolved(save_output(header + plan, filename, out_dir))
+        row.update(status="succeeded", verdict=extract_verdict(plan), report=filename)
+    except Exception as e:
+        row["error"] = str(e)[:500]
+    row.update(
+        duration_s=round(time.time() - started, 1),
+        input_tokens=stats.input_tokens,
+        output_tokens=stats.output_tokens,
+    )
+    return row
+
+
+def run_bulk(ideas: list[dict], concurrency: int = 2, output_dir: Path = OUTPUT_DIR) -> Path:
+    """
+    Chạy tất cả ý tưởng, tối đa `concurrency` pipeline cùng lúc.
+    Trả về path summary.csv (ghi lại sau mỗi ý tưởng xong → dừng giữa chừng vẫn có kết quả).
+    """
+    out_dir = output_dir / f"bulk_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    summary_path = out_dir / "summary.csv"
+    rows = []
+
+    print(f"\n📦 Bulk mode: {len(ideas)} ý tưởng, concurrency={concurrency}")
+    print(f"📁 Output: {out_dir}\n")
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="bulk") as pool:
+        futures = [pool.submit(_run_one, i, item, out_dir) for i, item in enumerate(ideas, 1)]
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            status = "✅" if row["status"] == "succeeded" else "❌"
+            print(f"{status} [#{row['index']:03d}] {row['idea'][:50]} — {row['verdict'] or row['error'][:60] or '?'} "
+                  f"({row['duration_s']:.0f}s) [{len(rows)}/{len(ideas)}]")
+            _write_summary(summary_path, rows)
+
+    ok = sum(1 for r in rows if r["status"] == "succeeded")
+    mins, secs = divmod(int(time.time() - started), 60)
+    print(f"\n🎉 Bulk xong: {ok}/{len(rows)} thành công trong {mins} phút {secs} giây")
+    print(f"📊 Summary: {summary_path}")
+    return summary_path
+
+
+def _write_summary(path: Path, rows: list[dict]):
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8-sig", newline="") as f:  # BOM → Excel đọc đúng tiếng Việt
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(sorted(rows, key=lambda r: r["index"]))
+    tmp.replace(path)
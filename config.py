@@ -13,18 +13,119 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 
+# Nhiều key (phân cách bằng dấu phẩy) → limiter pool chia tải giữa các key
+GEMINI_API_KEYS = [k.strip() for k in os.getenv("GEMINI_API_KEYS", "").split(",") if k.strip()] \
+    or ([GEMINI_API_KEY] if GEMINI_API_KEY else [])
+
 # === Proxy API (Antigravity Tools) ===
 PROXY_API_KEY = os.getenv("PROXY_API_KEY")
 PROXY_BASE_URL = os.getenv("PROXY_BASE_URL", "http://localhost:8045/v1")
 PROXY_MODEL = os.getenv("PROXY_MODEL", "gemini-2.5-pro")
+PROXY_TIMEOUT = float(os.getenv("PROXY_TIMEOUT", "180"))  # Giây, 1 call proxy
+
+# === Outbound HTTP (tools.http_pool — connection pool dùng chung) ===
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))                   # Giây, mặc định mỗi request
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))     # Tổng connection / client
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "8"))            # Request đồng thời / host
+RESOLVE_TIMEOUT = float(os.getenv("RESOLVE_TIMEOUT", "5"))              # Resolve 1 redirect URL
+RESOLVE_CONCURRENCY = int(os.getenv("RESOLVE_CONCURRENCY", "16"))       # URL resolve song song
+RESOLVE_DEADLINE = float(os.getenv("RESOLVE_DEADLINE", "2"))            # Tối đa chờ resolve / response
+RESOLVE_BACKGROUND_TIMEOUT = float(os.getenv("RESOLVE_BACKGROUND_TIMEOUT", "120"))  # Chờ resolve nền trước khi patch
+# Cache redirect → URL thật (SQLite, dùng chung giữa CLI / web / bulk)
+URL_CACHE_MAX_ENTRIES = int(os.getenv("URL_CACHE_MAX_ENTRIES", "50000"))
+URL_CACHE_TTL = float(os.getenv("URL_CACHE_TTL", str(30 * 86400)))          # Resolve thành công
+URL_CACHE_NEGATIVE_TTL = float(os.getenv("URL_CACHE_NEGATIVE_TTL", "3600"))  # Resolve thất bại → thử lại sau
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "300"))              # 1 call genai SDK (analysis có thể lâu)
+
+# === Search cache (tools.search_cache — SQLite, dọn nền định kỳ) ===
+# SEARCH_CACHE_LIMITS="search=5000/200,subquery=10000/300,batch=1000/100" (entry tối đa / MB tối đa theo namespace, 0 = không giới hạn)
+def _parse_cache_limits(spec: str) -> dict[str, tuple[int, float]]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        namespace, _, value = item.partition("=")
+        entries, megabytes = (value.split("/") + ["0"])[:2]
+        limits[namespace.strip()] = (int(entries or 0), float(megabytes or 0))
+    return limits
+
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "86400"))              # Giây, quá hạn → bị sweep xoá
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "20000"))  # Tổng mọi namespace (0 = không giới hạn)
+SEARCH_CACHE_MAX_MB = float(os.getenv("SEARCH_CACHE_MAX_MB", "500"))
+SEARCH_CACHE_LIMITS = _parse_cache_limits(os.getenv("SEARCH_CACHE_LIMITS", ""))
+SEARCH_CACHE_EVICTION = os.getenv("SEARCH_CACHE_EVICTION", "lru")               # lru | lfu
+SEARCH_CACHE_SWEEP_SECONDS = float(os.getenv("SEARCH_CACHE_SWEEP_SECONDS", "600"))  # Chu kỳ sweep nền (0 = tắt)
+# Search lẻ gần trùng (Jaccard token sau chuẩn hoá, số phải khớp) dùng lại kết quả cache (0 = chỉ khớp chính xác).
+# Để cao: query ngắn khác 1 token (VD: khác phân khúc) đã rơi xuống ~0.8–0.9
+SEARCH_CACHE_SIMILARITY = float(os.getenv("SEARCH_CACHE_SIMILARITY", "0.95"))
+# Quá TTL nhưng còn trong grace → trả kết quả cũ ngay, làm mới ở nền (0 = tắt, chờ search mới như trước)
+SEARCH_CACHE_STALE_GRACE = float(os.getenv("SEARCH_CACHE_STALE_GRACE", str(7 * 86400)))
 
 # === Model Configuration ===
 GEMINI_MODEL_FAST = os.getenv("GEMINI_MODEL_FAST", "gemini-2.0-flash")
 GEMINI_MODEL_PRO = os.getenv("GEMINI_MODEL_PRO", "gemini-2.5-pro")
 
-# CrewAI uses LiteLLM format for Gemini
-CREWAI_LLM_FAST = f"gemini/{GEMINI_MODEL_FAST}"
-CREWAI_LLM_PRO = f"gemini/{GEMINI_MODEL_PRO}"
+# === Rate Limits (mỗi cặp API key × model 1 bucket riêng) ===
+# MODEL_RATE_LIMITS="gemini-2.0-flash=15/1500/1000000,gemini-2.5-pro=5/100/250000"
+# (RPM/RPD/TPM, RPD và TPM có thể bỏ trống, 0 = không giới hạn)
+def _parse_rate_limits(spec: str) -> dict[str, tuple[int, int, int]]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, _, value = item.partition("=")
+        rpm, rpd, tpm = (value.split("/") + ["0", "0"])[:3]
+        limits[model.strip()] = (int(rpm), int(rpd or 0), int(tpm or 0))
+    return limits
+
+MODEL_RATE_LIMITS = _parse_rate_limits(os.getenv("MODEL_RATE_LIMITS", ""))
+GEMINI_DEFAULT_RPM = int(os.getenv("GEMINI_DEFAULT_RPM", "5"))   # Model không có trong MODEL_RATE_LIMITS
+GEMINI_DEFAULT_RPD = int(os.getenv("GEMINI_DEFAULT_RPD", "0"))
+GEMINI_DEFAULT_TPM = int(os.getenv("GEMINI_DEFAULT_TPM", "0"))
+
+# === Retry (tools.retry_policy) ===
+RETRY_BUDGET = int(os.getenv("RETRY_BUDGET", "20"))                       # Số retry tối đa cho 1 run
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "5"))              # Giây, backoff tối thiểu
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "120"))
+RUN_DEADLINE_SECONDS = float(os.getenv("RUN_DEADLINE_SECONDS", "1800"))   # Không retry nếu vượt deadline (0 = không giới hạn)
+
+# === Circuit breaker / hedging cho gemini_analyze ===
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))  # Lỗi liên tiếp → open
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "300"))     # Cooldown đầu (gấp đôi mỗi lần thử lại lỗi, tối đa 1h)
+# Proxy chưa trả lời sau p90 latency → gọi thêm direct, lấy kết quả về trước
+HEDGE_ANALYSIS = os.getenv("HEDGE_ANALYSIS", "1") == "1"
+
+# === LLM Backend (tools.llm_backend) ===
+# live = gọi API thật | record = gọi thật + lưu request/response | replay = chạy offline từ recording
+LLM_BACKEND = os.getenv("LLM_BACKEND", "live")
+REPLAY_LATENCY = os.getenv("REPLAY_LATENCY", "0")                          # Giây / call, "0.2-1.5" = ngẫu nhiên trong khoảng
+REPLAY_RATE_LIMIT_RATE = float(os.getenv("REPLAY_RATE_LIMIT_RATE", "0"))  # Tỉ lệ call bị 429 giả lập (0-1)
+REPLAY_ON_MISS = os.getenv("REPLAY_ON_MISS", "error")                     # "synthetic" = trả response tổng hợp
+REPLAY_SEED = int(os.environ["REPLAY_SEED"]) if os.getenv("REPLAY_SEED") else None
+
+# CrewAI uses LiteLLM format for Gemini (record/replay → custom provider "bdr" của tools.llm_backend)
+_CREWAI_PROVIDER = "gemini" if LLM_BACKEND == "live" else "bdr"
+CREWAI_LLM_FAST = f"{_CREWAI_PROVIDER}/{GEMINI_MODEL_FAST}"
+CREWAI_LLM_PRO = f"{_CREWAI_PROVIDER}/{GEMINI_MODEL_PRO}"
+
+# === Pipeline Execution ===
+# Số stage tối đa chạy song song (API calls vẫn bị giới hạn bởi rate limiter)
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", "4"))
+# Stream token từ gemini_analyze → Delta events (web UI thấy nội dung ngay khi generate)
+STREAM_ANALYSIS = os.getenv("STREAM_ANALYSIS", "1") == "1"
+# Prefetch toàn bộ search batch song song ngay đầu run (step sau lấy từ cache)
+SEARCH_PREFETCH = os.getenv("SEARCH_PREFETCH", "1") == "1"
+# Step 5: "sectioned" = mỗi section 1 call song song (map-reduce), "single" = 1 call cho cả plan
+SYNTHESIS_MODE = os.getenv("SYNTHESIS_MODE", "sectioned")
+SYNTHESIS_MAX_WORKERS = int(os.getenv("SYNTHESIS_MAX_WORKERS", "6"))
+
+# Số ý tưởng chạy đồng thời ở bulk mode (main.py --ideas-file), dùng chung rate limiter
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "2"))
+
+# === Web Job Queue ===
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))            # Số pipeline chạy đồng thời trên server
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "20"))   # Số job tối đa được phép chờ
 
 # === Paths ===
 BASE_DIR = Path(__file__).parent
@@ -34,6 +135,8 @@ INDUSTRIES_DIR = KNOWLEDGE_DIR / "industries"
 MARKETS_DIR = KNOWLEDGE_DIR / "markets"
 TEMPLATES_DIR = BASE_DIR / "templates"
 OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "./output"))
+CACHE_DIR = Path(os.getenv("CACHE_DIR", str(BASE_DIR / "cache")))  # Search cache + URL cache
+RECORDINGS_DIR = Path(os.getenv("RECORDINGS_DIR", str(BASE_DIR / "recordings")))
 
 # === Supported Industries ===
 INDUSTRIES = {
@@ -133,8 +236,8 @@ INVESTMENT_THRESHOLDS = {
 
 def validate_config():
     """Validate required configuration."""
-    if not GEMINI_API_KEY:
-        raise ValueError("GEMINI_API_KEY is required. Set it in .env file.")
+    if not GEMINI_API_KEYS and LLM_BACKEND != "replay":
+        raise ValueError("GEMINI_API_KEY (or GEMINI_API_KEYS) is required. Set it in .env file.")
     
     # Create output directory if not exists
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -10,6 +10,7 @@ from agents.industry_expert import create_industry_expert
 from agents.plan_writer import create_plan_writer
 from utils import load_all_frameworks, load_industry, load_market
 from config import INDUSTRY_FRAMEWORKS, INDUSTRIES, MARKETS
+from tools.llm_backend import register_litellm_provider
 
 
 def build_business_plan_crew(
@@ -27,6 +28,9 @@ def build_business_plan_crew(
         market: Thị trường (vietnam, international, sea)
         use_pro_model: Dùng Gemini Pro (chậm hơn nhưng chất lượng cao hơn)
     """
+    # LLM_BACKEND=record/replay → agents gọi model "bdr/..." qua custom provider của LiteLLM
+    register_litellm_provider()
+    
     # --- Load Knowledge ---
     framework_names = INDUSTRY_FRAMEWORKS.get(industry, INDUSTRY_FRAMEWORKS["tech_startup"])
     frameworks_knowledge = load_all_frameworks(framework_names)
@@ -0,0 +1,185 @@
+"""
+Job Queue — hàng đợi có giới hạn + worker pool cho /api/run.
+- Mỗi run là 1 Job có ID, trạng thái, kết quả
+- Priority queue (priority nhỏ chạy trước, FIFO trong cùng priority) + admission limit
+- Worker pool cố định → backpressure thay vì 1 thread/request
+- Event buffer theo job → SSE client có thể attach lại và replay từ offset
+  (delta stream của 1 step gộp thành 1 event khi step xong → buffer không phình theo số token)
+"""
+import itertools
+import queue
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+
+class QueueFullError(Exception):
+    """Hàng đợi đã đủ job đang chờ — client nên thử lại sau."""
+
+
+class Job:
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    def __init__(self, request: dict, priority: int = 0):
+        self.id = uuid.uuid4().hex[:12]
+        self.request = request
+        self.priority = priority
+        self.status = Job.QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.filename = None
+        self.error = None
+        self.events: list[dict] = []  # Sắp theo offset; offset tăng dần, không dùng lại sau khi gộp delta
+        self.next_offset = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (Job.SUCCEEDED, Job.FAILED)
+
+    def append_event(self, message: dict):
+        """Ghi event vào buffer (kèm offset) và đánh thức các stream đang chờ."""
+        with self._cond:
+            message = {**message, "offset": self.next_offset}
+            self.next_offset += 1
+            self.events.append(message)
+            if message.get("event") == "step_end":
+                self._compact_deltas(lambda m: m.get("step") == message.get("step"))
+            elif message.get("event") == "done":
+                self._compact_deltas(lambda m: True)
+            self._cond.notify_all()
+
+    def _compact_deltas(self, match):
+        """
+        Gộp các delta của 1 step thành 1 event reset=True mang offset của delta cuối:
+        client replay từ đầu hay từ giữa step đều dựng lại đúng text (reset = thay phần đã nhận).
+        """
+        groups: dict = {}
+        for m in self.events:
+            if m.get("event") == "delta" and match(m):
+                groups.setdefault(m.get("step"), []).append(m)
+        merged_away = set()
+        for deltas in groups.values():
+            if len(deltas) < 2:
+                continue
+            text = ""
+            for m in deltas:
+                text = m.get("text", "") if m.get("reset") else text + m.get("text", "")
+            last = deltas[-1]
+            last.update(text=text, reset=True)
+            merged_away.update(id(m) for m in deltas[:-1])
+        if merged_away:
+            self.events = [m for m in self.events if id(m) not in merged_away]
+
+    def events_since(self, offset: int) -> list[dict]:
+        with self._cond:
+            return self.events[bisect_left(self.events, offset, key=lambda m: m["offset"]):]
+
+    def to_dict(self, position: int | None = None) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": self.next_offset,
+            "filename": self.filename,
+            "error": self.error,
+            "idea": self.request.get("idea", ""),
+        }
+        if position is not None:
+            data["position"] = position
+        return data
+
+
+class JobManager:
+    """
+    Worker pool xử lý Job theo priority. `runner(job)` chạy pipeline, ghi event
+    qua job.append_event và set job.result / job.filename; exception → job FAILED.
+    """
+    def __init__(self, runner, workers: int = 2, max_pending: int = 20, max_retained: int = 200):
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.max_retained = max_retained
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, request: dict, priority: int = 0) -> Job:
+        """Đưa job vào hàng đợi. Raise QueueFullError nếu vượt admission limit."""
+        with self._lock:
+            if self.pending_count() >= self.max_pending:
+                raise QueueFullError(f"Job queue full ({self.max_pending} jobs đang chờ)")
+            self._ensure_workers()
+            job = Job(request, priority=priority)
+            self._jobs[job.id] = job
+            self._prune()
+            job.append_event({"event": "job", "job_id": job.id, "status": job.status,
+                              "position": self.position(job.id)})
+            self._queue.put((priority, next(self._seq), job.id))
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def pending_count(self) -> int:
+        return sum(1 for j in self._jobs.values() if j.status == Job.QUEUED)
+
+    def position(self, job_id: str) -> int | None:
+        """Vị trí trong hàng đợi (0 = chạy kế tiếp), None nếu không còn chờ."""
+        job = self._jobs.get(job_id)
+        if not job or job.status != Job.QUEUED:
+            return None
+        ahead = [j for j in self._jobs.values()
+                 if j.status == Job.QUEUED and (j.priority, j.created_at) < (job.priority, job.created_at)]
+        return len(ahead)
+
+    def _prune(self):
+        """Giữ tối đa max_retained job, bỏ các job đã xong cũ nhất trước."""
+        if len(self._jobs) <= self.max_retained:
+            return
+        finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished_at)
+        for job in finished[:len(self._jobs) - self.max_retained]:
+            del self._jobs[job.id]
+
+    def _worker(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            job.append_event({"event": "job", "job_id": job.id, "status": job.status})
+            status = Job.SUCCEEDED
+            try:
+                self.runner(job)
+            except Exception as e:
+                status = Job.FAILED
+                job.error = str(e)
+                job.append_event({"event": "error", "message": str(e)})
+            # "done" phải vào buffer trước khi status đổi → stream không bị cắt thiếu event cuối
+            job.finished_at = time.time()
+            job.append_event({"event": "done", "job_id": job.id, "status": status})
+            job.status = status
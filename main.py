@@ -9,6 +9,11 @@ Usage:
     python main.py --list-industries
     python main.py --idea "..." --dry-run
     python main.py --clear-cache
+    python main.py --migrate-cache
+    python main.py --sweep-cache
+    python main.py --resume <run-id>
+    python main.py --rerun <run-id> --context context.json
+    python main.py --ideas-file ideas.jsonl --concurrency 3
 """
 import argparse
 import os
@@ -20,13 +25,14 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from config import (
+    BULK_CONCURRENCY,
     INDUSTRIES,
     MARKETS,
     INDUSTRY_FRAMEWORKS,
     OUTPUT_DIR,
     validate_config,
 )
-from utils import save_output
+from utils import format_report_header, save_output
 
 
 def parse_args():
@@ -39,6 +45,14 @@ Examples:
   python main.py --idea "..." --context context.json
   python main.py --idea "..." --no-interactive
   python main.py --clear-cache
+  python main.py --migrate-cache
+  python main.py --sweep-cache
+  python main.py --resume 3f2a9c0d1b7e4a55
+  python main.py --rerun 3f2a9c0d1b7e4a55 --context context.json
+  python main.py --ideas-file ideas.jsonl --concurrency 3
+
+ideas.jsonl (mỗi dòng 1 ý tưởng):
+  {"idea": "AI chatbot CSKH cho SME", "industry": "tech_startup", "context": {"budget_vnd": 50000000}}
         """
     )
     
@@ -57,6 +71,18 @@ Examples:
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument("--clear-cache", action="store_true",
                        help="Clear search cache")
+    parser.add_argument("--migrate-cache", action="store_true",
+                       help="Import search cache JSON cũ (cache/*.json) vào SQLite rồi xoá file JSON")
+    parser.add_argument("--sweep-cache", action="store_true",
+                       help="Xoá entry hết hạn + evict phần vượt giới hạn search cache ngay")
+    parser.add_argument("--resume", type=str, default=None, metavar="RUN_ID",
+                       help="Resume run bị lỗi từ checkpoint (run ID in ở đầu mỗi run)")
+    parser.add_argument("--rerun", type=str, default=None, metavar="RUN_ID",
+                       help="Chạy lại run cũ với context mới — chỉ tính lại các step bị ảnh hưởng")
+    parser.add_argument("--ideas-file", type=str, default=None, metavar="JSONL",
+                       help="Bulk mode: chạy nhiều ý tưởng (1 JSON/dòng), xuất report + summary.csv")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY,
+                       help=f"Số ý tưởng chạy đồng thời ở bulk mode (mặc định {BULK_CONCURRENCY})")
     
     return parser.parse_args()
 
@@ -119,9 +145,11 @@ def run_dry(idea, industry, market):
         print(f"  ❌ Gemini Search error: {e}")
     
     # Check cache
-    from tools.search_cache import CACHE_DIR
-    cache_files = list(CACHE_DIR.glob("*.json")) if CACHE_DIR.exists() else []
-    print(f"\n  💾 Cache: {len(cache_files)} entries in {CACHE_DIR}")
+    from tools.search_cache import DB_PATH, cache_stats
+    stats = cache_stats()
+    total = sum(s["entries"] for s in stats.values())
+    detail = ", ".join(f"{ns}: {s['entries']}" for ns, s in sorted(stats.items()))
+    print(f"\n  💾 Cache: {total} entries in {DB_PATH}" + (f" ({detail})" if detail else ""))
     
     return True
 
@@ -136,6 +164,18 @@ def main():
         print("✅ Search cache cleared")
         return
     
+    if args.migrate_cache:
+        from tools.search_cache import CACHE_DIR, migrate_json_cache
+        imported, skipped = migrate_json_cache(CACHE_DIR, delete=True)
+        print(f"✅ Migrated {imported} cache entries from {CACHE_DIR}/*.json" +
+              (f" ({skipped} file lỗi, giữ nguyên)" if skipped else ""))
+        return
+    
+    if args.sweep_cache:
+        from tools.search_cache import format_sweep_report, sweep_cache
+        print(format_sweep_report(sweep_cache()))
+        return
+    
     if args.list_industries:
         list_industries()
         return
@@ -148,6 +188,28 @@ def main():
                 print(f"     {i}. {fw}")
         return
     
+    if args.ideas_file:
+        from bulk import load_ideas_file, run_bulk
+        try:
+            ideas = load_ideas_file(args.ideas_file, args.industry, args.market)
+            validate_config()
+        except (OSError, ValueError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        run_bulk(ideas, concurrency=args.concurrency)
+        return
+    
+    if args.resume or args.rerun:
+        from tools.checkpoint import CheckpointStore
+        try:
+            manifest = CheckpointStore(args.resume or args.rerun).load_manifest()
+        except FileNotFoundError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        args.idea = manifest["business_idea"]
+        args.industry = manifest["industry"]
+        args.market = manifest["market"]
+    
     if not args.idea:
         print("❌ Cần --idea 'mô tả ý tưởng'. Ví dụ:")
         print("   python main.py --idea 'AI chatbot cho SME Việt Nam'")
@@ -166,7 +228,13 @@ def main():
         sys.exit(1)
     
     # Import and run pipeline
-    from pipeline import run_pipeline
+    from pipeline import ProgressTracker, run_pipeline
+    from tools.events import EventBus, RunSummary
+    
+    events = EventBus()
+    events.subscribe(ProgressTracker())
+    summary = RunSummary()
+    events.subscribe(summary)
     
     final_plan = run_pipeline(
         business_idea=args.idea,
@@ -174,25 +242,21 @@ def main():
         market=args.market,
         context_file=args.context,
         interactive=not args.no_interactive,
+        resume=args.resume,
+        base_run=args.rerun,
+        events=events,
     )
     
     # Save output
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = args.output or f"business_plan_{args.industry}_{timestamp}.md"
     
-    header = f"""---
-title: Business Plan - {args.idea}
-industry: {args.industry}
-market: {args.market}
-generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-engine: Gemini API + Google Search Grounding (v4)
-frameworks: {", ".join(INDUSTRY_FRAMEWORKS.get(args.industry, []))}
-version: v4
----
-
-"""
+    header = format_report_header(args.idea, args.industry, args.market, stale_cache=summary.stale_cache)
     full_output = header + final_plan
     filepath = save_output(full_output, filename, OUTPUT_DIR)
+    # Link chưa kịp resolve trong lúc search → resolve nền rồi ghi lại file
+    from tools.gemini_search import patch_report_when_resolved
+    patch_report_when_resolved(filepath)
     
     print(f"\n{'='*60}")
     print(f"✅ Business plan đã được tạo thành công!")
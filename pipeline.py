@@ -8,37 +8,80 @@ Changes vs v3:
 - Search caching (24h TTL)
 - URL resolver for redirect links
 - Output validator
+- DAG executor: Strategy ∥ Financial chạy song song sau Research
+- Event bus riêng cho từng run (tools.events) thay cho global tracker
+- Checkpoint từng stage → resume bằng run ID (main.py --resume)
+- Incremental rerun: sửa ctx rồi chạy lại trên run cũ (--rerun) → chỉ các stage
+  đọc field đã đổi (và downstream của chúng) được tính lại
+- Search plan: mọi search batch được prefetch song song ngay đầu run
+- Sectioned synthesis: 13 sections generate song song + 1 pass Executive Summary
 """
+import contextvars
 import json
 import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from tools.gemini_search import gemini_batch_search, gemini_deep_research, gemini_analyze
 from tools.output_validator import validate_output, format_validation_report
+from tools.dag_executor import Stage, run_stages
+from tools.rate_limits import call_priority, current_priority
+from tools.retry_policy import RetryBudget, retry_budget
+from tools.checkpoint import (
+    CheckpointStore, ScopedCheckpoint, TrackedContext, compute_run_id, diff_context, is_error_output,
+    knowledge_version,
+)
+from tools.events import (
+    Event, EventBus, StepStarted, StepFinished, RunFinished, RunSummary,
+    emit, get_bus, log, use_bus, format_event, set_current_step,
+)
 from utils import load_all_frameworks, load_industry, load_market
-from config import INDUSTRY_FRAMEWORKS, INDUSTRIES, MARKETS
+from config import (
+    INDUSTRY_FRAMEWORKS, INDUSTRIES, MARKETS, PIPELINE_MAX_WORKERS, SEARCH_PREFETCH,
+    SYNTHESIS_MODE, SYNTHESIS_MAX_WORKERS, RETRY_BUDGET, RUN_DEADLINE_SECONDS,
+)
 
 
 # ═══════════════════════════════════════════════
 # PROGRESS TRACKER
 # ═══════════════════════════════════════════════
 
+STEP_NAMES = [
+    "Nghiên Cứu Thị Trường & Đối Thủ",
+    "Chiến Lược & Go-to-Market",
+    "Tài Chính & Chấm Điểm",
+    "Devil's Advocate (Phản Biện)",
+    "Tổng Hợp Business Plan",
+]
+TOTAL_STEPS = len(STEP_NAMES)
+
+
 class ProgressTracker:
-    """Visual progress tracker for terminal output."""
-    def __init__(self, total_steps: int = 5):
+    """Visual progress tracker — subscriber của event bus, render step events ra terminal."""
+    def __init__(self, total_steps: int = TOTAL_STEPS):
         self.total_steps = total_steps
         self.current_step = 0
         self.start_time = time.time()
-        self.step_times = []
-        self.step_names = [
-            "Nghiên Cứu Thị Trường & Đối Thủ",
-            "Chiến Lược & Go-to-Market",
-            "Tài Chính & Chấm Điểm",
-            "Devil's Advocate (Phản Biện)",
-            "Tổng Hợp Business Plan",
-        ]
+        self.step_times = {}  # step_num → start time
+        self.completed = set()
+        self.lock = threading.Lock()
+        self.step_names = STEP_NAMES
+    
+    def __call__(self, event: Event):
+        if isinstance(event, StepStarted):
+            self.start_step(event.step, event.name)
+        elif isinstance(event, StepFinished):
+            self.end_step(event.step, event.duration)
+        elif isinstance(event, RunFinished):
+            self.finish(event.duration, event.stale_cache)
+        else:
+            line = format_event(event)
+            if line is not None:
+                with self.lock:
+                    print(line)
     
     def _progress_bar(self, current, total, width=30):
         filled = int(width * current / total)
@@ -53,50 +96,63 @@ class ProgressTracker:
         return f"{mins:02d}:{secs:02d}"
     
     def start_step(self, step_num: int, name: str = ""):
-        self.current_step = step_num
-        step_start = time.time()
-        self.step_times.append(step_start)
-        
-        step_name = name or self.step_names[step_num - 1]
-        icons = ["📊", "📐", "💰", "😈", "📝"]
-        icon = icons[step_num - 1] if step_num <= len(icons) else "🔄"
-        
-        print(f"\n{'━' * 60}")
-        print(f"  {self._progress_bar(step_num - 1, self.total_steps)}  ⏱️ {self._elapsed()}")
-        print(f"{'━' * 60}")
-        print(f"  {icon} STEP {step_num}/{self.total_steps}: {step_name.upper()}")
-        print(f"{'━' * 60}")
-        
-        # Show remaining steps
-        for i in range(self.total_steps):
-            if i < step_num - 1:
-                print(f"    ✅ Step {i+1}: {self.step_names[i]}")
-            elif i == step_num - 1:
-                print(f"    ▶️ Step {i+1}: {self.step_names[i]} ← đang chạy")
-            else:
-                print(f"    ⬜ Step {i+1}: {self.step_names[i]}")
-        print()
-    
-    def end_step(self, step_num: int):
-        if self.step_times:
-            step_duration = time.time() - self.step_times[-1]
-            mins = int(step_duration // 60)
-            secs = int(step_duration % 60)
+        with self.lock:
+            if not self.step_times:  # Tracker có thể tạo trước questionnaire → tính giờ từ step đầu
+                self.start_time = time.time()
+            self.current_step = step_num
+            self.step_times[step_num] = time.time()
+            
+            step_name = name or self.step_names[step_num - 1]
+            icons = ["📊", "📐", "💰", "😈", "📝"]
+            icon = icons[step_num - 1] if step_num <= len(icons) else "🔄"
+            
+            print(f"\n{'━' * 60}")
+            print(f"  {self._progress_bar(len(self.completed), self.total_steps)}  ⏱️ {self._elapsed()}")
+            print(f"{'━' * 60}")
+            print(f"  {icon} STEP {step_num}/{self.total_steps}: {step_name.upper()}")
+            print(f"{'━' * 60}")
+            
+            # Show remaining steps
+            for i in range(self.total_steps):
+                if i + 1 in self.completed:
+                    print(f"    ✅ Step {i+1}: {self.step_names[i]}")
+                elif i + 1 in self.step_times:
+                    print(f"    ▶️ Step {i+1}: {self.step_names[i]} ← đang chạy")
+                else:
+                    print(f"    ⬜ Step {i+1}: {self.step_names[i]}")
+            print()
+    
+    def end_step(self, step_num: int, duration: float):
+        with self.lock:
+            self.completed.add(step_num)
+            mins = int(duration // 60)
+            secs = int(duration % 60)
             print(f"  ✅ Step {step_num} hoàn thành ({mins:02d}:{secs:02d})")
     
-    def finish(self):
-        total_elapsed = time.time() - self.start_time
+    def finish(self, total_elapsed: float, stale_cache: int = 0):
         mins = int(total_elapsed // 60)
         secs = int(total_elapsed % 60)
         
-        print(f"\n{'━' * 60}")
-        print(f"  {self._progress_bar(self.total_steps, self.total_steps)}  ⏱️ {mins:02d}:{secs:02d}")
-        print(f"{'━' * 60}")
-        print(f"  🎉 TẤT CẢ 5 STEPS ĐÃ HOÀN THÀNH!")
-        print(f"  ⏱️  Tổng thời gian: {mins} phút {secs} giây")
-        print(f"{'━' * 60}")
+        with self.lock:
+            print(f"\n{'━' * 60}")
+            print(f"  {self._progress_bar(self.total_steps, self.total_steps)}  ⏱️ {mins:02d}:{secs:02d}")
+            print(f"{'━' * 60}")
+            print(f"  🎉 TẤT CẢ {self.total_steps} STEPS ĐÃ HOÀN THÀNH!")
+            print(f"  ⏱️  Tổng thời gian: {mins} phút {secs} giây")
+            if stale_cache:
+                print(f"  💾 {stale_cache} kết quả search từ cache cũ (quá TTL) — đang làm mới ở nền")
+            print(f"{'━' * 60}")
+
+
+def _step_started(step_num: int) -> float:
+    set_current_step(step_num)  # Delta events từ gemini_analyze gắn với step này
+    emit(StepStarted(step=step_num, total=TOTAL_STEPS, name=STEP_NAMES[step_num - 1]))
+    return time.time()
 
-_tracker = ProgressTracker()
+
+def _step_finished(step_num: int, started: float):
+    emit(StepFinished(step=step_num, total=TOTAL_STEPS, name=STEP_NAMES[step_num - 1],
+                      duration=time.time() - started))
 
 
 # ═══════════════════════════════════════════════
@@ -269,61 +325,133 @@ def _context_to_prompt_notes(ctx: dict) -> str:
 
 
 # ═══════════════════════════════════════════════
-# PIPELINE STEPS
+# SEARCH PLAN
 # ═══════════════════════════════════════════════
+# Query của các step chỉ phụ thuộc idea/market/ctx (không phụ thuộc output step trước)
+# → build trước được và prefetch song song ngay khi run bắt đầu.
 
-def step_research(business_idea: str, industry: str, market: str, ctx: dict) -> str:
-    """Step 1: Market Research + Competitors (2 batch calls)."""
-    _tracker.start_step(1)
-    
+def _research_batches(business_idea: str, industry: str, market: str, ctx: dict) -> dict:
     ind_name = INDUSTRIES.get(industry, industry)
     mkt_name = MARKETS.get(market, market)
     target = ctx.get("target_customers", "SME")
-    advantages = ctx.get("competitive_advantages", [])
     idea_keywords = business_idea[:100]
     
-    print("  🔎 Batch 1: Nghiên cứu thị trường...")
     batch1 = [
         f"Quy mô thị trường {ind_name} tại {mkt_name} 2024-2026, CAGR, dự báo tăng trưởng, market size",
         f"Nhu cầu của {target} tại {mkt_name} 2025, chi tiêu cho công nghệ giáo dục, chuyển đổi số",
         f"Xu hướng AI trong {ind_name} tại {mkt_name} 2025 2026: {idea_keywords}, adoption rate benchmark",
         f"Chính sách hỗ trợ startup công nghệ {mkt_name} 2025, quy định pháp lý EdTech, bảo vệ dữ liệu",
     ]
-    
-    result1 = gemini_batch_search(batch1, topic=f"Thị trường {ind_name} tại {mkt_name}")
-    
-    print("  🔎 Batch 2: Phân tích đối thủ & chi phí...")
     batch2 = [
         f"Top đối thủ cạnh tranh cho {target} trong ngành {ind_name} {mkt_name} 2025: so sánh pricing features strengths weaknesses",
         f"Đối thủ quốc tế trong ngành {ind_name}: {idea_keywords}, so sánh giá tính năng, điểm yếu tại {mkt_name}",
         f"Hành vi chi tiêu của {target} {mkt_name}, willingness to pay cho sản phẩm {ind_name}, channels preferred",
         f"Chi phí cloud hosting API AI 3D rendering cho startup {mkt_name} 2025, pricing tiers cho MVP",
     ]
+    return {
+        "market": (batch1, f"Thị trường {ind_name} tại {mkt_name}"),
+        "competitors": (batch2, f"Đối thủ & Chi phí {ind_name}"),
+    }
+
+
+def _strategy_batch(market: str) -> tuple[list[str], str]:
+    return [
+        f"Go-to-market strategy SaaS startup bootstrapped {MARKETS.get(market)} 2025, PLG channels CAC",
+        f"Content marketing SEO cho SaaS startup {MARKETS.get(market)}, freemium conversion benchmark",
+        f"Blue ocean cơ hội thị trường ngách SaaS micro-SME {MARKETS.get(market)}, underserved",
+        f"SaaS metrics benchmark 2025: gross margin, churn, freemium conversion, LTV/CAC",
+    ], "Strategy & GTM benchmarks"
+
+
+def _financial_batch(market: str) -> tuple[list[str], str]:
+    return [
+        f"Chi phí khởi nghiệp SaaS startup {MARKETS.get(market)} 2025: hosting, tools, marketing",
+        f"SaaS revenue projection benchmark Year 1-3 monthly MRR growth early stage",
+        f"Thuế doanh nghiệp {MARKETS.get(market)} 2025, ưu đãi startup công nghệ",
+    ], "Financial benchmarks"
+
+
+# Stage có search → stage upstream mà output của nó phụ thuộc (khớp inputs trong run_pipeline)
+_SEARCH_STAGE_INPUTS = {"research": [], "strategy": ["research"], "financials": ["research"]}
+
+
+def plan_searches(business_idea: str, industry: str, market: str, ctx: dict) -> dict:
+    """Tất cả search batch của run, theo stage: {stage: [(queries, topic), ...]}."""
+    return {
+        "research": list(_research_batches(business_idea, industry, market, ctx).values()),
+        "strategy": [_strategy_batch(market)],
+        "financials": [_financial_batch(market)],
+    }
+
+
+def _prefetch_searches(business_idea: str, industry: str, market: str, ctx: dict,
+                       checkpoint: CheckpointStore | None = None):
+    """
+    Bắn tất cả search batch song song ở background (qua shared rate limiter).
+    Step nào gọi đúng batch đó sau sẽ lấy từ cache, hoặc chờ request đang bay
+    (single-flight trong gemini_batch_search) thay vì gọi lại.
+    Bỏ qua stage sẽ được dùng lại từ checkpoint (cùng kiểm tra dependency như lookup: ctx đã
+    đọc + output upstream) — tránh tốn API cho kết quả không dùng tới.
+    """
+    reused = {}
+    if checkpoint is not None:
+        for stage, names in _SEARCH_STAGE_INPUTS.items():
+            if all(name in reused for name in names):
+                output = checkpoint.peek(stage, {name: reused[name] for name in names}, ctx)
+                if output is not None:
+                    reused[stage] = output
+    plan = plan_searches(business_idea, industry, market, ctx)
+    batches = [batch for stage, stage_batches in plan.items() if stage not in reused for batch in stage_batches]
+    if not batches:
+        return
+    log(f"  🚀 Prefetch {len(batches)} search batches song song...")
+    
+    def _prefetch(queries, topic):
+        # Prefetch là suy đoán → xếp hàng sau các call trên critical path
+        with call_priority(current_priority() + 1):
+            gemini_batch_search(queries, topic)
+    
+    pool = ThreadPoolExecutor(max_workers=len(batches), thread_name_prefix="prefetch")
+    for queries, topic in batches:
+        pool.submit(contextvars.copy_context().run, _prefetch, queries, topic)
+    pool.shutdown(wait=False)  # không chặn pipeline; thread tự kết thúc khi search xong
+
+
+# ═══════════════════════════════════════════════
+# PIPELINE STEPS
+# ═══════════════════════════════════════════════
+
+def step_research(business_idea: str, industry: str, market: str, ctx: dict) -> str:
+    """Step 1: Market Research + Competitors (2 batch calls)."""
+    started = _step_started(1)
+    
+    batches = _research_batches(business_idea, industry, market, ctx)
     
-    result2 = gemini_batch_search(batch2, topic=f"Đối thủ & Chi phí {ind_name}")
+    # 2 batch độc lập → chạy song song
+    log("  🔎 Batch 1 + 2: Nghiên cứu thị trường & đối thủ (song song)...")
+    results = run_stages([
+        Stage(name, lambda queries=queries, topic=topic: gemini_batch_search(queries, topic=topic))
+        for name, (queries, topic) in batches.items()
+    ], max_workers=2)
+    result1, result2 = results["market"], results["competitors"]
     
-    _tracker.end_step(1)
+    _step_finished(1, started)
     return f"## Market Research\n{result1}\n\n## Competitor & Cost Research\n{result2}"
 
 
 def step_strategy_gtm(business_idea: str, industry: str, market: str,
                       ctx: dict, research_data: str) -> str:
     """Step 2: Strategy + GTM (1 batch + 1 analysis)."""
-    _tracker.start_step(2)
+    started = _step_started(2)
     
     ind_name = INDUSTRIES.get(industry, industry)
     framework_names = INDUSTRY_FRAMEWORKS.get(industry, INDUSTRY_FRAMEWORKS["tech_startup"])
     frameworks_knowledge = load_all_frameworks(framework_names)
     ctx_notes = _context_to_prompt_notes(ctx)
     
-    batch = [
-        f"Go-to-market strategy SaaS startup bootstrapped {MARKETS.get(market)} 2025, PLG channels CAC",
-        f"Content marketing SEO cho SaaS startup {MARKETS.get(market)}, freemium conversion benchmark",
-        f"Blue ocean cơ hội thị trường ngách SaaS micro-SME {MARKETS.get(market)}, underserved",
-        f"SaaS metrics benchmark 2025: gross margin, churn, freemium conversion, LTV/CAC",
-    ]
-    print("  🔎 Searching GTM benchmarks...")
-    search_data = gemini_batch_search(batch, topic="Strategy & GTM benchmarks")
+    batch, topic = _strategy_batch(market)
+    log("  🔎 Searching GTM benchmarks...")
+    search_data = gemini_batch_search(batch, topic=topic)
     
     analysis_prompt = f"""
 Bạn là cựu Partner McKinsey + CMO 15 năm scale SaaS.
@@ -360,29 +488,25 @@ Bạn là cựu Partner McKinsey + CMO 15 năm scale SaaS.
 - Viết tiếng Việt | Tables markdown | Thực tế cho bootstrap 1 người
 """
     
-    print("  🧠 Analyzing with Gemini Pro...")
+    log("  🧠 Analyzing with Gemini Pro...")
     report = gemini_analyze(analysis_prompt, context=f"## Research:\n{research_data[:4000]}\n\n## Search:\n{search_data}")
-    _tracker.end_step(2)
+    _step_finished(2, started)
     return report
 
 
 def step_financials(business_idea: str, industry: str, market: str,
                     ctx: dict, research_data: str) -> str:
     """Step 3: Financial Analysis + Scoring."""
-    _tracker.start_step(3)
+    started = _step_started(3)
     
     budget = ctx.get("budget_vnd", 50_000_000)
     budget_display = f"{budget / 1_000_000:.0f} triệu VND"
     ctx_notes = _context_to_prompt_notes(ctx)
     scoring = _get_scoring_prompt(ctx)
     
-    batch = [
-        f"Chi phí khởi nghiệp SaaS startup {MARKETS.get(market)} 2025: hosting, tools, marketing",
-        f"SaaS revenue projection benchmark Year 1-3 monthly MRR growth early stage",
-        f"Thuế doanh nghiệp {MARKETS.get(market)} 2025, ưu đãi startup công nghệ",
-    ]
-    print("  🔎 Searching financial benchmarks...")
-    benchmark_data = gemini_batch_search(batch, topic="Financial benchmarks")
+    batch, topic = _financial_batch(market)
+    log("  🔎 Searching financial benchmarks...")
+    benchmark_data = gemini_batch_search(batch, topic=topic)
     fin_frameworks = load_all_frameworks(["financial_projections", "investment_analysis"])
     
     analysis_prompt = f"""
@@ -422,15 +546,15 @@ Bạn là CFA kiêm serial entrepreneur. Xây dựng MÔ HÌNH TÀI CHÍNH:
 - Verdict decisive, dựa trên data
 """
     
-    print("  🧠 Analyzing financials with Gemini Pro...")
+    log("  🧠 Analyzing financials with Gemini Pro...")
     report = gemini_analyze(analysis_prompt, context=f"## Benchmarks:\n{benchmark_data}\n\n## Research:\n{research_data[:3000]}")
-    _tracker.end_step(3)
+    _step_finished(3, started)
     return report
 
 
 def step_devils_advocate(business_idea: str, ctx: dict, all_analysis: str) -> str:
     """Step 4: Devil's Advocate — phản biện và tìm lỗi."""
-    _tracker.start_step(4)
+    started = _step_started(4)
     
     prompt = f"""
 Bạn là DEVIL'S ADVOCATE. Công việc duy nhất: TÌM LỖI và THÁCH THỨC.
@@ -471,17 +595,47 @@ Bạn KHÔNG được đồng ý hay khen. Bạn chỉ được PHÊ BÌNH.
 - Kết luận: "Rủi ro lớn nhất theo tôi là..."
 """
     
-    print("  🧠 Running Devil's Advocate analysis...")
+    log("  🧠 Running Devil's Advocate analysis...")
     report = gemini_analyze(prompt, context=all_analysis[:8000])
-    _tracker.end_step(4)
+    _step_finished(4, started)
     return report
 
 
-def step_final_synthesis(business_idea: str, industry: str, market: str,
-                         ctx: dict, all_sections: dict) -> str:
-    """Step 5: Final synthesis with cross-validation."""
-    _tracker.start_step(5)
-    
+# Sectioned synthesis: mỗi section 1 prompt riêng, chỉ nhận upstream material cần thiết
+# (title, yêu cầu nội dung, upstream sections)
+SYNTHESIS_SOURCES = {
+    "research": "Market Research & Competitors",
+    "strategy": "Strategic Analysis & Go-to-Market",
+    "financials": "Financial Analysis & Decision",
+    "devils": "Devil's Advocate (Phản Biện)",
+}
+SYNTHESIS_SECTIONS = [
+    ("1. Company Description", "Vision, Mission, Problem, Solution", ["research", "strategy"]),
+    ("2. Market Analysis", "TAM/SAM/SOM TABLE, **2 Personas**, 7+ Trends", ["research", "strategy"]),
+    ("3. Competitive Analysis", "Competitor TABLE, Positioning, Advantages", ["research", "strategy"]),
+    ("4. Business Model", "Lean Canvas TABLE, Revenue, Pricing TABLE — DÙNG GIÁ TỪ CONTEXT",
+     ["strategy", "financials"]),
+    ("5. Strategic Analysis", "SWOT TABLE, TOWS, Porter TABLE, PESTEL, ERRC Grid TABLE", ["strategy"]),
+    ("6. Go-to-Market Strategy", "Phases by month, Channels TABLE, Content plan", ["strategy"]),
+    ("7. Operations Plan", "Tech Stack TABLE, Team timeline, Milestones TABLE", ["strategy", "financials"]),
+    ("8. Financial Projections",
+     "Assumptions TABLE; Revenue TABLE: **3 SCENARIOS (Pessimistic/Base/Optimistic) — MONTHLY Y1**; "
+     "P&L TABLE; Cash Flow TABLE; Unit Economics TABLE; Break-Even", ["financials"]),
+    ("9. Quyết Định & Chấm Điểm", "Decision Matrix TABLE, VERDICT bold", ["financials", "devils"]),
+    ("10. 😈 Devil's Advocate — Phản Biện & Thách Thức",
+     "Giữ NGUYÊN NỘI DUNG phản biện, KHÔNG LÀM NHẸ ĐI", ["devils"]),
+    ("11. Implementation Roadmap", "Roadmap TABLE theo tháng", ["strategy", "financials"]),
+    ("12. Risk Management", "Risk TABLE (7+ risks): xác suất, impact, mitigation", ["research", "devils"]),
+    ("13. Appendix", "Legal checklist, Assumptions", ["research", "financials"]),
+]
+SECTION_SOURCE_CHARS = 6000   # Upstream material tối đa / nguồn / section
+SUMMARY_SECTION_CHARS = 1200  # Mỗi section đưa vào pass Executive Summary
+
+CITATION_PATTERN = re.compile(r"\[([^\]]+)\]\((https?://[^)\s]+)\)")
+
+
+def _synthesis_header(business_idea: str, industry: str, market: str, ctx: dict) -> tuple[str, str]:
+    """(thông tin chung cho mọi prompt synthesis, heading tên dự án)."""
     ind_name = INDUSTRIES.get(industry, industry)
     mkt_name = MARKETS.get(market, market)
     budget = ctx.get("budget_vnd", 50_000_000)
@@ -489,26 +643,53 @@ def step_final_synthesis(business_idea: str, industry: str, market: str,
     timestamp = datetime.now().strftime("%d/%m/%Y")
     ctx_notes = _context_to_prompt_notes(ctx)
     
-    try:
-        industry_knowledge = load_industry(industry)[:2000]
-    except FileNotFoundError:
-        industry_knowledge = ""
-    
-    project_name_note = ""
     if ctx.get("project_name"):
         project_name_note = f"# {ctx['project_name']} - Business Plan"
     else:
         project_name_note = "# [TÊN DỰ ÁN] - Business Plan"
     
-    synthesis_prompt = f"""
-Bạn là Senior Business Plan Writer. TỔNG HỢP thành business plan hoàn chỉnh.
-
-**Ý tưởng:** {business_idea}
+    info = f"""**Ý tưởng:** {business_idea}
 **Ngành:** {ind_name} | **Thị trường:** {mkt_name}
 **Vốn:** {budget_display} | **Ngày:** {timestamp}
 
 ## CONTEXT BẮT BUỘC — TUÂN THỦ TUYỆT ĐỐI:
-{ctx_notes}
+{ctx_notes}"""
+    return info, project_name_note
+
+
+def _collect_sources(texts) -> list[tuple[str, str]]:
+    """Tất cả [title](url) trong upstream material, dedupe theo URL, giữ thứ tự xuất hiện."""
+    seen = {}
+    for text in texts:
+        for title, url in CITATION_PATTERN.findall(text):
+            seen.setdefault(url, title)
+    return [(title, url) for url, title in seen.items()]
+
+
+def step_final_synthesis(business_idea: str, industry: str, market: str,
+                         ctx: dict, all_sections: dict, checkpoint: CheckpointStore | None = None) -> str:
+    """
+    Step 5: Final synthesis with cross-validation (SYNTHESIS_MODE: sectioned | single).
+    `checkpoint`: sectioned mode lưu từng section → resume chỉ viết lại section lỗi.
+    """
+    started = _step_started(5)
+    if SYNTHESIS_MODE == "single":
+        report = _synthesis_single(business_idea, industry, market, ctx, all_sections)
+    else:
+        report = _synthesis_sectioned(business_idea, industry, market, ctx, all_sections, checkpoint)
+    _step_finished(5, started)
+    return report
+
+
+def _synthesis_single(business_idea: str, industry: str, market: str,
+                      ctx: dict, all_sections: dict) -> str:
+    """1 lần gọi cho cả 13 sections (chế độ cũ)."""
+    info, project_name_note = _synthesis_header(business_idea, industry, market, ctx)
+    
+    synthesis_prompt = f"""
+Bạn là Senior Business Plan Writer. TỔNG HỢP thành business plan hoàn chỉnh.
+
+{info}
 
 ## STRUCTURE (13 sections):
 
@@ -550,11 +731,96 @@ Bạn là Senior Business Plan Writer. TỔNG HỢP thành business plan hoàn c
     for name, content in all_sections.items():
         combined += f"\n{'='*30}\n## {name}\n{'='*30}\n{content}"
     
-    print("  🧠 Synthesizing final business plan with Gemini Pro...")
-    report = gemini_analyze(synthesis_prompt, context=combined)
-    _tracker.end_step(5)
-    _tracker.finish()
-    return report
+    log("  🧠 Synthesizing final business plan with Gemini Pro...")
+    return gemini_analyze(synthesis_prompt, context=combined)
+
+
+def _section_material(sources: list[str], all_sections: dict) -> str:
+    """Upstream material của 1 section (chỉ các nguồn nó cần, mỗi nguồn cắt SECTION_SOURCE_CHARS)."""
+    material = ""
+    for key in sources:
+        name = SYNTHESIS_SOURCES[key]
+        material += f"\n{'='*30}\n## {name}\n{'='*30}\n{all_sections.get(name, '')[:SECTION_SOURCE_CHARS]}"
+    return material
+
+
+def _write_section(info: str, title: str, spec: str, material: str) -> str:
+    """Map: viết 1 section từ upstream material của riêng nó."""
+    prompt = f"""
+Bạn là Senior Business Plan Writer. Viết DUY NHẤT 1 section của business plan:
+
+## {title}
+Nội dung bắt buộc: {spec}
+
+{info}
+
+## QUY TẮC:
+1. Bắt đầu bằng đúng heading "## {title}" — KHÔNG viết section khác, KHÔNG viết lời dẫn
+2. GIỮ NGUYÊN [Source](URL) citations và data cụ thể
+3. PRICING PHẢI NHẤT QUÁN (dùng từ context)
+4. Tables markdown nhiều nhất
+5. Viết sâu, cụ thể (400-800 words)
+6. Devil's Advocate KHÔNG ĐƯỢC LÀM MỀM — giữ nguyên sự thẳng thắn
+"""
+    # Nhiều section generate song song → không stream (Delta của các section sẽ lẫn nhau)
+    text = gemini_analyze(prompt, context=material, stream=False).strip()
+    if is_error_output(text):
+        log(f"  ⚠️ Section '{title}' lỗi — giữ placeholder, các section khác không bị ảnh hưởng")
+        return f"## {title}\n\n> ⚠️ Section này chưa generate được: {text[:200]}"
+    if not text.startswith("#"):
+        text = f"## {title}\n\n{text}"
+    log(f"  ✍️ Section xong: {title}")
+    return text
+
+
+def _synthesis_sectioned(business_idea: str, industry: str, market: str,
+                         ctx: dict, all_sections: dict, checkpoint: CheckpointStore | None = None) -> str:
+    """
+    Map-reduce: 13 sections generate song song (mỗi section 1 prompt + upstream cần thiết),
+    sau đó 1 pass nhỏ viết Executive Summary; ghép + Sources được làm bằng code.
+    Mỗi section checkpoint riêng ("synthesis:<title>", dependency = material + ctx đã đọc);
+    section lỗi giữ placeholder có error marker → không được lưu, resume chỉ viết lại nó.
+    """
+    info, project_name_note = _synthesis_header(business_idea, industry, market, ctx)
+    
+    log(f"  🧠 Sectioned synthesis: {len(SYNTHESIS_SECTIONS)} sections song song...")
+    materials = {title: _section_material(sources, all_sections) for title, _, sources in SYNTHESIS_SECTIONS}
+    stages = [
+        Stage(title, lambda title=title, spec=spec: _write_section(info, title, spec, materials[title]), ctx=ctx)
+        for title, spec, _ in SYNTHESIS_SECTIONS
+    ]
+    scoped = None
+    if checkpoint is not None:
+        scoped = ScopedCheckpoint(checkpoint, "synthesis:",
+                                  {title: {"material": material} for title, material in materials.items()})
+    results = run_stages(stages, max_workers=SYNTHESIS_MAX_WORKERS, checkpoint=scoped)
+    sections = [results[title] for title, _, _ in SYNTHESIS_SECTIONS]
+    
+    # Reduce: Executive Summary từ phần đầu mỗi section (rẻ hơn nhiều so với đọc lại toàn bộ)
+    digest = "\n\n".join(section[:SUMMARY_SECTION_CHARS] for section in sections)
+    summary_prompt = f"""
+Viết phần "## Executive Summary" cho business plan dưới đây.
+
+{info}
+
+## Yêu cầu:
+- Key Metrics TABLE (thị trường, pricing, vốn, break-even, verdict)
+- Narrative thuyết phục 200-350 words
+- Số liệu và VERDICT PHẢI KHỚP với các section
+- Bắt đầu bằng đúng heading "## Executive Summary"
+"""
+    log("  🧠 Executive Summary + ghép các section...")
+    summary = gemini_analyze(summary_prompt, context=digest).strip()
+    if not summary.startswith("#"):
+        summary = f"## Executive Summary\n\n{summary}"
+    
+    sources = _collect_sources(all_sections.values())
+    references = "\n".join(f"{i}. [{title}]({url})" for i, (title, url) in enumerate(sources, 1))
+    
+    parts = [project_name_note, summary, *sections]
+    if references:
+        parts.append(f"### Sources & References\n\n{references}")
+    return "\n\n".join(parts)
 
 
 # ═══════════════════════════════════════════════
@@ -563,17 +829,33 @@ Bạn là Senior Business Plan Writer. TỔNG HỢP thành business plan hoàn c
 
 def run_pipeline(business_idea: str, industry: str = "tech_startup",
                  market: str = "vietnam", context_file: str = None,
-                 interactive: bool = True) -> str:
+                 interactive: bool = True, context: dict | None = None,
+                 events: EventBus | None = None, resume: str | None = None,
+                 base_run: str | None = None) -> str:
     """
-    Pipeline v4: 5 steps, ~9-10 API calls.
+    Pipeline v4: 5 steps, ~9-10 API calls (sectioned synthesis: +13 section calls chạy song song).
     With questionnaire, Devil's Advocate, cross-validation, caching.
+    
+    `context`: context dict truyền thẳng (thay cho context_file).
+    `events`: event bus của run; mặc định in progress ra terminal.
+    `resume`: run ID cũ — lấy lại inputs từ manifest, bỏ qua các stage đã checkpoint.
+    `base_run`: run ID cũ để rerun với ctx mới — stage nào không đọc field ctx đã đổi
+    (và inputs không đổi) thì dùng lại output của run đó. Không truyền context/context_file
+    thì dùng lại ctx của base run.
     """
-    ind_name = INDUSTRIES.get(industry, industry)
-    mkt_name = MARKETS.get(market, market)
+    base_manifest = CheckpointStore(base_run).load_manifest() if base_run else None
     
     # Build context
-    if context_file:
-        ctx = load_context_file(context_file)
+    if base_manifest and context is None and not context_file:
+        ctx = dict(base_manifest["ctx"])
+    elif resume:
+        manifest = CheckpointStore(resume).load_manifest()
+        business_idea = manifest["business_idea"]
+        industry = manifest["industry"]
+        market = manifest["market"]
+        ctx = manifest["ctx"]
+    elif context is not None or context_file:
+        ctx = dict(context) if context is not None else load_context_file(context_file)
         ctx.setdefault("business_idea", business_idea)
         ctx.setdefault("industry", industry)
         ctx.setdefault("market", market)
@@ -606,61 +888,126 @@ def run_pipeline(business_idea: str, industry: str = "tech_startup",
         if ctx["budget_vnd"] < 100_000_000:
             ctx["is_bootstrap"] = True
     
-    mode = "🏃 BOOTSTRAP" if ctx.get("is_bootstrap") else "💼 INVESTOR"
+    # Mỗi run có event bus riêng → nhiều pipeline chạy song song không lẫn log
+    if events is None:
+        events = EventBus()
+        events.subscribe(ProgressTracker())
+    
+    with use_bus(events):
+        run_id = compute_run_id(business_idea, industry, market, ctx)
+        if resume and run_id != resume:
+            log(f"  ⚠️ Knowledge đã thay đổi từ run {resume} → checkpoint cũ không còn hợp lệ, chạy lại từ đầu")
+        base = _base_store(base_manifest, run_id, business_idea, industry, market, ctx)
+        checkpoint = CheckpointStore(run_id, base=base)
+        if resume != run_id and base_run != run_id:
+            checkpoint.clear()
+        checkpoint.save_manifest(business_idea, industry, market, ctx)
+        # Retry budget dùng chung cho mọi stage/prefetch thread của run
+        with retry_budget(RetryBudget(RETRY_BUDGET, RUN_DEADLINE_SECONDS)):
+            return _execute_pipeline(business_idea, industry, market, ctx, checkpoint)
+
+
+def _base_store(manifest: dict | None, run_id: str, business_idea: str, industry: str,
+                market: str, ctx: dict) -> CheckpointStore | None:
+    """Checkpoint của base run nếu dùng lại được cho run này (cùng idea/ngành/thị trường/knowledge)."""
+    if not manifest or manifest["run_id"] == run_id:
+        return None
+    base_id = manifest["run_id"]
+    if (manifest["business_idea"], manifest["industry"], manifest["market"]) != (business_idea, industry, market):
+        log(f"  ⚠️ Idea/ngành/thị trường khác run {base_id} → không dùng lại được, chạy từ đầu")
+        return None
+    if manifest.get("knowledge") != knowledge_version():
+        log(f"  ⚠️ Knowledge đã thay đổi từ run {base_id} → không dùng lại được, chạy từ đầu")
+        return None
+    changed = diff_context(manifest["ctx"], ctx)
+    log(f"  🔀 Rerun trên run {base_id} — ctx thay đổi: {', '.join(changed) or '(không có)'}")
+    return CheckpointStore(base_id)
+
+
+def _execute_pipeline(business_idea: str, industry: str, market: str, ctx: dict,
+                      checkpoint: CheckpointStore | None = None) -> str:
+    """Chạy DAG 5 steps trong event bus hiện tại."""
+    ind_name = INDUSTRIES.get(industry, industry)
+    mkt_name = MARKETS.get(market, market)
+    run_started = time.time()
     
-    # Reset tracker
-    global _tracker
-    _tracker = ProgressTracker()
+    mode = "🏃 BOOTSTRAP" if ctx.get("is_bootstrap") else "💼 INVESTOR"
     
-    print(f"\n{'='*60}")
-    print(f"🚀 BUSINESS DEEP RESEARCH AGENT v4")
-    print(f"{'='*60}")
-    print(f"📌 Ý tưởng:    {business_idea}")
+    log(f"\n{'='*60}")
+    log(f"🚀 BUSINESS DEEP RESEARCH AGENT v4")
+    log(f"{'='*60}")
+    log(f"📌 Ý tưởng:    {business_idea}")
     if ctx.get("project_name"):
-        print(f"📛 Tên dự án:  {ctx['project_name']}")
-    print(f"🏢 Ngành:      {ind_name}")
-    print(f"🌍 Thị trường: {mkt_name}")
-    print(f"💰 Vốn:        {ctx.get('budget_vnd', 50_000_000) / 1_000_000:.0f} triệu VND")
+        log(f"📛 Tên dự án:  {ctx['project_name']}")
+    log(f"🏢 Ngành:      {ind_name}")
+    log(f"🌍 Thị trường: {mkt_name}")
+    log(f"💰 Vốn:        {ctx.get('budget_vnd', 50_000_000) / 1_000_000:.0f} triệu VND")
     if ctx.get("pricing"):
-        print(f"💵 Pricing:    {ctx['pricing']}")
-    print(f"🎯 Mode:       {mode}")
-    print(f"🔍 Engine:     Gemini + Google Search (batched, cached, URL-resolved)")
-    print(f"{'='*60}")
-    print(f"⏱️  5 steps: Research → Strategy → Financial → Devil's Advocate → Synthesis")
-    print(f"{'='*60}\n")
-    
-    # Step 1: Research
-    research = step_research(business_idea, industry, market, ctx)
-    
-    # Step 2: Strategy + GTM
-    strategy = step_strategy_gtm(business_idea, industry, market, ctx, research)
-    
-    # Step 3: Financial + Scoring
-    financials = step_financials(business_idea, industry, market, ctx, research)
-    
-    # Step 4: Devil's Advocate
-    all_analysis = f"{research[:3000]}\n{strategy[:3000]}\n{financials[:3000]}"
-    devils = step_devils_advocate(business_idea, ctx, all_analysis)
-    
-    # Step 5: Final synthesis
-    all_sections = {
-        "Market Research & Competitors": research,
-        "Strategic Analysis & Go-to-Market": strategy,
-        "Financial Analysis & Decision": financials,
-        "Devil's Advocate (Phản Biện)": devils,
-    }
+        log(f"💵 Pricing:    {ctx['pricing']}")
+    log(f"🎯 Mode:       {mode}")
+    log(f"🔍 Engine:     Gemini + Google Search (batched, cached, URL-resolved)")
+    log(f"{'='*60}")
+    log(f"⏱️  5 steps: Research → (Strategy ∥ Financial) → Devil's Advocate → Synthesis")
+    if checkpoint is not None:
+        log(f"🔖 Run ID:     {checkpoint.run_id}  (resume: python main.py --resume {checkpoint.run_id})")
+        log(f"              Sửa context rồi: python main.py --rerun {checkpoint.run_id} --context <file>")
+    log(f"{'='*60}\n")
+    
+    # Đếm kết quả search lấy từ cache stale (RunFinished.stale_cache → metadata report)
+    summary = RunSummary()
+    get_bus().subscribe(summary)
+    
+    if SEARCH_PREFETCH:
+        _prefetch_searches(business_idea, industry, market, ctx, checkpoint)
+    
+    # Pipeline DAG: Strategy và Financial chỉ phụ thuộc Research → chạy song song
+    # Mỗi stage đọc ctx qua TrackedContext riêng → checkpoint biết stage dùng field nào
+    tracked = {name: TrackedContext(ctx) for name in ("research", "strategy", "financials", "devils", "synthesis")}
+    
+    def _devils(research, strategy, financials):
+        all_analysis = f"{research[:3000]}\n{strategy[:3000]}\n{financials[:3000]}"
+        return step_devils_advocate(business_idea, tracked["devils"], all_analysis)
+    
+    def _synthesis(research, strategy, financials, devils):
+        all_sections = {
+            "Market Research & Competitors": research,
+            "Strategic Analysis & Go-to-Market": strategy,
+            "Financial Analysis & Decision": financials,
+            "Devil's Advocate (Phản Biện)": devils,
+        }
+        return step_final_synthesis(business_idea, industry, market, tracked["synthesis"], all_sections, checkpoint)
+    
+    stages = [
+        Stage("research", lambda: step_research(business_idea, industry, market, tracked["research"]),
+              ctx=tracked["research"]),
+        Stage("strategy", lambda research: step_strategy_gtm(business_idea, industry, market,
+                                                             tracked["strategy"], research),
+              inputs=["research"], ctx=tracked["strategy"]),
+        Stage("financials", lambda research: step_financials(business_idea, industry, market,
+                                                             tracked["financials"], research),
+              inputs=["research"], ctx=tracked["financials"]),
+        Stage("devils", _devils, inputs=["research", "strategy", "financials"], ctx=tracked["devils"]),
+        Stage("synthesis", _synthesis, inputs=["research", "strategy", "financials", "devils"],
+              ctx=tracked["synthesis"]),
+    ]
     
-    final_plan = step_final_synthesis(business_idea, industry, market, ctx, all_sections)
+    try:
+        results = run_stages(stages, max_workers=PIPELINE_MAX_WORKERS, checkpoint=checkpoint)
+    finally:
+        get_bus().unsubscribe(summary)
+    final_plan = results["synthesis"]
+    emit(RunFinished(total_steps=TOTAL_STEPS, duration=time.time() - run_started,
+                     stale_cache=summary.stale_cache))
     
     # Post-processing: validate output
     issues = validate_output(final_plan)
     if issues:
-        print(f"\n{'='*60}")
-        print("⚠️ OUTPUT VALIDATION REPORT:")
+        log(f"\n{'='*60}")
+        log("⚠️ OUTPUT VALIDATION REPORT:")
         for issue in issues:
-            print(f"  {issue}")
-        print("="*60)
+            log(f"  {issue}")
+        log("="*60)
     else:
-        print("\n  ✅ Output validation passed — no issues found")
+        log("\n  ✅ Output validation passed — no issues found")
     
     return final_plan
@@ -0,0 +1,260 @@
+"""
+Pipeline Checkpoints — lưu output từng stage để resume khi run bị lỗi giữa chừng.
+- Run ID = hash(idea, industry, market, ctx, knowledge version)
+- Mỗi stage 1 file JSON trong checkpoints/<run_id>/, ghi atomic (tmp + rename)
+- Output lỗi ([Analysis Error], [Search Error]...) không được checkpoint
+- Mỗi stage ghi lại dependency: các field ctx đã đọc + digest output upstream
+  → rerun với ctx đã sửa (base run) chỉ chạy lại các stage bị ảnh hưởng
+- DAG con (VD: từng section của synthesis) checkpoint qua ScopedCheckpoint → resume chỉ chạy
+  lại section lỗi thay vì cả stage
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from config import BASE_DIR, KNOWLEDGE_DIR, TEMPLATES_DIR
+from tools.events import log
+
+CHECKPOINT_DIR = Path(os.getenv("CHECKPOINT_DIR", str(BASE_DIR / "checkpoints")))
+MANIFEST_FILE = "manifest.json"
+_UNSAFE_NAME = re.compile(r"[^\w.-]+")
+
+# Các marker mà gemini_search/gemini_analyze trả về thay vì raise
+ERROR_MARKERS = ("[Analysis Error]", "[Search Error]", "[Batch Search Error]", "[No response]")
+
+
+def is_error_output(output) -> bool:
+    return isinstance(output, str) and any(m in output for m in ERROR_MARKERS)
+
+
+def knowledge_version() -> str:
+    """Hash nội dung knowledge/ + templates/ — sửa framework là checkpoint cũ hết hiệu lực."""
+    digest = hashlib.sha256()
+    for root in (KNOWLEDGE_DIR, TEMPLATES_DIR):
+        if not root.exists():
+            continue
+        for path in sorted(root.rglob("*.md")):
+            digest.update(str(path.relative_to(BASE_DIR)).encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def compute_run_id(business_idea: str, industry: str, market: str, ctx: dict) -> str:
+    payload = json.dumps({
+        "idea": business_idea,
+        "industry": industry,
+        "market": market,
+        "ctx": ctx,
+        "knowledge": knowledge_version(),
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def fingerprint(value) -> str:
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _field_fingerprint(ctx: dict, key: str) -> str:
+    # Phân biệt "không có key" với value None; gọi dict.* để không bị TrackedContext ghi nhận
+    return fingerprint([dict.__contains__(ctx, key), dict.get(ctx, key)])
+
+
+class TrackedContext(dict):
+    """ctx dict ghi lại các key đã đọc → biết stage phụ thuộc field nào."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads: set[str] = set()
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.reads.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return super().__contains__(key)
+
+    # Duyệt toàn bộ dict → coi như phụ thuộc mọi field
+    def __iter__(self):
+        self.reads.update(super().keys())
+        return super().__iter__()
+
+    def keys(self):
+        self.reads.update(super().keys())
+        return super().keys()
+
+    def values(self):
+        self.reads.update(super().keys())
+        return super().values()
+
+    def items(self):
+        self.reads.update(super().keys())
+        return super().items()
+
+    def read_fingerprints(self) -> dict[str, str]:
+        return {key: _field_fingerprint(self, key) for key in sorted(self.reads)}
+
+
+def diff_context(old: dict, new: dict) -> list[str]:
+    """Các field ctx khác nhau giữa 2 run."""
+    keys = set(old) | set(new)
+    return sorted(k for k in keys if _field_fingerprint(old, k) != _field_fingerprint(new, k))
+
+
+def stale_reason(record: dict, ctx: dict | None, inputs: dict) -> str | None:
+    """None nếu output trong record vẫn hợp lệ với ctx + inputs hiện tại, ngược lại là lý do."""
+    deps = record.get("deps")
+    if deps is None:
+        return "checkpoint không có dependency record"
+    if ctx is not None:
+        for key, digest in deps.get("ctx", {}).items():
+            if _field_fingerprint(ctx, key) != digest:
+                return f"ctx.{key} thay đổi"
+    recorded = deps.get("inputs", {})
+    if set(recorded) != set(inputs):
+        return "danh sách inputs thay đổi"
+    for name, digest in recorded.items():
+        if fingerprint(inputs[name]) != digest:
+            return f"output '{name}' thay đổi"
+    return None
+
+
+def _write_json_atomic(path: Path, data: dict):
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class CheckpointStore:
+    """
+    Checkpoint của 1 run: manifest (inputs) + output từng stage.
+    `base`: store của run trước (ctx khác) — stage nào không bị ctx thay đổi
+    ảnh hưởng thì lấy lại output từ đó thay vì gọi API.
+    """
+    def __init__(self, run_id: str, root: Path = CHECKPOINT_DIR, base: "CheckpointStore | None" = None):
+        self.run_id = run_id
+        self.dir = root / run_id
+        self.base = base
+
+    def save_manifest(self, business_idea: str, industry: str, market: str, ctx: dict):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic(self.dir / MANIFEST_FILE, {
+            "run_id": self.run_id,
+            "business_idea": business_idea,
+            "industry": industry,
+            "market": market,
+            "ctx": ctx,
+            "knowledge": knowledge_version(),
+            "created": time.time(),
+        })
+
+    def load_manifest(self) -> dict:
+        path = self.dir / MANIFEST_FILE
+        if not path.exists():
+            raise FileNotFoundError(f"Run '{self.run_id}' không có checkpoint trong {self.dir.parent}")
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def _stage_path(self, stage: str) -> Path:
+        safe = _UNSAFE_NAME.sub("_", stage)
+        if safe != stage:  # VD: "synthesis:1. Company Description" → tên file hợp lệ, không đụng nhau
+            safe += "_" + hashlib.sha256(stage.encode()).hexdigest()[:8]
+        return self.dir / f"stage_{safe}.json"
+
+    def _record(self, stage: str) -> dict | None:
+        path = self._stage_path(stage)
+        if not path.exists():
+            return None
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            return None
+        return record if "output" in record else None
+
+    def get(self, stage: str):
+        """Output đã lưu của stage, hoặc None nếu chưa có / file hỏng."""
+        record = self._record(stage)
+        return record["output"] if record else None
+
+    def peek(self, stage: str, inputs: dict, ctx: dict | None = None):
+        """Như lookup nhưng không log / không copy từ base — đoán trước stage nào sẽ được dùng lại."""
+        record = self._record(stage)
+        if record is not None and (record.get("deps") is None or stale_reason(record, ctx, inputs) is None):
+            return record["output"]
+        record = self.base._record(stage) if self.base is not None else None
+        if record is None or stale_reason(record, ctx, inputs):
+            return None
+        return record["output"]
+
+    def lookup(self, stage: str, inputs: dict, ctx: dict | None = None):
+        """
+        Output còn hợp lệ của stage cho inputs + ctx hiện tại, hoặc None.
+        Thứ tự: checkpoint của run này → base run (copy sang run này nếu dùng được).
+        """
+        record = self._record(stage)
+        if record is not None and (record.get("deps") is None or stale_reason(record, ctx, inputs) is None):
+            # Record cũ không có deps chỉ có thể đến từ chính run này (cùng inputs + ctx)
+            log(f"  ♻️ Resume: dùng checkpoint cho stage '{stage}'")
+            return record["output"]
+        if self.base is None:
+            return None
+        record = self.base._record(stage)
+        if record is None:
+            return None
+        reason = stale_reason(record, ctx, inputs)
+        if reason:
+            log(f"  🔁 Stage '{stage}' chạy lại: {reason}")
+            return None
+        log(f"  ♻️ Stage '{stage}' không bị ảnh hưởng → dùng lại từ run {self.base.run_id}")
+        self._write(stage, record["output"], record["deps"])
+        return record["output"]
+
+    def put(self, stage: str, output, inputs: dict | None = None, ctx: dict | None = None) -> bool:
+        """Lưu output kèm dependency (field ctx đã đọc nếu ctx là TrackedContext + digest inputs)."""
+        if is_error_output(output):
+            return False
+        deps = {
+            "ctx": ctx.read_fingerprints() if isinstance(ctx, TrackedContext) else {},
+            "inputs": {name: fingerprint(value) for name, value in (inputs or {}).items()},
+        }
+        self._write(stage, output, deps)
+        return True
+
+    def _write(self, stage: str, output, deps: dict):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic(self._stage_path(stage), {
+            "stage": stage,
+            "output": output,
+            "deps": deps,
+            "created": time.time(),
+        })
+
+    def clear(self):
+        """Xoá output các stage (giữ manifest) — dùng khi chạy lại từ đầu."""
+        for path in self.dir.glob("stage_*.json"):
+            path.unlink()
+
+
+class ScopedCheckpoint:
+    """
+    Checkpoint cho DAG con chạy bên trong 1 stage: tên stage thêm `prefix`, `extra_inputs[name]`
+    (dữ liệu từ ngoài DAG con, VD: upstream material của section) tính vào dependency như inputs.
+    """
+    def __init__(self, store: CheckpointStore, prefix: str, extra_inputs: dict[str, dict] | None = None):
+        self.store = store
+        self.prefix = prefix
+        self.extra_inputs = extra_inputs or {}
+
+    def _inputs(self, name: str, inputs: dict | None) -> dict:
+        return {**self.extra_inputs.get(name, {}), **(inputs or {})}
+
+    def lookup(self, name: str, inputs: dict, ctx: dict | None = None):
+        return self.store.lookup(self.prefix + name, self._inputs(name, inputs), ctx)
+
+    def put(self, name: str, output, inputs: dict | None = None, ctx: dict | None = None) -> bool:
+        return self.store.put(self.prefix + name, output, self._inputs(name, inputs), ctx)
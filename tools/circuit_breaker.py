@@ -0,0 +1,95 @@
+"""
+Circuit Breaker — mỗi backend analysis (proxy, direct Pro, direct Flash) 1 breaker.
+- closed: gọi bình thường; `failure_threshold` lỗi liên tiếp → open
+- open: bỏ qua backend (không tốn timeout) tới hết cooldown → half_open
+- half_open: cho đúng 1 call thử; thành công → closed, lỗi → open lại với cooldown gấp đôi
+- Ghi latency các call thành công → p90 làm ngưỡng hedging
+"""
+import threading
+import time
+from collections import deque
+from tools.events import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+LATENCY_WINDOW = 50      # Số call gần nhất dùng để tính p90
+MIN_LATENCY_SAMPLES = 5  # Ít mẫu hơn → chưa đủ tin để hedge
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 300.0,
+                 max_reset_timeout: float = 3600.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = reset_timeout
+        self.opened_at = 0.0
+        self.probing = False
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Được gọi backend không. Half-open chỉ cho 1 call thử tại 1 thời điểm."""
+        with self.lock:
+            if self.state == OPEN and time.time() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self, latency: float | None = None):
+        with self.lock:
+            if self.state != CLOSED:
+                log(f"  ✅ Circuit {self.name}: hoạt động lại → closed")
+            self.state = CLOSED
+            self.failures = 0
+            self.cooldown = self.reset_timeout
+            self.probing = False
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.max_reset_timeout)
+            elif self.failures < self.failure_threshold:
+                return
+            self.state = OPEN
+            self.opened_at = time.time()
+            self.probing = False
+            log(f"  🔌 Circuit {self.name}: open — bỏ qua {self.cooldown:.0f}s")
+
+    def release(self):
+        """Call thử bị bỏ dở (VD: hedge đã thắng trước) → half-open cho thử lại lần sau."""
+        with self.lock:
+            self.probing = False
+
+    def p90(self) -> float | None:
+        """p90 latency của các call thành công gần đây (None = chưa đủ mẫu)."""
+        with self.lock:
+            if len(self.latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+    def stats(self) -> dict:
+        p90 = self.p90()
+        with self.lock:
+            return {
+                "backend": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": round(max(0.0, self.opened_at + self.cooldown - time.time()), 1)
+                if self.state == OPEN else 0,
+                "p90": round(p90, 2) if p90 is not None else None,
+            }
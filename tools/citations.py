@@ -0,0 +1,145 @@
+"""
+Citations — render inline citation [n](url) + danh sách nguồn từ grounding metadata.
+- segment.end_index của API là byte offset UTF-8 → map sang index ký tự 1 lần (bisect),
+  tiếng Việt có dấu không bị lệch vị trí
+- Build output 1 lượt (ghép các đoạn), không cắt/ghép lại cả text cho mỗi support
+- Nguồn trùng URL gộp làm 1, đánh số lại theo thứ tự xuất hiện đầu tiên trong text
+- Tách / ghép text đã render theo đoạn (cache từng câu trả lời của batch search)
+"""
+import re
+from bisect import bisect_left
+from itertools import accumulate
+
+REFERENCES_HEADER = "\n\n---\n**📚 Nguồn tham khảo:**\n"
+_REFERENCE_LINE = re.compile(r"^\[\d+\] \[(.*)\]\((\S+)\)$", re.M)
+_MARKER = re.compile(r"\[(\d+)\]\((https?://[^)\s]+)\)")
+
+
+class Source:
+    def __init__(self, number: int, uri: str, title: str):
+        self.number = number
+        self.uri = uri
+        self.title = title
+
+
+def byte_to_char_offsets(text: str):
+    """Hàm map byte offset (UTF-8) → index ký tự trong `text`; offset giữa 1 ký tự làm tròn lên."""
+    # byte_ends[i] = số byte của text[:i + 1]
+    byte_ends = list(accumulate(len(ch.encode("utf-8")) for ch in text))
+    return lambda offset: bisect_left(byte_ends, offset) + 1 if offset > 0 else 0
+
+
+def _chunk_web(chunk) -> tuple[str, str] | None:
+    web = getattr(chunk, "web", None)
+    uri = getattr(web, "uri", "") if web else ""
+    if not uri:
+        return None
+    return uri, getattr(web, "title", None) or "Source"
+
+
+def number_sources(chunks: list, cited_order: list[int]) -> tuple[dict[int, Source], list[Source]]:
+    """
+    Đánh số nguồn: chunk được trích dẫn trước có số nhỏ hơn, chunk không được trích dẫn xếp sau.
+    Chunk cùng URL dùng chung 1 số. Trả về (chunk index → Source, danh sách Source theo số).
+    """
+    by_uri: dict[str, Source] = {}
+    by_chunk: dict[int, Source] = {}
+    ordered: list[Source] = []
+    for idx in [*cited_order, *range(len(chunks))]:
+        if idx in by_chunk or not 0 <= idx < len(chunks):
+            continue
+        web = _chunk_web(chunks[idx])
+        if web is None:
+            continue
+        uri, title = web
+        source = by_uri.get(uri)
+        if source is None:
+            source = by_uri[uri] = Source(len(ordered) + 1, uri, title)
+            ordered.append(source)
+        by_chunk[idx] = source
+    return by_chunk, ordered
+
+
+def render_citations(text: str, supports: list, chunks: list) -> str:
+    """Chèn [n](url) sau mỗi segment được support + nối danh sách nguồn (đã dedupe) vào cuối."""
+    to_char = byte_to_char_offsets(text)
+
+    # (vị trí ký tự, chunk indices) theo thứ tự trong text
+    anchors = []
+    for support in supports or []:
+        segment = getattr(support, "segment", None)
+        end_index = getattr(segment, "end_index", None) if segment else None
+        indices = getattr(support, "grounding_chunk_indices", None) or []
+        if end_index is None or not indices:
+            continue
+        anchors.append((min(to_char(end_index), len(text)), list(indices)))
+    anchors.sort(key=lambda a: a[0])
+
+    by_chunk, sources = number_sources(chunks, [i for _, indices in anchors for i in indices])
+
+    # Gộp các support kết thúc cùng vị trí, bỏ số trùng
+    markers: dict[int, list[Source]] = {}
+    for position, indices in anchors:
+        cited = markers.setdefault(position, [])
+        for idx in indices:
+            source = by_chunk.get(idx)
+            if source is not None and source not in cited:
+                cited.append(source)
+
+    parts, cursor = [], 0
+    for position in sorted(markers):
+        if not markers[position]:
+            continue
+        parts.append(text[cursor:position])
+        parts.append(" " + ", ".join(f"[{s.number}]({s.uri})" for s in markers[position]))
+        cursor = position
+    parts.append(text[cursor:])
+    text = "".join(parts)
+
+    return text + format_references([(s.title, s.uri) for s in sources])
+
+
+def format_references(refs: list[tuple[str, str]]) -> str:
+    """Danh sách nguồn [(title, uri)] → block cuối text, đánh số 1..n theo thứ tự."""
+    if not refs:
+        return ""
+    return REFERENCES_HEADER + "\n".join(f"[{i}] [{title}]({uri})" for i, (title, uri) in enumerate(refs, 1)) + "\n"
+
+
+def split_references(text: str) -> tuple[str, list[tuple[str, str]]]:
+    """Tách text đã render thành (nội dung, [(title, uri)] của danh sách nguồn cuối)."""
+    body, sep, refs = text.rpartition(REFERENCES_HEADER)
+    if not sep:
+        return text, []
+    return body, _REFERENCE_LINE.findall(refs)
+
+
+def merge_sections(sections: list[str]) -> str:
+    """
+    Ghép nhiều đoạn đã render (mỗi đoạn có danh sách nguồn riêng, đánh số riêng) thành 1 text
+    với 1 danh sách nguồn chung: đánh số lại theo URL, nguồn trùng gộp làm 1.
+    """
+    numbers: dict[str, int] = {}
+    titles: dict[str, str] = {}
+
+    def _renumber(match: re.Match) -> str:
+        uri = match.group(2)
+        return f"[{numbers.setdefault(uri, len(numbers) + 1)}]({uri})"
+
+    bodies = []
+    for section in sections:
+        body, refs = split_references(section)
+        bodies.append(_MARKER.sub(_renumber, body).strip())
+        for title, uri in refs:
+            numbers.setdefault(uri, len(numbers) + 1)
+            titles.setdefault(uri, title)
+    ordered = sorted(numbers, key=numbers.get)
+    return "\n\n".join(bodies) + format_references([(titles.get(uri, "Source"), uri) for uri in ordered])
+
+
+def render_source_list(text: str, chunks: list) -> str:
+    """Không có grounding supports: chỉ nối danh sách nguồn (đã dedupe)."""
+    _, sources = number_sources(chunks, [])
+    if sources:
+        text += "\n\n**Nguồn tham khảo:**\n" + "\n".join(f"{s.number}. [{s.title}]({s.uri})" for s in sources)
+    return text
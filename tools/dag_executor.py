@@ -0,0 +1,104 @@
+"""
+DAG Executor — chạy pipeline dưới dạng đồ thị các stage có inputs rõ ràng.
+- Mỗi Stage khai báo tên + danh sách inputs (tên các stage khác)
+- Stage được khởi chạy ngay khi tất cả inputs đã có kết quả
+- Số stage chạy song song giới hạn bởi max_workers; mọi API call
+  vẫn đi qua shared rate limiter trong tools.gemini_search
+- Mỗi stage chạy trong bản copy contextvars của caller → event bus của run đi theo
+- Optional checkpoint store: stage đã có output hợp lệ thì bỏ qua, stage xong thì lưu lại
+  kèm dependency (inputs + field ctx đã đọc) → rerun chỉ chạy các stage bị ảnh hưởng
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    """
+    Một node trong DAG. `func` nhận outputs của `inputs` theo đúng thứ tự khai báo.
+    `ctx`: context mà func đọc (thường là TrackedContext) — checkpoint dùng để biết
+    stage phụ thuộc field nào.
+    """
+    def __init__(self, name: str, func, inputs: list[str] | None = None, ctx: dict | None = None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.ctx = ctx
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs})"
+
+
+def _validate(stages: list[Stage]) -> dict[str, Stage]:
+    """Check tên unique, inputs tồn tại, không có cycle."""
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        by_name[stage.name] = stage
+
+    for stage in stages:
+        missing = [i for i in stage.inputs if i not in by_name]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' has unknown inputs: {missing}")
+
+    # Kahn's algorithm — nếu không sort hết được thì có cycle
+    remaining = {s.name: set(s.inputs) for s in stages}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Cycle detected between stages: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    return by_name
+
+
+def run_stages(stages: list[Stage], max_workers: int = 4, checkpoint=None) -> dict:
+    """
+    Chạy các stage theo thứ tự phụ thuộc, song song khi có thể.
+    Trả về dict {stage_name: output}. Stage lỗi → raise exception gốc,
+    các stage chưa bắt đầu sẽ bị huỷ.
+    `checkpoint`: object có lookup(name, inputs, ctx) / put(name, output, inputs, ctx)
+    (xem tools.checkpoint). Stage chỉ được lookup khi inputs đã có → output upstream
+    chạy lại sẽ kéo theo downstream chạy lại.
+    """
+    by_name = _validate(stages)
+    pending = dict(by_name)
+    results = {}
+    running = {}  # future → stage name
+
+    pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="stage")
+    try:
+        while pending or running:
+            scheduled = True
+            while scheduled:  # stage lấy từ checkpoint có thể mở khoá stage khác ngay
+                scheduled = False
+                for name, stage in list(pending.items()):
+                    if not all(i in results for i in stage.inputs):
+                        continue
+                    del pending[name]
+                    inputs = {i: results[i] for i in stage.inputs}
+                    if checkpoint is not None:
+                        output = checkpoint.lookup(name, inputs, stage.ctx)
+                        if output is not None:
+                            results[name] = output
+                            scheduled = True
+                            continue
+                    ctx = contextvars.copy_context()
+                    running[pool.submit(ctx.run, stage.func, *inputs.values())] = name
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if checkpoint is not None:
+                    stage = by_name[name]
+                    checkpoint.put(name, results[name], {i: results[i] for i in stage.inputs}, stage.ctx)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return results
@@ -0,0 +1,234 @@
+"""
+Pipeline Events — event bus riêng cho từng run.
+- Typed events: step start/end, search, cache hit, retry, rate limit, token usage, delta, log
+- Bus của run hiện tại gắn qua contextvars → tool calls emit mà không cần truyền tham số
+- In ra terminal chỉ là 1 subscriber (ConsolePrinter); web server subscribe vào queue riêng
+"""
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Callable, ClassVar
+
+
+# === Event Types ===
+@dataclass(kw_only=True)
+class Event:
+    kind: ClassVar[str] = "event"
+    run_id: str = ""
+    ts: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return {"event": self.kind, **asdict(self)}
+
+
+@dataclass(kw_only=True)
+class StepStarted(Event):
+    kind: ClassVar[str] = "step"
+    step: int
+    total: int
+    name: str
+
+
+@dataclass(kw_only=True)
+class StepFinished(Event):
+    kind: ClassVar[str] = "step_end"
+    step: int
+    total: int
+    name: str
+    duration: float
+
+
+@dataclass(kw_only=True)
+class RunFinished(Event):
+    kind: ClassVar[str] = "run_end"
+    total_steps: int
+    duration: float
+    stale_cache: int = 0     # Số kết quả search lấy từ cache quá TTL (stale-while-revalidate)
+
+
+@dataclass(kw_only=True)
+class SearchStarted(Event):
+    kind: ClassVar[str] = "search"
+    topic: str
+    queries: int = 1
+    batched: bool = False
+
+
+@dataclass(kw_only=True)
+class CacheHit(Event):
+    kind: ClassVar[str] = "cache_hit"
+    key: str
+    matched: str = ""        # Query của entry đã trả lời (khác key khi khớp gần trùng)
+    similarity: float = 1.0
+    stale: bool = False      # Quá TTL, đang làm mới ở nền (stale-while-revalidate)
+    age: float = 0.0         # Tuổi entry (giây)
+
+
+@dataclass(kw_only=True)
+class RetryScheduled(Event):
+    kind: ClassVar[str] = "retry"
+    attempt: int
+    max_retries: int
+    delay: float
+    reason: str = "429"
+
+
+@dataclass(kw_only=True)
+class RateLimited(Event):
+    kind: ClassVar[str] = "rate_limit"
+    wait_time: float
+
+
+@dataclass(kw_only=True)
+class TokenUsage(Event):
+    kind: ClassVar[str] = "tokens"
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+@dataclass(kw_only=True)
+class Delta(Event):
+    """Chunk text đang stream từ model. `reset` = bỏ phần đã nhận (retry / fallback backend)."""
+    kind: ClassVar[str] = "delta"
+    text: str
+    step: int | None = None
+    reset: bool = False
+
+
+@dataclass(kw_only=True)
+class Log(Event):
+    kind: ClassVar[str] = "log"
+    message: str
+
+
+def format_event(event: Event) -> str | None:
+    """Render event thành 1 dòng text cho terminal/log. None = không hiển thị."""
+    if isinstance(event, Log):
+        return event.message
+    if isinstance(event, StepStarted):
+        return f"  ▶️ STEP {event.step}/{event.total}: {event.name.upper()}"
+    if isinstance(event, StepFinished):
+        mins, secs = int(event.duration // 60), int(event.duration % 60)
+        return f"  ✅ Step {event.step} hoàn thành ({mins:02d}:{secs:02d})"
+    if isinstance(event, RunFinished):
+        mins, secs = int(event.duration // 60), int(event.duration % 60)
+        stale = f" ({event.stale_cache} kết quả từ cache cũ, đang làm mới ở nền)" if event.stale_cache else ""
+        return f"  🎉 Hoàn thành {event.total_steps} steps trong {mins} phút {secs} giây{stale}"
+    if isinstance(event, SearchStarted):
+        if event.batched:
+            return f"  🔍 Batch search ({event.queries} queries in 1 call): {event.topic[:60]}..."
+        return f"  🔍 Search: {event.topic[:60]}..."
+    if isinstance(event, CacheHit):
+        if event.stale:
+            return f"  💾 Cache hit (stale {event.age / 3600:.1f}h, refreshing in background): {event.key[:50]}..."
+        if event.matched:
+            return f"  💾 Cache hit (≈{event.similarity:.2f}): {event.key[:50]}... ← {event.matched[:50]}..."
+        return f"  💾 Cache hit: {event.key[:50]}..."
+    if isinstance(event, RetryScheduled):
+        cause = "Rate limited (429)" if event.reason == "429" else f"Lỗi {event.reason}"
+        return f"  ⚠️ {cause}. Retry {event.attempt}/{event.max_retries} in {event.delay:.0f}s..."
+    if isinstance(event, RateLimited):
+        return f"  ⏳ Rate limit: waiting {event.wait_time:.1f}s..."
+    if isinstance(event, TokenUsage):
+        return f"  🧮 Tokens [{event.model}]: {event.input_tokens:,} in / {event.output_tokens:,} out"
+    return None
+
+
+class ConsolePrinter:
+    """Subscriber in event ra stdout (prefix dùng khi nhiều run chung 1 terminal)."""
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        line = format_event(event)
+        if line is not None:
+            with self.lock:
+                print(f"{self.prefix}{line}" if self.prefix else line)
+
+
+class RunSummary:
+    """Subscriber gom metadata cho report: số kết quả search lấy từ cache stale (đang làm mới ở nền)."""
+    def __init__(self):
+        self.stale_cache = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        if isinstance(event, CacheHit) and event.stale:
+            with self.lock:
+                self.stale_cache += 1
+
+
+# === Event Bus ===
+class EventBus:
+    """Bus cho 1 run. Subscriber lỗi không được làm hỏng pipeline."""
+    def __init__(self, run_id: str | None = None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self._subscribers: list[Callable[[Event], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[Event], None]):
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: Callable[[Event], None]):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def emit(self, event: Event):
+        event.run_id = self.run_id
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                pass
+
+
+_current_bus: contextvars.ContextVar[EventBus | None] = contextvars.ContextVar("bdr_event_bus", default=None)
+_current_step: contextvars.ContextVar[int | None] = contextvars.ContextVar("bdr_current_step", default=None)
+_default_bus = EventBus(run_id="default")
+_default_bus.subscribe(ConsolePrinter())
+
+
+def get_bus() -> EventBus:
+    """Bus của run hiện tại; ngoài run (VD: --dry-run) thì in thẳng ra terminal."""
+    return _current_bus.get() or _default_bus
+
+
+def emit(event: Event):
+    get_bus().emit(event)
+
+
+def log(message: str):
+    emit(Log(message=message))
+
+
+def set_current_step(step: int | None):
+    """Đánh dấu step đang chạy trong context hiện tại (mỗi stage thread có context riêng)."""
+    _current_step.set(step)
+
+
+def current_step() -> int | None:
+    return _current_step.get()
+
+
+def emit_delta(text: str = "", reset: bool = False):
+    emit(Delta(text=text, step=current_step(), reset=reset))
+
+
+@contextmanager
+def use_bus(bus: EventBus):
+    """Gắn bus vào context hiện tại (thread/task) trong suốt block."""
+    token = _current_bus.set(bus)
+    try:
+        yield bus
+    finally:
+        _current_bus.reset(token)
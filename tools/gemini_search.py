@@ -1,109 +1,196 @@
 """
 Gemini Search Tool v4 — Rate-limited, cached, with URL resolver.
 - Inline citations via groundingSupports + groundingChunks
-- Redirect URL → direct URL resolver
+- Redirect URL → direct URL resolver: song song, deadline/response, phần còn lại resolve nền
+  rồi patch cache + report (connection pool dùng chung: tools.http_pool)
 - Search cache (24h TTL)
-- Rate limiter + exponential backoff for 429
+- Limiter pool theo (API key, model), tính cả RPM + TPM
+- Retry policy (tools.retry_policy): phân loại lỗi, retryDelay, jitter, budget; 429 → cooldown bucket
+- Circuit breaker theo backend (proxy / Pro / Flash) + hedging proxy → direct theo p90 latency
+- LLM_BACKEND=live|record|replay (tools.llm_backend): chạy offline từ recording
+- Search / retry / token usage / streamed deltas → tools.events (event bus của run hiện tại)
 """
-import time
+import contextvars
+import re
 import threading
-import requests
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+import httpx
 import openai
 from google import genai
 from google.genai import types
-from config import GEMINI_API_KEY, GEMINI_MODEL_FAST, GEMINI_MODEL_PRO, PROXY_API_KEY, PROXY_BASE_URL, PROXY_MODEL
-from tools.search_cache import get_cached, set_cached
+from config import (
+    GEMINI_API_KEY, GEMINI_API_KEYS, GEMINI_MODEL_FAST, GEMINI_MODEL_PRO,
+    GEMINI_DEFAULT_RPD, GEMINI_DEFAULT_RPM, GEMINI_DEFAULT_TPM, MODEL_RATE_LIMITS,
+    PROXY_API_KEY, PROXY_BASE_URL, PROXY_MODEL, PROXY_TIMEOUT, STREAM_ANALYSIS, GEMINI_TIMEOUT,
+    RESOLVE_TIMEOUT, RESOLVE_CONCURRENCY, RESOLVE_DEADLINE, RESOLVE_BACKGROUND_TIMEOUT,
+    URL_CACHE_MAX_ENTRIES, URL_CACHE_NEGATIVE_TTL, URL_CACHE_TTL,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS, HEDGE_ANALYSIS,
+)
+from tools.search_cache import CACHE_DIR, drop_cached, get_cached, refresh_in_background, set_cached
+from tools.url_cache import UrlCache
+from tools.citations import format_references, merge_sections, render_citations, render_source_list, split_references
+from tools.llm_backend import REPLAY, backend, record_url, replayed_url, wrap_chat, wrap_genai
+from tools.events import emit, emit_delta, log, SearchStarted, TokenUsage
+from tools.retry_policy import DEFAULT_POLICY, CLIENT, CONTENT, RATE_LIMIT, classify, server_retry_delay
+from tools.circuit_breaker import CircuitBreaker
+from tools.http_pool import client_args, host_slot, sync_client
+from tools.rate_limits import LimiterPool, RateLimiter, estimate_tokens  # noqa: F401 — RateLimiter re-export
 
 
-# === Rate Limiter ===
-class RateLimiter:
-    def __init__(self, max_per_minute: int = 10):
-        self.max_per_minute = max_per_minute
-        self.tokens = max_per_minute
-        self.last_refill = time.time()
-        self.lock = threading.Lock()
-    
-    def wait(self):
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_refill
-            self.tokens = min(
-                self.max_per_minute,
-                self.tokens + elapsed * (self.max_per_minute / 60.0)
-            )
-            self.last_refill = now
-            if self.tokens < 1:
-                wait_time = (1 - self.tokens) / (self.max_per_minute / 60.0)
-                print(f"  ⏳ Rate limit: waiting {wait_time:.1f}s...")
-                time.sleep(wait_time)
-                self.tokens = 0
-                self.last_refill = time.time()
-            else:
-                self.tokens -= 1
-
-
-# Tuned: 5 RPM for search grounding (with backoff), proxy handles generate
-_rate_limiter = RateLimiter(max_per_minute=5)
+# 1 bucket / (key, model): Flash search và Pro analysis không tranh slot của nhau.
+# Proxy không đi qua pool (proxy tự quản lý quota)
+_limiters = LimiterPool(
+    num_keys=len(GEMINI_API_KEYS),
+    limits=MODEL_RATE_LIMITS,
+    default=(GEMINI_DEFAULT_RPM, GEMINI_DEFAULT_RPD, GEMINI_DEFAULT_TPM),
+)
+# Output token ước lượng cho TPM (input ước lượng từ độ dài prompt); settle() bù theo usage thật
+SEARCH_OUTPUT_TOKENS = 2048
+ANALYSIS_OUTPUT_TOKENS = 8192
+RATE_LIMIT_COOLDOWN = 10.0  # Giây cooldown bucket khi 429 mà server không gửi retryDelay
+# Circuit breaker theo backend analysis: "proxy" + từng model direct
+_breakers = {
+    name: CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+    for name in ("proxy", GEMINI_MODEL_PRO, GEMINI_MODEL_FAST)
+}
 _proxy_client = None
-_client = None
-_url_cache = {}  # In-memory cache for resolved URLs
+_clients: dict[int, "genai.Client"] = {}
+# redirect → URL thật, lưu đĩa dùng chung giữa các process (thất bại chỉ nhớ URL_CACHE_NEGATIVE_TTL)
+_url_cache = UrlCache(
+    CACHE_DIR / "urls.sqlite3",
+    max_entries=URL_CACHE_MAX_ENTRIES,
+    ttl=URL_CACHE_TTL,
+    negative_ttl=URL_CACHE_NEGATIVE_TTL,
+)
+
+# Resolve redirect URL song song; URL quá deadline tiếp tục resolve nền
+_resolve_pool = ThreadPoolExecutor(max_workers=RESOLVE_CONCURRENCY, thread_name_prefix="resolve")
+_resolving: dict[str, Future] = {}
+
+# Batch search đang bay theo cache key (single-flight)
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
 
 
-def get_client():
-    global _client
-    if _client is None:
-        _client = genai.Client(api_key=GEMINI_API_KEY)
-    return _client
+def get_client(key_index: int = 0):
+    """genai client cho key thứ `key_index` (index do _limiters.wait() trả về)."""
+    client = _clients.get(key_index)
+    if client is None:
+        api_key = GEMINI_API_KEYS[key_index] if GEMINI_API_KEYS else GEMINI_API_KEY
+        # Replay: không cần client thật (không API key, không network)
+        real = None if backend.mode == REPLAY else genai.Client(api_key=api_key, http_options=genai_http_options())
+        client = _clients[key_index] = wrap_genai(real)
+    return client
+
+
+def genai_http_options() -> "types.HttpOptions":
+    """genai client dùng cùng pool/timeout với tools.http_pool (timeout của HttpOptions tính bằng ms)."""
+    return types.HttpOptions(
+        timeout=int(GEMINI_TIMEOUT * 1000),
+        client_args=client_args(GEMINI_TIMEOUT),
+    )
 
 
 def get_proxy_client():
     """Get OpenAI-compatible client for Antigravity Manager proxy."""
     global _proxy_client
     if _proxy_client is None and PROXY_API_KEY:
-        _proxy_client = openai.OpenAI(
+        _proxy_client = wrap_chat(openai.OpenAI(
             api_key=PROXY_API_KEY,
             base_url=PROXY_BASE_URL or "http://127.0.0.1:8045/v1",
-        )
+            timeout=PROXY_TIMEOUT,
+            http_client=httpx.Client(**client_args(PROXY_TIMEOUT)),
+        ))
     return _proxy_client
 
 
-def _retry_with_backoff(func, max_retries: int = 5, base_delay: float = 30.0):
-    for attempt in range(max_retries + 1):
-        try:
-            return func()
-        except Exception as e:
-            error_str = str(e)
-            if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                if attempt < max_retries:
-                    delay = base_delay * (2 ** attempt)
-                    print(f"  ⚠️ Rate limited (429). Retry {attempt+1}/{max_retries} in {delay:.0f}s...")
-                    time.sleep(delay)
-                    continue
-            raise
+def _emit_usage(response, model: str):
+    """Emit TokenUsage từ usage metadata (genai) hoặc usage (OpenAI-compatible)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        emit(TokenUsage(
+            model=model,
+            input_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+            output_tokens=getattr(usage, 'candidates_token_count', 0) or 0,
+        ))
+        return
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        emit(TokenUsage(
+            model=model,
+            input_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            output_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+        ))
+
+
+def _usage_total(response) -> int | None:
+    """Tổng token thật (input + output) từ usage_metadata của genai, None nếu không có."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None
+    return (getattr(usage, 'prompt_token_count', 0) or 0) + (getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+def _penalize_on_rate_limit(key_index: int, model: str, error: Exception):
+    """429 → cooldown cả bucket (key, model) để mọi thread cùng lùi lại."""
+    if classify(error) == RATE_LIMIT:
+        _limiters.penalize(key_index, model, server_retry_delay(error) or RATE_LIMIT_COOLDOWN)
+
+
+def _limited_call(model: str, estimated: int, call):
+    """1 API call qua limiter pool: xếp hàng theo RPM/TPM, gọi `call(client)`, settle token thật."""
+    key_index = _limiters.wait(model, estimated)
+    try:
+        response = call(get_client(key_index))
+    except Exception as e:
+        _penalize_on_rate_limit(key_index, model, e)
+        raise
+    _limiters.settle(key_index, model, estimated, _usage_total(response))
+    return response
+
+
+def _retry_with_backoff(func):
+    return DEFAULT_POLICY.call(func)
 
 
 # === URL Resolver ===
+REDIRECT_MARKER = "vertexaisearch.cloud.google.com/grounding-api-redirect"
+REDIRECT_PATTERN = re.compile(
+    r'https://vertexaisearch\.cloud\.google\.com/grounding-api-redirect/[^\s\)]+',
+)
+RESOLVE_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+
 def resolve_url(redirect_url: str) -> str:
     """
     Resolve Google redirect URL → actual URL.
-    Dùng HTTP HEAD request với allow_redirects=True.
+    Dùng HTTP HEAD (follow redirects) qua client dùng chung của tools.http_pool → keep-alive,
+    không handshake TCP/TLS lại cho mỗi URL.
     """
-    if "vertexaisearch.cloud.google.com/grounding-api-redirect" not in redirect_url:
+    if REDIRECT_MARKER not in redirect_url:
         return redirect_url  # Already a direct URL
     
-    if redirect_url in _url_cache:
-        return _url_cache[redirect_url]
+    cached = _url_cache.get(redirect_url)
+    if cached is not None:
+        return cached
+    
+    if backend.mode == REPLAY:
+        return replayed_url(redirect_url) or redirect_url
     
     try:
-        resp = requests.head(
-            redirect_url, 
-            allow_redirects=True, 
-            timeout=5,
-            headers={"User-Agent": "Mozilla/5.0"}
-        )
-        final_url = resp.url
+        with host_slot(redirect_url):
+            resp = sync_client().head(
+                redirect_url,
+                follow_redirects=True,
+                timeout=RESOLVE_TIMEOUT,
+                headers=RESOLVE_HEADERS,
+            )
+        final_url = str(resp.url)
         if final_url and final_url != redirect_url:
             _url_cache[redirect_url] = final_url
+            record_url(redirect_url, final_url)
             return final_url
     except Exception:
         pass
@@ -113,29 +200,70 @@ def resolve_url(redirect_url: str) -> str:
     return redirect_url
 
 
-def _resolve_all_urls_in_text(text: str) -> str:
-    """Replace all redirect URLs in text with resolved URLs."""
-    import re
-    redirect_pattern = re.compile(
-        r'https://vertexaisearch\.cloud\.google\.com/grounding-api-redirect/[^\s\)]+',
-    )
-    
-    urls_to_resolve = set(redirect_pattern.findall(text))
-    if not urls_to_resolve:
-        return text
-    
-    print(f"  🔗 Resolving {len(urls_to_resolve)} redirect URLs...")
-    for url in urls_to_resolve:
-        resolved = resolve_url(url)
-        if resolved != url:
-            text = text.replace(url, resolved)
-    
-    return text
+def _submit_resolve(url: str) -> Future:
+    """Resolve `url` trên pool nền; URL đang resolve thì dùng lại future cũ."""
+    with _inflight_lock:
+        future = _resolving.get(url)
+        if future is None:
+            future = _resolving[url] = _resolve_pool.submit(resolve_url, url)
+            future.add_done_callback(lambda _: _resolving.pop(url, None))
+    return future
+
+
+def resolve_urls(urls, deadline: float = RESOLVE_DEADLINE) -> dict[str, str]:
+    """
+    Resolve song song (tối đa RESOLVE_CONCURRENCY), chờ tối đa `deadline` giây cho cả response.
+    URL chưa xong giữ nguyên link gốc và tiếp tục resolve nền (kết quả vào _url_cache).
+    """
+    pending = {u for u in urls if REDIRECT_MARKER in u and u not in _url_cache}
+    if pending:
+        log(f"  🔗 Resolving {len(pending)} redirect URLs...")
+        _, not_done = wait([_submit_resolve(u) for u in pending], timeout=deadline)
+        if not_done:
+            log(f"  ⏳ {len(not_done)} URL chưa resolve sau {deadline:.0f}s → giữ link gốc, resolve nền")
+    return {u: _url_cache.get(u, u) for u in urls}
+
+
+def patch_resolved_urls(text: str) -> str:
+    """Thay redirect URL trong text bằng URL đã resolve (chỉ đọc _url_cache, không network)."""
+    return REDIRECT_PATTERN.sub(lambda m: _url_cache.get(m.group(0), m.group(0)), text)
+
+
+def _when_resolved(text: str, on_patched, timeout: float = RESOLVE_BACKGROUND_TIMEOUT):
+    """Text còn redirect URL chưa resolve → thread nền chờ resolve xong rồi gọi on_patched(text mới)."""
+    futures = [_submit_resolve(u) for u in set(REDIRECT_PATTERN.findall(text)) if u not in _url_cache]
+    if not futures:
+        return
+
+    def _patch():
+        wait(futures, timeout=timeout)
+        patched = patch_resolved_urls(text)
+        if patched != text:
+            on_patched(patched)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(_patch,), name="resolve-patch").start()
+
+
+def patch_report_when_resolved(path: Path):
+    """Report đã ghi ra file nhưng còn link chưa resolve → ghi lại file khi resolve nền xong."""
+    def _write(patched: str):
+        path.write_text(patched, encoding="utf-8")
+        log(f"  🔗 Đã cập nhật link đã resolve trong {path.name}")
+    _when_resolved(path.read_text(encoding="utf-8"), _write)
+
+
+def _cache_result(key: str, result: str):
+    """Lưu search cache; link chưa resolve kịp thì patch lại cache entry khi resolve nền xong."""
+    set_cached(key, result)
+    _when_resolved(result, lambda patched: set_cached(key, patched))
 
 
 # === Citations ===
-def add_citations(response) -> str:
-    """Official pattern: inline [1](url) via groundingSupports + groundingChunks, with URL resolution."""
+def add_citations(response, deadline: float = RESOLVE_DEADLINE) -> str:
+    """
+    Official pattern: inline [1](url) via groundingSupports + groundingChunks, with URL resolution.
+    `deadline`: thời gian tối đa chờ resolve URL (link chưa kịp resolve được patch sau ở nền).
+    """
     text = response.text or ""
     
     candidate = response.candidates[0] if response.candidates else None
@@ -149,167 +277,267 @@ def add_citations(response) -> str:
     supports = getattr(grounding, 'grounding_supports', None)
     chunks = getattr(grounding, 'grounding_chunks', None)
     
-    # Resolve all chunk URLs first
-    if chunks:
-        for chunk in chunks:
-            web = getattr(chunk, 'web', None)
-            if web:
-                uri = getattr(web, 'uri', '')
-                if uri:
-                    resolved = resolve_url(uri)
-                    if hasattr(web, 'uri'):
-                        try:
-                            web.uri = resolved
-                        except (AttributeError, TypeError):
-                            pass
+    # Resolve chunk URLs + redirect URLs trong text 1 lượt song song (có deadline)
+    webs = [getattr(chunk, 'web', None) for chunk in (chunks or [])]
+    webs = [web for web in webs if web and getattr(web, 'uri', '')]
+    resolved = resolve_urls({web.uri for web in webs} | set(REDIRECT_PATTERN.findall(text)), deadline)
+    for web in webs:
+        try:
+            web.uri = resolved[web.uri]
+        except (AttributeError, TypeError):
+            pass
     
     if not supports or not chunks:
-        source_list = []
-        if chunks:
-            for i, chunk in enumerate(chunks):
-                web = getattr(chunk, 'web', None)
-                if web:
-                    uri = getattr(web, 'uri', '')
-                    title = getattr(web, 'title', 'Source')
-                    if uri:
-                        source_list.append(f"{i+1}. [{title}]({uri})")
-            if source_list:
-                text += "\n\n**Nguồn tham khảo:**\n" + "\n".join(source_list)
-        return text
-    
-    sorted_supports = sorted(
-        supports,
-        key=lambda s: getattr(getattr(s, 'segment', None), 'end_index', 0),
-        reverse=True
-    )
-    
-    for support in sorted_supports:
-        segment = getattr(support, 'segment', None)
-        if not segment:
-            continue
-        end_index = getattr(segment, 'end_index', None)
-        chunk_indices = getattr(support, 'grounding_chunk_indices', [])
-        if end_index is None or not chunk_indices:
-            continue
-        
-        citation_links = []
-        for idx in chunk_indices:
-            if idx < len(chunks):
-                web = getattr(chunks[idx], 'web', None)
-                if web:
-                    uri = getattr(web, 'uri', '')
-                    if uri:
-                        citation_links.append(f"[{idx + 1}]({uri})")
-        
-        if citation_links:
-            citation_string = " " + ", ".join(citation_links)
-            text = text[:end_index] + citation_string + text[end_index:]
-    
-    # Append full reference list with resolved URLs
-    source_list = []
-    seen_uris = set()
-    for i, chunk in enumerate(chunks):
-        web = getattr(chunk, 'web', None)
-        if web:
-            uri = getattr(web, 'uri', '')
-            title = getattr(web, 'title', 'Source')
-            if uri and uri not in seen_uris:
-                seen_uris.add(uri)
-                source_list.append(f"[{i+1}] [{title}]({uri})")
+        return patch_resolved_urls(render_source_list(text, chunks or []))
     
-    if source_list:
-        text += "\n\n---\n**📚 Nguồn tham khảo:**\n" + "\n".join(source_list) + "\n"
+    text = render_citations(text, supports, chunks)
     
-    # Final pass: resolve any remaining redirect URLs in text
-    text = _resolve_all_urls_in_text(text)
+    # Final pass: thay redirect URL trong text (đã resolve ở trên, không network)
+    text = patch_resolved_urls(text)
     
     return text
 
 
+# === Prompts & Configs ===
+SEARCH_SYSTEM_INSTRUCTION = (
+    "Bạn là chuyên gia nghiên cứu thị trường và phân tích kinh doanh.\n"
+    "Khi trả lời:\n"
+    "1. LUÔN cung cấp số liệu CỤ THỂ (con số, %, $, VND)\n"
+    "2. Ưu tiên dữ liệu từ: báo cáo chính thức, bài báo uy tín, nghiên cứu học thuật\n"
+    "3. Nếu data không chính xác 100%, ghi rõ 'Ước tính'\n"
+    "4. Trả lời bằng tiếng Việt, thuật ngữ chuyên môn giữ tiếng Anh\n"
+    "5. Phân tích chi tiết, đưa ra nhiều số liệu nhất có thể"
+)
+
+BATCH_SYSTEM_INSTRUCTION = (
+    "Bạn là Senior Market Research Analyst. Trả lời từng câu hỏi chi tiết.\n"
+    "Mỗi câu trả lời phải có: số liệu cụ thể, nguồn dữ liệu, phân tích.\n"
+    "Viết tiếng Việt, thuật ngữ chuyên môn giữ tiếng Anh."
+)
+
+ANALYST_SYSTEM_PROMPT = "Bạn là Senior Business Analyst. Phân tích chi tiết, có số liệu cụ thể. Viết tiếng Việt."
+
+
+def _search_query(query: str, detailed: bool) -> str:
+    return f"Phân tích chi tiết với số liệu cụ thể: {query}" if detailed else query
+
+
+def _batch_cache_key(queries: list[str], topic: str) -> str:
+    return f"BATCH:{topic}:{';'.join(queries)}"
+
+
+def _subquery_cache_key(query: str, topic: str) -> str:
+    return f"SUBQ:{topic}:{query}"
+
+
+def _batch_query(queries: list[str], topic: str) -> str:
+    combined_query = f"Nghiên cứu chi tiết về: {topic}\n\n"
+    combined_query += "Hãy trả lời TẤT CẢ các câu hỏi sau với số liệu cụ thể:\n\n"
+    for i, q in enumerate(queries, 1):
+        combined_query += f"{i}. {q}\n"
+    combined_query += "\nTrả lời từng câu hỏi chi tiết, có số liệu và dẫn chứng."
+    combined_query += "\nBắt đầu câu trả lời cho câu hỏi thứ i bằng đúng 1 dòng tiêu đề `### Câu i`, theo đúng thứ tự."
+    return combined_query
+
+
+# "### Câu 2", "**Câu 2:**", "## Câu 2 — ..." → tiêu đề câu trả lời thứ 2
+_ANSWER_HEADING = re.compile(r"^[#*\s]*Câu\s+(\d+)\b[^\n]*$", re.M | re.I)
+
+
+def _split_answers(text: str, count: int) -> list[str] | None:
+    """
+    Tách response batch (đã render citation) thành `count` câu trả lời, mỗi câu kèm danh sách
+    nguồn nó trích dẫn. None nếu model không theo đúng format tiêu đề (không tách được an toàn).
+    """
+    body, refs = split_references(text)
+    headings = list(_ANSWER_HEADING.finditer(body))
+    if [int(m.group(1)) for m in headings] != list(range(1, count + 1)):
+        return None
+    answers = []
+    for i, heading in enumerate(headings):
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(body)
+        answer = body[heading.end():end].strip()
+        answers.append(answer + format_references([ref for ref in refs if ref[1] in answer]))
+    return answers
+
+
+def _cached_answers(queries: list[str], topic: str) -> dict[str, str]:
+    """Câu trả lời có trong cache (kể cả stale). Các câu stale được làm mới chung 1 batch ở nền."""
+    answers, stale = {}, []
+    for query in queries:
+        cached = get_cached(_subquery_cache_key(query, topic), on_stale=lambda q=query: stale.append(q))
+        if cached:
+            answers[query] = cached
+    if stale:
+        _refresh_batch(stale, topic)
+    return answers
+
+
+def _refresh_batch(queries: list[str], topic: str):
+    refresh_in_background(_batch_cache_key(queries, topic),
+                          lambda: _batch_search_uncached(queries, topic, refresh=True))
+
+
+def _store_answers(queries: list[str], topic: str, text: str,
+                   refresh: bool = False) -> tuple[dict[str, str], str]:
+    """
+    Cache từng câu trả lời của response batch. Trả về (câu hỏi → câu trả lời, phần không tách được).
+    Không tách được → cache cả response theo batch key như cũ. `refresh` (làm mới câu trả lời stale):
+    bỏ luôn các câu trả lời cũ, lần tra sau rơi xuống batch key mới thay vì phục vụ stale + refresh lại.
+    """
+    answers = _split_answers(text, len(queries))
+    if answers is None:
+        _cache_result(_batch_cache_key(queries, topic), text)
+        if refresh:
+            for query in queries:
+                drop_cached(_subquery_cache_key(query, topic))
+        return {}, text
+    for query, answer in zip(queries, answers):
+        _cache_result(_subquery_cache_key(query, topic), answer)
+    return dict(zip(queries, answers)), ""
+
+
+def _assemble_batch(queries: list[str], answers: dict[str, str], unsplit: str = "") -> str:
+    """Ghép câu trả lời (từ cache + vừa search) theo thứ tự câu hỏi, 1 danh sách nguồn chung."""
+    sections = [f"### {i}. {query}\n\n{answers[query]}"
+                for i, query in enumerate(queries, 1) if query in answers]
+    if unsplit:
+        sections.append(unsplit)
+    return merge_sections(sections)
+
+
+def _grounded_config(system_instruction: str) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=system_instruction,
+        tools=[types.Tool(google_search=types.GoogleSearch())],
+        temperature=0.3,
+    )
+
+
+def _analysis_config() -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        temperature=0.2,
+        max_output_tokens=16000,
+    )
+
+
+def _analysis_prompt(prompt: str, context: str) -> str:
+    if context:
+        return f"## Context (Research Data):\n{context}\n\n## Task:\n{prompt}"
+    return prompt
+
+
+def _proxy_messages(full_prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": ANALYST_SYSTEM_PROMPT},
+        {"role": "user", "content": full_prompt},
+    ]
+
+
 # === Search Functions ===
 def gemini_search(query: str, detailed: bool = True) -> str:
     """Search with caching + rate limiting + retry + URL resolution."""
-    # Check cache first
-    cached = get_cached(query)
+    # Check cache first (quá TTL trong grace → trả kết quả cũ, làm mới ở nền)
+    cached = get_cached(query, on_stale=lambda: _refresh_search(query, detailed))
     if cached:
         return cached
     
-    client = get_client()
-    
-    system_instruction = (
-        "Bạn là chuyên gia nghiên cứu thị trường và phân tích kinh doanh.\n"
-        "Khi trả lời:\n"
-        "1. LUÔN cung cấp số liệu CỤ THỂ (con số, %, $, VND)\n"
-        "2. Ưu tiên dữ liệu từ: báo cáo chính thức, bài báo uy tín, nghiên cứu học thuật\n"
-        "3. Nếu data không chính xác 100%, ghi rõ 'Ước tính'\n"
-        "4. Trả lời bằng tiếng Việt, thuật ngữ chuyên môn giữ tiếng Anh\n"
-        "5. Phân tích chi tiết, đưa ra nhiều số liệu nhất có thể"
-    )
+    try:
+        return _search_uncached(query, detailed)
+    except Exception as e:
+        return f"[Search Error] {str(e)}"
+
+
+def _refresh_search(query: str, detailed: bool):
+    refresh_in_background(query, lambda: _search_uncached(query, detailed))
+
+
+def _search_uncached(query: str, detailed: bool) -> str:
+    search_query = _search_query(query, detailed)
     
-    search_query = f"Phân tích chi tiết với số liệu cụ thể: {query}" if detailed else query
+    estimated = estimate_tokens(search_query) + SEARCH_OUTPUT_TOKENS
     
     def _call():
-        _rate_limiter.wait()
-        return client.models.generate_content(
+        return _limited_call(GEMINI_MODEL_FAST, estimated, lambda client: client.models.generate_content(
             model=GEMINI_MODEL_FAST,
             contents=search_query,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                tools=[types.Tool(google_search=types.GoogleSearch())],
-                temperature=0.3,
-            ),
-        )
-    
+            config=_grounded_config(SEARCH_SYSTEM_INSTRUCTION),
+        ))
+    
+    emit(SearchStarted(topic=query))
+    response = _retry_with_backoff(_call)
+    _emit_usage(response, GEMINI_MODEL_FAST)
+    result = add_citations(response)
+    _cache_result(query, result)
+    return result
+
+
+def _single_flight(key: str, func):
+    """Cùng key đang có request bay → chờ lấy kết quả của nó thay vì gọi API lần nữa."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result()
     try:
-        response = _retry_with_backoff(_call)
-        result = add_citations(response)
-        set_cached(query, result)  # Save to cache
+        result = func()
+        future.set_result(result)
         return result
-    except Exception as e:
-        return f"[Search Error] {str(e)}"
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
 
 
 def gemini_batch_search(queries: list[str], topic: str = "") -> str:
-    """Batch queries into ONE API call. Cached."""
-    cache_key = f"BATCH:{topic}:{';'.join(queries)}"
-    cached = get_cached(cache_key)
-    if cached:
-        return cached
-    
-    client = get_client()
+    """
+    Batch queries into ONE API call. Mỗi câu hỏi cache riêng → chỉ search các câu chưa có
+    (run khác cùng ngành / thị trường dùng lại phần lớn câu trả lời).
+    Single-flight theo tập câu hỏi còn thiếu (prefetch và step không gọi trùng).
+    """
+    answers = _cached_answers(queries, topic)
+    missing = [q for q in queries if q not in answers]
+    if not missing:
+        return _assemble_batch(queries, answers)
+    cache_key = _batch_cache_key(missing, topic)
+    unsplit = get_cached(cache_key, on_stale=lambda: _refresh_batch(missing, topic))
+    if unsplit:
+        return _assemble_batch(queries, answers, unsplit)
+    try:
+        fetched, unsplit = _single_flight(cache_key, lambda: _batch_search_uncached(missing, topic))
+    except Exception as e:
+        return f"[Batch Search Error] {str(e)}"
+    return _assemble_batch(queries, {**answers, **fetched}, unsplit)
+
+
+def _batch_search_uncached(queries: list[str], topic: str, refresh: bool = False) -> tuple[dict[str, str], str]:
+    """`refresh`: làm mới câu trả lời stale → search lại tất cả, không đọc cache."""
+    # Request trước có thể vừa xong giữa lúc check cache và lúc nhận lượt
+    answers = {} if refresh else _cached_answers(queries, topic)
+    queries = [q for q in queries if q not in answers]
+    if not queries:
+        return answers, ""
     
-    combined_query = f"Nghiên cứu chi tiết về: {topic}\n\n"
-    combined_query += "Hãy trả lời TẤT CẢ các câu hỏi sau với số liệu cụ thể:\n\n"
-    for i, q in enumerate(queries, 1):
-        combined_query += f"{i}. {q}\n"
-    combined_query += "\nTrả lời từng câu hỏi chi tiết, có số liệu và dẫn chứng."
+    combined_query = _batch_query(queries, topic)
     
-    system_instruction = (
-        "Bạn là Senior Market Research Analyst. Trả lời từng câu hỏi chi tiết.\n"
-        "Mỗi câu trả lời phải có: số liệu cụ thể, nguồn dữ liệu, phân tích.\n"
-        "Viết tiếng Việt, thuật ngữ chuyên môn giữ tiếng Anh."
-    )
+    estimated = estimate_tokens(combined_query) + SEARCH_OUTPUT_TOKENS
     
     def _call():
-        _rate_limiter.wait()
-        return client.models.generate_content(
+        return _limited_call(GEMINI_MODEL_FAST, estimated, lambda client: client.models.generate_content(
             model=GEMINI_MODEL_FAST,
             contents=combined_query,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                tools=[types.Tool(google_search=types.GoogleSearch())],
-                temperature=0.3,
-            ),
-        )
-    
-    try:
-        print(f"  🔍 Batch search ({len(queries)} queries in 1 call): {topic[:60]}...")
-        response = _retry_with_backoff(_call)
-        result = add_citations(response)
-        set_cached(cache_key, result)
-        return result
-    except Exception as e:
-        return f"[Batch Search Error] {str(e)}"
+            config=_grounded_config(BATCH_SYSTEM_INSTRUCTION),
+        ))
+    
+    emit(SearchStarted(topic=topic, queries=len(queries), batched=True))
+    response = _retry_with_backoff(_call)
+    _emit_usage(response, GEMINI_MODEL_FAST)
+    fetched, unsplit = _store_answers(queries, topic, add_citations(response), refresh)
+    return {**answers, **fetched}, unsplit
 
 
 def gemini_deep_research(topic: str, sub_queries: list[str]) -> str:
@@ -322,9 +550,9 @@ def gemini_deep_research(topic: str, sub_queries: list[str]) -> str:
         batch_num = batch_start // BATCH_SIZE + 1
         total_batches = (len(sub_queries) + BATCH_SIZE - 1) // BATCH_SIZE
         
-        print(f"  📦 Batch [{batch_num}/{total_batches}] ({len(batch)} queries):")
+        log(f"  📦 Batch [{batch_num}/{total_batches}] ({len(batch)} queries):")
         for q in batch:
-            print(f"     • {q[:70]}...")
+            log(f"     • {q[:70]}...")
         
         result = gemini_batch_search(batch, topic=topic)
         all_results.append(result)
@@ -334,64 +562,208 @@ def gemini_deep_research(topic: str, sub_queries: list[str]) -> str:
     return combined
 
 
-def gemini_analyze(prompt: str, context: str = "") -> str:
-    """Gemini analysis — routes through Antigravity proxy if available, else direct."""
-    full_prompt = prompt
-    if context:
-        full_prompt = f"## Context (Research Data):\n{context}\n\n## Task:\n{prompt}"
-    
-    # === Try Antigravity proxy first (no rate limit!) ===
-    proxy = get_proxy_client()
-    if proxy:
+def _proxy_analyze(proxy, full_prompt: str, stream: bool, cancel: threading.Event | None = None) -> str:
+    """
+    1 lần gọi proxy (OpenAI-compatible); stream thì emit từng chunk qua event bus.
+    `cancel` set (hedge đã thắng) → đóng stream, bỏ kết quả.
+    """
+    model = PROXY_MODEL or "gemini-2.5-pro"
+    response = proxy.chat.completions.create(
+        model=model,
+        messages=_proxy_messages(full_prompt),
+        temperature=0.2,
+        max_tokens=16000,
+        stream=stream,
+    )
+    if not stream:
+        _emit_usage(response, model)
+        return response.choices[0].message.content
+    
+    emit_delta(reset=True)
+    parts = []
+    for chunk in response:
+        if cancel is not None and cancel.is_set():
+            response.close()
+            return ""
+        text = chunk.choices[0].delta.content if chunk.choices else None
+        if text:
+            parts.append(text)
+            emit_delta(text)
+    return "".join(parts)
+
+
+def _direct_analyze(model: str, full_prompt: str, stream: bool, cancel: threading.Event | None = None) -> str:
+    """
+    1 attempt gọi direct SDK (key ít tải nhất cho model); stream thì emit từng chunk.
+    Có `cancel` (hedge) → luôn gọi dạng stream (không emit) để đóng được khi bên kia thắng.
+    """
+    estimated = estimate_tokens(full_prompt) + ANALYSIS_OUTPUT_TOKENS
+    if not stream and cancel is None:
+        response = _limited_call(model, estimated, lambda client: client.models.generate_content(
+            model=model,
+            contents=full_prompt,
+            config=_analysis_config(),
+        ))
+        _emit_usage(response, model)
+        return response.text
+    
+    key_index = _limiters.wait(model, estimated)
+    if stream:
+        emit_delta(reset=True)
+    parts, last_chunk = [], None
+    try:
+        response = get_client(key_index).models.generate_content_stream(
+            model=model,
+            contents=full_prompt,
+            config=_analysis_config(),
+        )
+        for chunk in response:
+            if cancel is not None and cancel.is_set():
+                response.close()
+                break
+            last_chunk = chunk
+            if chunk.text:
+                parts.append(chunk.text)
+                if stream:
+                    emit_delta(chunk.text)
+    except Exception as e:
+        _penalize_on_rate_limit(key_index, model, e)
+        raise
+    if last_chunk is not None:
+        _emit_usage(last_chunk, model)  # usage_metadata nằm ở chunk cuối
+        _limiters.settle(key_index, model, estimated, _usage_total(last_chunk))
+    if cancel is not None and cancel.is_set():
+        return ""
+    return "".join(parts)
+
+
+def _counts_as_failure(error: Exception) -> bool:
+    """Lỗi do request (content/4xx) không nói gì về sức khoẻ backend → không tính vào breaker."""
+    return classify(error) not in (CONTENT, CLIENT)
+
+
+def _proxy_attempt(proxy, full_prompt: str, stream: bool, cancel: threading.Event | None = None) -> str:
+    """Gọi proxy + cập nhật circuit/latency của proxy. Rỗng cũng tính là lỗi."""
+    breaker = _breakers["proxy"]
+    started = time.time()
+    try:
+        result = _proxy_analyze(proxy, full_prompt, stream, cancel)
+    except Exception as e:
+        if _counts_as_failure(e) and not (cancel is not None and cancel.is_set()):
+            breaker.record_failure()
+        else:
+            breaker.release()
+        raise
+    if cancel is not None and cancel.is_set():
+        breaker.release()
+        return result
+    if not result:
+        breaker.record_failure()
+        raise RuntimeError("Proxy trả về rỗng")
+    breaker.record_success(time.time() - started)
+    return result
+
+
+def _direct_chain(full_prompt: str, stream: bool, cancel: threading.Event | None = None) -> str:
+    """
+    Direct SDK: Pro → Flash, bỏ qua model đang open circuit (Flash vẫn thử nếu chưa thử được gì —
+    call "ép" này lỗi thì không tính vào breaker, tránh nhân đôi cooldown khi chưa tới lượt thử).
+    `cancel` set (proxy đã thắng hedge) → dừng, không thử model tiếp theo.
+    """
+    last_error = None
+    for model in (GEMINI_MODEL_PRO, GEMINI_MODEL_FAST):
+        if cancel is not None and cancel.is_set():
+            return ""
+        breaker = _breakers[model]
+        forced = not breaker.allow()
+        if forced and (model != GEMINI_MODEL_FAST or last_error is not None):
+            log(f"  ⏭️ Circuit {model} đang open → bỏ qua")
+            continue
+        started = time.time()
         try:
-            print(f"  🔀 Routing via Antigravity proxy → {PROXY_MODEL or 'gemini-2.5-pro'}")
-            response = proxy.chat.completions.create(
-                model=PROXY_MODEL or "gemini-2.5-pro",
-                messages=[
-                    {"role": "system", "content": "Bạn là Senior Business Analyst. Phân tích chi tiết, có số liệu cụ thể. Viết tiếng Việt."},
-                    {"role": "user", "content": full_prompt},
-                ],
-                temperature=0.2,
-                max_tokens=16000,
+            result = _retry_with_backoff(
+                lambda: "" if cancel is not None and cancel.is_set()
+                else _direct_analyze(model, full_prompt, stream, cancel)
             )
-            result = response.choices[0].message.content
-            if result:
-                return result
         except Exception as e:
-            print(f"  ⚠️ Proxy failed: {str(e)[:80]}. Fallback to direct...")
-    
-    # === Fallback: Direct Google GenAI SDK ===
-    client = get_client()
+            if not forced:
+                if _counts_as_failure(e) and not (cancel is not None and cancel.is_set()):
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+            log(f"  ⚠️ {model} failed: {str(e)[:60]}")
+            last_error = e
+            continue
+        if cancel is not None and cancel.is_set():
+            if not forced:
+                breaker.release()
+            return result
+        breaker.record_success(time.time() - started)
+        return result if result else "[No response]"
+    raise last_error
+
+
+def _hedged_analyze(proxy, full_prompt: str, stream: bool) -> str:
+    """
+    Proxy trước; quá p90 latency của proxy mà chưa xong → bắn thêm direct (không emit delta,
+    tránh trộn), lấy kết quả nào về trước; bên thua bị đóng stream qua `cancel`.
+    Chưa đủ mẫu latency → không hedge.
+    Proxy lỗi trước khi hedge → raise để caller fallback như thường.
+    """
+    delay = _breakers["proxy"].p90()
+    if delay is None:
+        return _proxy_attempt(proxy, full_prompt, stream)
     
-    def _call_pro():
-        _rate_limiter.wait()
-        return client.models.generate_content(
-            model=GEMINI_MODEL_PRO,
-            contents=full_prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.2,
-                max_output_tokens=16000,
-            ),
-        )
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+    try:
+        # Mỗi thread 1 bản copy context → giữ event bus / step / retry budget của run
+        primary = executor.submit(contextvars.copy_context().run, _proxy_attempt, proxy, full_prompt, stream, cancel)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        
+        log(f"  🏁 Proxy chậm hơn p90 ({delay:.0f}s) → hedge sang direct")
+        hedge = executor.submit(contextvars.copy_context().run, _direct_chain, full_prompt, False, cancel)
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    cancel.set()
+                    log(f"  🏁 Hedge: {'proxy' if future is primary else 'direct'} về trước")
+                    return future.result()
+                error = future.exception()
+        return f"[Analysis Error] {str(error)}"
+    finally:
+        executor.shutdown(wait=False)
+
+
+def gemini_analyze(prompt: str, context: str = "", stream: bool | None = None) -> str:
+    """
+    Gemini analysis — routes through Antigravity proxy if available, else direct.
+    Mỗi backend 1 circuit breaker: proxy/model lỗi liên tục thì bị bỏ qua tới hết cooldown.
+    `stream`: emit Delta events trong lúc generate (mặc định theo STREAM_ANALYSIS);
+    kết quả trả về vẫn là full text.
+    """
+    full_prompt = _analysis_prompt(prompt, context)
+    stream = STREAM_ANALYSIS if stream is None else stream
     
-    def _call_flash():
-        _rate_limiter.wait()
-        return client.models.generate_content(
-            model=GEMINI_MODEL_FAST,
-            contents=full_prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.2,
-                max_output_tokens=16000,
-            ),
-        )
+    # === Try Antigravity proxy first (no rate limit!) ===
+    proxy = get_proxy_client()
+    if proxy and _breakers["proxy"].allow():
+        try:
+            log(f"  🔀 Routing via Antigravity proxy → {PROXY_MODEL or 'gemini-2.5-pro'}")
+            if HEDGE_ANALYSIS:
+                return _hedged_analyze(proxy, full_prompt, stream)
+            return _proxy_attempt(proxy, full_prompt, stream)
+        except Exception as e:
+            log(f"  ⚠️ Proxy failed: {str(e)[:80]}. Fallback to direct...")
+    elif proxy:
+        log("  ⏭️ Circuit proxy đang open → direct")
     
+    # === Fallback: Direct Google GenAI SDK (Pro → Flash) ===
     try:
-        response = _retry_with_backoff(_call_pro)
-        return response.text if response.text else "[No response]"
+        return _direct_chain(full_prompt, stream)
     except Exception as e:
-        print(f"  ⚠️ Pro failed, fallback to Flash: {str(e)[:60]}")
-        try:
-            response = _retry_with_backoff(_call_flash)
-            return response.text if response.text else "[No response]"
-        except Exception as e2:
-            return f"[Analysis Error] {str(e2)}"
+        return f"[Analysis Error] {str(e)}"
@@ -0,0 +1,53 @@
+"""
+HTTP Pool — 1 lớp HTTP dùng chung cho mọi outbound call.
+- httpx client dùng chung (keep-alive, connection pool) thay vì mỗi request 1 handshake TCP/TLS
+- Giới hạn tổng connection + giới hạn theo host (semaphore/host)
+- Timeout cấu hình qua config; genai / OpenAI client dựng từ cùng client_args()
+"""
+import atexit
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import httpx
+from config import HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_PER_HOST, HTTP_TIMEOUT
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def client_args(timeout: float = HTTP_TIMEOUT) -> dict:
+    """kwargs chung cho httpx.Client (pool + timeout) — dùng cho cả client của SDK."""
+    return {
+        "timeout": httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        ),
+    }
+
+
+def sync_client() -> httpx.Client:
+    """httpx.Client dùng chung toàn process (thread-safe)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(**client_args())
+                atexit.register(_client.close)
+    return _client
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+@contextmanager
+def host_slot(url: str):
+    """Giữ 1 trong HTTP_MAX_PER_HOST slot của host `url` trong lúc request."""
+    with _client_lock:
+        slot = _host_slots.get(_host(url))
+        if slot is None:
+            slot = _host_slots[_host(url)] = threading.BoundedSemaphore(HTTP_MAX_PER_HOST)
+    with slot:
+        yield
@@ -0,0 +1,403 @@
+"""
+LLM Backend — live / record / replay cho mọi call Gemini (genai SDK), proxy (OpenAI-compatible)
+và LiteLLM (crew path). Chọn bằng LLM_BACKEND.
+- live: gọi thẳng API như cũ
+- record: gọi API + lưu request/response (kể cả grounding metadata, stream chunks) vào RECORDINGS_DIR
+- replay: trả response đã lưu, không cần API key / network; có latency giả lập + 429 giả lập
+  (REPLAY_LATENCY, REPLAY_RATE_LIMIT_RATE); request chưa được record → lỗi hoặc response tổng hợp
+  (REPLAY_ON_MISS=synthetic) để chạy benchmark orchestration hoàn toàn offline
+Wrapper giữ nguyên interface client (client.models / proxy.chat.completions)
+→ code gọi API trong tools.gemini_search không phải đổi.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from config import (
+    LLM_BACKEND, RECORDINGS_DIR, REPLAY_LATENCY, REPLAY_ON_MISS, REPLAY_RATE_LIMIT_RATE, REPLAY_SEED,
+)
+
+LIVE = "live"
+RECORD = "record"
+REPLAY = "replay"
+
+# Ngày trong prompt (VD: header synthesis) không làm đổi key → record hôm qua vẫn replay được
+_DATE_PATTERN = re.compile(r"\b\d{1,2}/\d{1,2}/\d{4}\b")
+SYNTHETIC_SOURCES = 3
+
+
+class ReplayMissError(LookupError):
+    """Replay mode nhưng request chưa từng được record."""
+
+
+class ReplayRateLimitError(RuntimeError):
+    """429 giả lập ở replay mode — tools.retry_policy phân loại như 429 thật."""
+    code = 429
+
+    def __init__(self, delay: float):
+        super().__init__(f"429 RESOURCE_EXHAUSTED (replay). {{'retryDelay': '{delay:g}s'}}")
+
+
+def _latency_sampler(spec: str):
+    """
+    Phân phối latency giả lập (giây): "0.5" = cố định, "0.2-1.5" = đều trong khoảng,
+    "lognormal:1.5,0.5" = lognormal với median 1.5s, sigma 0.5 (đuôi dài như API thật).
+    """
+    if spec.startswith("lognormal:"):
+        median, _, sigma = spec.split(":", 1)[1].partition(",")
+        mu, sigma = math.log(float(median)), float(sigma or 0.5)
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    low, _, high = spec.partition("-")
+    low, high = float(low or 0), float(high or low or 0)
+    return lambda rng: rng.uniform(low, high)
+
+
+def _dump(obj):
+    """pydantic model (genai / openai / litellm) → dict JSON được."""
+    if obj is None or isinstance(obj, (str, int, float, bool, list, dict)):
+        return obj
+    return obj.model_dump(mode="json", exclude_none=True)
+
+
+class Backend:
+    def __init__(self, mode: str = LIVE, root: Path = RECORDINGS_DIR, latency: str = "0",
+                 rate_limit_rate: float = 0.0, on_miss: str = "error", seed: int | None = None):
+        if mode not in (LIVE, RECORD, REPLAY):
+            raise ValueError(f"LLM_BACKEND không hợp lệ: {mode} (live | record | replay)")
+        self.mode = mode
+        self.root = Path(root)
+        self.latency = _latency_sampler(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.on_miss = on_miss
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: Counter[str] = Counter()  # Số call theo kind (metric, benchmark)
+        self.injected_429 = 0
+
+    # === Storage ===
+    def key(self, kind: str, request: dict) -> str:
+        payload = json.dumps({"kind": kind, **request}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(_DATE_PATTERN.sub("<date>", payload).encode()).hexdigest()
+
+    def _path(self, kind: str, request: dict) -> Path:
+        return self.root / kind / f"{self.key(kind, request)[:24]}.json"
+
+    def save(self, kind: str, request: dict, response):
+        path = self._path(kind, request)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps({"kind": kind, "request": request, "response": response},
+                                  ensure_ascii=False, indent=1, default=str), encoding="utf-8")
+        tmp.replace(path)
+
+    def load(self, kind: str, request: dict):
+        path = self._path(kind, request)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))["response"]
+
+    # === Replay simulation ===
+    def _count(self, kind: str):
+        with self._lock:
+            self.calls[kind] += 1
+
+    def _draw(self) -> tuple[float, bool]:
+        with self._lock:
+            limited = self._random.random() < self.rate_limit_rate
+            self.injected_429 += limited
+            return self.latency(self._random), limited
+
+    def _replayed(self, kind: str, request: dict, synthetic):
+        data = self.load(kind, request)
+        if data is not None:
+            return data
+        if self.on_miss == "synthetic" and synthetic is not None:
+            return synthetic()
+        raise ReplayMissError(f"Chưa có recording cho {kind} {self.key(kind, request)[:24]} "
+                              f"(chạy LLM_BACKEND=record trước, hoặc REPLAY_ON_MISS=synthetic)")
+
+    # === Calls ===
+    def call(self, kind: str, request: dict, live, decode, synthetic=None):
+        """`live()` → response thật; response lưu dạng dict, replay trả `decode(dict)`."""
+        self._count(kind)
+        if self.mode == LIVE:
+            return live()
+        if self.mode == RECORD:
+            response = live()
+            self.save(kind, request, _dump(response))
+            return response
+        delay, limited = self._draw()
+        time.sleep(delay)
+        if limited:
+            raise ReplayRateLimitError(delay=1)
+        return decode(self._replayed(kind, request, synthetic))
+
+    def stream(self, kind: str, request: dict, live, decode, synthetic=None):
+        """Stream: record gom chunk khi chúng đi qua, replay trả lại từng chunk."""
+        self._count(kind)
+        if self.mode == LIVE:
+            return live()
+        if self.mode == RECORD:
+            return _RecordingStream(self, kind, request, live())
+        delay, limited = self._draw()
+        time.sleep(delay)
+        if limited:
+            raise ReplayRateLimitError(delay=1)
+        return _ReplayStream([decode(c) for c in self._replayed(kind, request, synthetic)])
+
+
+class _RecordingStream:
+    def __init__(self, backend: Backend, kind: str, request: dict, inner):
+        self.backend, self.kind, self.request, self.inner = backend, kind, request, inner
+
+    def __iter__(self):
+        chunks = []
+        for chunk in self.inner:
+            chunks.append(_dump(chunk))
+            yield chunk
+        self.backend.save(self.kind, self.request, chunks)
+
+    def close(self):
+        if hasattr(self.inner, "close"):
+            self.inner.close()
+
+
+class _ReplayStream:
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.chunks = []
+
+
+# ═══════════════════════════════════════════════
+# Synthetic responses (REPLAY_ON_MISS=synthetic)
+# ═══════════════════════════════════════════════
+
+def _synthetic_text(prompt: str) -> str:
+    """Text tất định theo prompt — đủ dài để các bước sau (validator, section) có dữ liệu."""
+    digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+    return (
+        f"## Kết quả tổng hợp (replay {digest})\n\n"
+        "- Quy mô thị trường ước tính: 1,200 tỷ VND, tăng trưởng 15%/năm (Ước tính)\n"
+        "- 3 đối thủ chính, thị phần 20% / 15% / 10%\n"
+        "- Giá đề xuất: 199,000 VND/tháng; CAC 150,000 VND; LTV 1,800,000 VND\n\n"
+        "Nội dung tổng hợp cho replay offline, không phải dữ liệu thật.\n"
+    )
+
+
+def synthetic_genai_response(request: dict) -> dict:
+    contents = request.get("contents")
+    prompt = contents if isinstance(contents, str) else json.dumps(contents, ensure_ascii=False, default=str)
+    text = _synthetic_text(prompt)
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "finish_reason": "STOP"}
+    if (request.get("config") or {}).get("tools"):
+        # Grounded search: kèm nguồn (URL trực tiếp → không cần resolve qua network)
+        candidate["grounding_metadata"] = {
+            "grounding_chunks": [
+                {"web": {"uri": f"https://example.com/replay/{i + 1}", "title": f"Nguồn replay {i + 1}"}}
+                for i in range(SYNTHETIC_SOURCES)
+            ],
+            "grounding_supports": [
+                {"segment": {"start_index": 0, "end_index": len(text.encode("utf-8"))},
+                 "grounding_chunk_indices": list(range(SYNTHETIC_SOURCES))},
+            ],
+        }
+    prompt_tokens = len(prompt) // 4 + 1
+    output_tokens = len(text) // 4 + 1
+    return {
+        "candidates": [candidate],
+        "usage_metadata": {
+            "prompt_token_count": prompt_tokens,
+            "candidates_token_count": output_tokens,
+            "total_token_count": prompt_tokens + output_tokens,
+        },
+    }
+
+
+def _synthetic_chat_text(request: dict) -> str:
+    return _synthetic_text(json.dumps(request.get("messages"), ensure_ascii=False, default=str))
+
+
+def synthetic_chat_completion(request: dict) -> dict:
+    text = _synthetic_chat_text(request)
+    prompt_tokens = len(json.dumps(request.get("messages"), ensure_ascii=False)) // 4 + 1
+    return {
+        "id": "replay", "object": "chat.completion", "created": 0, "model": request.get("model", ""),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4 + 1,
+                  "total_tokens": prompt_tokens + len(text) // 4 + 1},
+    }
+
+
+def synthetic_chat_chunks(request: dict) -> list[dict]:
+    text = _synthetic_chat_text(request)
+    pieces = [text[i:i + 200] for i in range(0, len(text), 200)]
+    return [
+        {"id": "replay", "object": "chat.completion.chunk", "created": 0, "model": request.get("model", ""),
+         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        for piece in pieces
+    ]
+
+
+# ═══════════════════════════════════════════════
+# Client wrappers
+# ═══════════════════════════════════════════════
+
+def _genai_request(model: str, contents, config) -> dict:
+    return {"model": model, "contents": _dump(contents), "config": _dump(config)}
+
+
+def _genai_response(data: dict):
+    from google.genai import types
+    return types.GenerateContentResponse.model_validate(data)
+
+
+class _GenaiModels:
+    def __init__(self, backend: Backend, real):
+        self.backend = backend
+        self.real = real
+
+    def generate_content(self, *, model: str, contents, config=None):
+        request = _genai_request(model, contents, config)
+        return self.backend.call(
+            "genai", request,
+            lambda: self.real.generate_content(model=model, contents=contents, config=config),
+            _genai_response, lambda: synthetic_genai_response(request),
+        )
+
+    def generate_content_stream(self, *, model: str, contents, config=None):
+        request = _genai_request(model, contents, config)
+        return self.backend.stream(
+            "genai_stream", request,
+            lambda: self.real.generate_content_stream(model=model, contents=contents, config=config),
+            _genai_response, lambda: [synthetic_genai_response(request)],
+        )
+
+
+class _Namespace:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class GenaiClient:
+    """Thay cho genai.Client: `.models` đi qua backend. `real` = None ở replay."""
+    def __init__(self, backend: Backend, real=None):
+        self.models = _GenaiModels(backend, real.models if real else None)
+
+
+def _chat_request(kwargs: dict) -> dict:
+    return {k: kwargs.get(k) for k in ("model", "messages", "temperature", "max_tokens")}
+
+
+def _chat_completion(data: dict):
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate(data)
+
+
+def _chat_chunk(data: dict):
+    from openai.types.chat import ChatCompletionChunk
+    return ChatCompletionChunk.model_validate(data)
+
+
+class _ChatCompletions:
+    def __init__(self, backend: Backend, real):
+        self.backend = backend
+        self.real = real
+
+    def create(self, **kwargs):
+        request = _chat_request(kwargs)
+        live = lambda: self.real.create(**kwargs)
+        if kwargs.get("stream"):
+            return self.backend.stream("chat_stream", request, live, _chat_chunk,
+                                       lambda: synthetic_chat_chunks(request))
+        return self.backend.call("chat", request, live, _chat_completion, lambda: synthetic_chat_completion(request))
+
+
+class ChatClient:
+    """Thay cho openai.OpenAI (proxy): `.chat.completions.create` đi qua backend."""
+    def __init__(self, backend: Backend, real=None):
+        completions = _ChatCompletions(backend, real.chat.completions if real else None)
+        self.chat = _Namespace(completions=completions)
+
+
+# ═══════════════════════════════════════════════
+# Module-level backend + URL resolve + LiteLLM (crew path)
+# ═══════════════════════════════════════════════
+
+backend = Backend(
+    mode=LLM_BACKEND,
+    root=RECORDINGS_DIR,
+    latency=REPLAY_LATENCY,
+    rate_limit_rate=REPLAY_RATE_LIMIT_RATE,
+    on_miss=REPLAY_ON_MISS,
+    seed=REPLAY_SEED,
+)
+
+
+def is_live() -> bool:
+    return backend.mode == LIVE
+
+
+def wrap_genai(real):
+    return real if backend.mode == LIVE else GenaiClient(backend, real)
+
+
+def wrap_chat(real):
+    return real if backend.mode == LIVE else ChatClient(backend, real)
+
+
+def replayed_url(redirect_url: str) -> str | None:
+    """Replay: URL thật đã record cho redirect (không network); None = chưa record."""
+    return backend.load("url", {"url": redirect_url})
+
+
+def record_url(redirect_url: str, final_url: str):
+    if backend.mode == RECORD:
+        backend.save("url", {"url": redirect_url}, final_url)
+
+
+LITELLM_PROVIDER = "bdr"
+
+
+def register_litellm_provider():
+    """
+    Crew path: đăng ký custom provider `bdr/<model>` cho LiteLLM (config.CREWAI_LLM_* trỏ vào
+    đây khi LLM_BACKEND != live). Record gọi `gemini/<model>` thật; replay dùng mock_response.
+    """
+    if backend.mode == LIVE:
+        return
+    import litellm
+    from litellm import CustomLLM
+
+    if any(p.get("provider") == LITELLM_PROVIDER for p in litellm.custom_provider_map):
+        return
+
+    class _BackendLLM(CustomLLM):
+        def completion(self, model: str, messages: list, *args, **kwargs):
+            model = model.split("/", 1)[-1]
+            request = {"model": model, "messages": messages}
+            content = backend.call(
+                "litellm", request,
+                lambda: litellm.completion(model=f"gemini/{model}", messages=messages)
+                .choices[0].message.content,
+                lambda text: text, lambda: _synthetic_chat_text(request),
+            )
+            return litellm.completion(model=f"gemini/{model}", messages=messages, mock_response=content)
+
+        async def acompletion(self, model: str, messages: list, *args, **kwargs):
+            return await asyncio.to_thread(self.completion, model, messages)
+
+    litellm.custom_provider_map = [
+        *litellm.custom_provider_map,
+        {"provider": LITELLM_PROVIDER, "custom_handler": _BackendLLM()},
+    ]
@@ -0,0 +1,65 @@
+"""
+Query Match — so khớp query gần trùng cho search cache, chạy local (không cần embedding service).
+- normalize_query: NFC + lowercase, bỏ dấu câu / khoảng trắng thừa / stop word, giữ dấu tiếng Việt
+  (bán ≠ bạn) nhưng thống nhất vị trí dấu thanh kiểu cũ / mới (hoà = hòa, thuý = thúy)
+- MinHash + LSH banding: tìm ứng viên nhanh qua index band hash trong SQLite
+- Quyết định cuối bằng Jaccard chính xác trên token + bắt buộc trùng mọi token có số
+  (năm 2025 ≠ 2026, dù phần còn lại giống hệt)
+"""
+import hashlib
+import random
+import re
+import unicodedata
+
+NUM_PERM = 64
+BANDS = 16           # 16 band × 4 hàng → query Jaccard ~0.5 trở lên thường thành ứng viên
+ROWS = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20250101)  # Seed cố định → band hash giống nhau giữa các process
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+STOP_WORDS = frozenset("""
+và của cho các những là có trong tại với về được này một theo từ đến như thì mà để bị hay hoặc
+cũng đã sẽ đang rất nào gì ở trên dưới ra vào lại nên nhưng khi the a an of for in on and or to
+with at by from vs is are about
+""".split())
+
+_TONES = "\u0300\u0301\u0303\u0309\u0323"  # huyền, sắc, ngã, hỏi, nặng (combining, sau NFD)
+# "oa", "oe", "uy" cuối âm tiết: dấu ở nguyên âm thứ 2 (kiểu mới) → nguyên âm thứ 1 (kiểu cũ).
+# "qu" + "y" không đổi (quý: "u" thuộc phụ âm đầu).
+_NEW_STYLE_TONE = re.compile(rf"(?<!q)([ou])([ae]|(?<=u)y)([{_TONES}])(?!\w)")
+_PUNCT = re.compile(r"[^\w\s]+")
+
+
+def normalize_query(query: str) -> str:
+    text = unicodedata.normalize("NFD", query.lower())
+    text = _NEW_STYLE_TONE.sub(r"\1\3\2", text)
+    text = unicodedata.normalize("NFC", text)
+    text = _PUNCT.sub(" ", text.replace("_", " "))
+    return " ".join(t for t in text.split() if t not in STOP_WORDS)
+
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def band_hashes(norm: str) -> list[str]:
+    """MinHash signature của tập token → BANDS hash (index LSH, mỗi band gồm ROWS giá trị)."""
+    hashes = [_token_hash(t) for t in set(norm.split())]
+    if not hashes:
+        return []
+    signature = [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS]
+    return [
+        hashlib.blake2b(f"{band}:{signature[band * ROWS:(band + 1) * ROWS]}".encode(), digest_size=8).hexdigest()
+        for band in range(BANDS)
+    ]
+
+
+def similarity(norm_a: str, norm_b: str) -> float:
+    """Jaccard trên tập token; 0 nếu token có số (năm, %, số tiền) khác nhau."""
+    a, b = set(norm_a.split()), set(norm_b.split())
+    if not a or not b:
+        return 0.0
+    if {t for t in a if any(c.isdigit() for c in t)} != {t for t in b if any(c.isdigit() for c in t)}:
+        return 0.0
+    return len(a & b) / len(a | b)
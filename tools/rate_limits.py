@@ -0,0 +1,284 @@
+"""
+Rate Limits — limiter pool theo (API key, model).
+- Mỗi cặp (key, model) 1 bucket riêng: RPM + TPM (token bucket) + RPD (cửa sổ 24h)
+- Permit cấp theo hàng đợi (priority, FIFO), không sleep trong lock
+- Call Pro không ăn slot của Flash search và ngược lại
+- Mỗi call chọn bucket ít tải nhất (chờ ít nhất, còn nhiều slot nhất) trong các key
+  → thêm key là throughput tăng gần tuyến tính
+"""
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from tools.events import emit, RateLimited
+
+DAY_SECONDS = 86400
+
+
+class QuotaExhaustedError(RuntimeError):
+    """Mọi key đều đã hết quota ngày (RPD) cho model này."""
+
+
+# Priority của call trong context hiện tại (nhỏ hơn = được cấp permit trước)
+_call_priority: contextvars.ContextVar[int] = contextvars.ContextVar("bdr_call_priority", default=0)
+
+
+def current_priority() -> int:
+    return _call_priority.get()
+
+
+@contextmanager
+def call_priority(priority: int):
+    """Mọi API call trong block xếp hàng với priority này (VD: prefetch = ưu tiên thấp hơn)."""
+    token = _call_priority.set(priority)
+    try:
+        yield
+    finally:
+        _call_priority.reset(token)
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng token thô (~4 ký tự/token) — đủ để giữ TPM, sai số được settle() bù lại."""
+    return len(text) // 4 + 1
+
+
+class _Waiter:
+    """1 lượt chờ permit của 1 thread."""
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+class RateLimiter:
+    """
+    Limiter RPM + TPM (token ước lượng) với hàng đợi công bằng.
+    - Permit cấp theo (priority, thứ tự đến) — chỉ waiter đầu hàng được lấy slot
+    - Không sleep trong lock: waiter đầu hàng tính thời gian chờ rồi ngủ ngoài lock,
+      waiter phía sau ngủ tới khi được đánh thức
+    - `tokens_per_minute=0` = không giới hạn TPM
+    """
+    def __init__(self, max_per_minute: int = 10, tokens_per_minute: int = 0):
+        self.max_per_minute = max_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = max_per_minute          # Slot request còn lại
+        self.token_budget = tokens_per_minute  # Token còn lại trong phút
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self._queue: list[tuple[int, int, _Waiter]] = []  # heap (priority, seq, waiter)
+        self._seq = itertools.count()
+        self.last_wait = 0.0  # Thời gian chờ của permit gần nhất (metric)
+        self.total_wait = 0.0  # Tổng thời gian chờ của mọi permit (metric, benchmark)
+        self.cooldown_until = 0.0  # Server báo 429 → không cấp permit trước thời điểm này
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.tokens = min(
+            self.max_per_minute,
+            self.tokens + elapsed * (self.max_per_minute / 60.0)
+        )
+        if self.tokens_per_minute:
+            self.token_budget = min(
+                self.tokens_per_minute,
+                self.token_budget + elapsed * (self.tokens_per_minute / 60.0)
+            )
+        self.last_refill = now
+
+    def _clamp(self, tokens: int) -> int:
+        # Request lớn hơn cả budget/phút vẫn phải chạy được khi bucket đầy
+        return min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+
+    def _delay(self, requests: float, tokens: int) -> float:
+        """Giây cần chờ để bucket đủ `requests` slot + `tokens` token (gọi trong lock)."""
+        delay = max(0.0, (requests - self.tokens) / (self.max_per_minute / 60.0),
+                    self.cooldown_until - time.time())
+        if self.tokens_per_minute and tokens:
+            delay = max(delay, (tokens - self.token_budget) / (self.tokens_per_minute / 60.0))
+        return delay
+
+    def current_wait(self, tokens: int = 0) -> float:
+        """Metric: thời gian chờ ước tính nếu 1 request mới (với `tokens`) vào hàng đợi ngay bây giờ."""
+        with self.lock:
+            self._refill(time.time())
+            queued = sum(self._clamp(w.tokens) for _, _, w in self._queue)
+            return self._delay(len(self._queue) + 1, queued + self._clamp(tokens))
+
+    def queue_length(self) -> int:
+        with self.lock:
+            return len(self._queue)
+
+    def _poll(self, waiter: _Waiter) -> float | None:
+        """0 = đã cấp permit; >0 = đầu hàng, chờ thêm chừng đó giây; None = chưa tới lượt."""
+        with self.lock:
+            if self._queue[0][2] is not waiter:
+                return None
+            self._refill(time.time())
+            tokens = self._clamp(waiter.tokens)
+            delay = self._delay(1, tokens)
+            if delay > 0:
+                return delay
+            self.tokens -= 1
+            self.token_budget -= tokens
+            heapq.heappop(self._queue)
+            if self._queue:
+                self._queue[0][2].wake()
+            return 0.0
+
+    def _enqueue(self, waiter: _Waiter, priority: int):
+        with self.lock:
+            heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+
+    def _abandon(self, waiter: _Waiter):
+        """Waiter bị huỷ (timeout/cancel) → bỏ khỏi hàng, đánh thức đầu hàng mới."""
+        with self.lock:
+            for i, (_, _, w) in enumerate(self._queue):
+                if w is waiter:
+                    self._queue.pop(i)
+                    heapq.heapify(self._queue)
+                    if i == 0 and self._queue:
+                        self._queue[0][2].wake()
+                    break
+
+    def wait(self, tokens: int = 0, priority: int | None = None):
+        """Block tới khi được cấp permit (1 request + `tokens` token ước lượng)."""
+        waiter = _Waiter(tokens)
+        self._enqueue(waiter, current_priority() if priority is None else priority)
+        started = time.time()
+        announced = False
+        granted = False
+        try:
+            while True:
+                delay = self._poll(waiter)
+                if delay == 0:
+                    granted = True
+                    break
+                if delay is not None and not announced:
+                    emit(RateLimited(wait_time=delay))
+                    announced = True
+                waiter.event.wait(timeout=delay)
+                waiter.event.clear()
+        finally:
+            if not granted:
+                self._abandon(waiter)
+        self._record_wait(time.time() - started)
+
+    def _record_wait(self, waited: float):
+        with self.lock:
+            self.last_wait = waited
+            self.total_wait += waited
+
+    def penalize(self, seconds: float):
+        """Feedback từ 429: chặn cả bucket `seconds` giây → mọi thread cùng chậm lại, không chỉ thread bị lỗi."""
+        with self.lock:
+            self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+            self.tokens = min(self.tokens, 0)  # Hết cooldown cũng không bắn cả burst ngay
+
+    def settle(self, estimated: int, actual: int):
+        """Sau call: trả lại / trừ thêm phần chênh giữa token ước lượng và usage thật."""
+        if not self.tokens_per_minute:
+            return
+        with self.lock:
+            self.token_budget = min(
+                self.tokens_per_minute,
+                self.token_budget + self._clamp(estimated) - actual
+            )
+
+
+class Bucket:
+    """Limiter của 1 cặp (key, model): RPM + TPM + RPD (0 = không giới hạn)."""
+    def __init__(self, key_index: int, model: str, rpm: int, rpd: int = 0, tpm: int = 0):
+        self.key_index = key_index
+        self.model = model
+        self.minute = RateLimiter(max_per_minute=rpm, tokens_per_minute=tpm)
+        self.rpd = rpd
+        self.day_calls: deque[float] = deque()
+
+    def _prune(self, now: float):
+        while self.day_calls and now - self.day_calls[0] >= DAY_SECONDS:
+            self.day_calls.popleft()
+
+    def day_remaining(self, now: float) -> float:
+        if not self.rpd:
+            return float("inf")
+        self._prune(now)
+        return self.rpd - len(self.day_calls)
+
+    def load(self, tokens: int = 0) -> tuple[float, float]:
+        """Key sắp xếp: (giây chờ ước tính, -tỉ lệ slot/phút còn lại) — nhỏ hơn = ít tải hơn."""
+        return self.minute.current_wait(tokens), -self.minute.tokens / self.minute.max_per_minute
+
+    def count_call(self, now: float):
+        if self.rpd:
+            self.day_calls.append(now)
+
+
+class LimiterPool:
+    """
+    Registry bucket theo (key, model). `limits`: {model: (rpm, rpd, tpm)}; model không
+    có trong limits dùng `default`. wait() chọn key ít tải nhất rồi xếp hàng ở bucket đó.
+    """
+    def __init__(self, num_keys: int, limits: dict[str, tuple[int, int, int]] | None = None,
+                 default: tuple[int, int, int] = (5, 0, 0)):
+        self.num_keys = max(1, num_keys)
+        self.limits = dict(limits or {})
+        self.default = default
+        self._buckets: dict[tuple[int, str], Bucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, key_index: int, model: str) -> Bucket:
+        bucket = self._buckets.get((key_index, model))
+        if bucket is None:
+            rpm, rpd, tpm = self.limits.get(model, self.default)
+            bucket = self._buckets[(key_index, model)] = Bucket(key_index, model, rpm, rpd, tpm)
+        return bucket
+
+    def select(self, model: str, tokens: int = 0) -> Bucket:
+        """Bucket ít tải nhất còn quota ngày cho model (tính luôn 1 call vào RPD). Raise QuotaExhaustedError."""
+        with self._lock:
+            now = time.time()
+            candidates = [self.bucket(i, model) for i in range(self.num_keys)]
+            candidates = [b for b in candidates if b.day_remaining(now) > 0]
+            if not candidates:
+                raise QuotaExhaustedError(f"Hết quota ngày cho {model} trên {self.num_keys} key")
+            chosen = min(candidates, key=lambda b: b.load(tokens))
+            chosen.count_call(now)
+            return chosen
+
+    def wait(self, model: str, tokens: int = 0) -> int:
+        """Block tới khi có permit; trả về index key dùng cho call này."""
+        bucket = self.select(model, tokens)
+        bucket.minute.wait(tokens)
+        return bucket.key_index
+
+    def penalize(self, key_index: int, model: str, seconds: float):
+        self.bucket(key_index, model).minute.penalize(seconds)
+
+    def settle(self, key_index: int, model: str, estimated: int, actual: int | None):
+        """Bù chênh lệch token ước lượng vs usage thật (None = không có usage → giữ ước lượng)."""
+        if actual is not None:
+            self.bucket(key_index, model).minute.settle(estimated, actual)
+
+    def stats(self) -> list[dict]:
+        """Trạng thái từng bucket (không lộ key) — metric cho /api/limits."""
+        now = time.time()
+        with self._lock:
+            buckets = list(self._buckets.values())
+            for b in buckets:
+                b._prune(now)
+        return [{
+            "key": f"key#{b.key_index + 1}",
+            "model": b.model,
+            "rpm": b.minute.max_per_minute,
+            "tpm": b.minute.tokens_per_minute,
+            "rpd": b.rpd,
+            "queued": b.minute.queue_length(),
+            "wait": round(b.minute.current_wait(), 2),
+            "last_wait": round(b.minute.last_wait, 2),
+            "total_wait": round(b.minute.total_wait, 2),
+            "day_used": len(b.day_calls) if b.rpd else None,
+        } for b in buckets]
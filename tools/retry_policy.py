@@ -0,0 +1,158 @@
+"""
+Retry Policy — phân loại lỗi + backoff có jitter + budget theo run.
+- Phân loại theo status code + kiểu exception (httpx / openai / genai), không dò chuỗi tuỳ ý:
+  429 (rate limit), 5xx, timeout, transport (mất kết nối), content (safety/blocked), client (4xx khác)
+- Tôn trọng retryDelay / Retry-After server trả về
+- Decorrelated jitter → các thread không retry đồng loạt
+- Retry budget + deadline theo run (contextvar, stage/prefetch thread dùng chung)
+- 429 → caller phạt bucket trong limiter pool (cooldown) → cả process chậm lại
+"""
+import contextvars
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+import httpx
+import openai
+from google.genai import errors as genai_errors
+from config import RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from tools.events import emit, log, RetryScheduled
+
+RATE_LIMIT = "429"
+SERVER = "5xx"
+TIMEOUT = "timeout"
+TRANSPORT = "transport"
+CONTENT = "content"
+CLIENT = "4xx"
+UNKNOWN = "unknown"
+
+RETRY_DELAY_PATTERN = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", re.IGNORECASE)
+CONTENT_PATTERN = re.compile(r"\b(?:SAFETY|RECITATION|PROHIBITED_CONTENT|BLOCKLIST|blocked)\b")
+# Lỗi không có status code (VD: message từ proxy / SDK bọc lại) → chỉ nhận đúng tên status gRPC
+STATUS_NAMES = {"RESOURCE_EXHAUSTED": RATE_LIMIT, "UNAVAILABLE": SERVER, "DEADLINE_EXCEEDED": TIMEOUT}
+_STATUS_NAME_PATTERN = re.compile(rf"\b({'|'.join(STATUS_NAMES)})\b")
+
+
+def _status_code(error: Exception) -> int | None:
+    # genai APIError: .code | openai APIStatusError / httpx: .status_code
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def server_retry_delay(error: Exception) -> float | None:
+    """retryDelay (google.rpc.RetryInfo) hoặc header Retry-After, tính bằng giây."""
+    match = RETRY_DELAY_PATTERN.search(f"{getattr(error, 'details', '')} {error}")
+    if match:
+        return float(match.group(1))
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value and value.replace(".", "", 1).isdigit():
+            return float(value)
+    return None
+
+
+def classify(error: Exception) -> str:
+    code = _status_code(error)
+    if isinstance(error, (TimeoutError, httpx.TimeoutException, openai.APITimeoutError)) or code in (408, 504):
+        return TIMEOUT
+    if code == 429:
+        return RATE_LIMIT
+    if isinstance(error, (ConnectionError, httpx.TransportError, openai.APIConnectionError)):
+        return TRANSPORT
+    if isinstance(error, genai_errors.ServerError) or code is not None and code >= 500:
+        return SERVER
+    text = str(error)
+    if code is None:
+        match = _STATUS_NAME_PATTERN.search(text)
+        if match:
+            return STATUS_NAMES[match.group(1)]
+    if CONTENT_PATTERN.search(text):
+        return CONTENT
+    if code is not None and 400 <= code < 500:
+        return CLIENT
+    return UNKNOWN
+
+
+class RetryBudget:
+    """Số retry tối đa + deadline cho 1 run (dùng chung giữa các thread của run)."""
+    def __init__(self, max_retries: int = 20, deadline_seconds: float = 0):
+        self.max_retries = max_retries
+        self.deadline = time.time() + deadline_seconds if deadline_seconds else None
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self, delay: float) -> str | None:
+        """Lấy 1 lượt retry sẽ ngủ `delay` giây. None = OK, ngược lại là lý do từ chối."""
+        with self.lock:
+            if self.used >= self.max_retries:
+                return f"hết retry budget ({self.max_retries} lần/run)"
+            if self.deadline is not None and time.time() + delay > self.deadline:
+                return "vượt deadline của run"
+            self.used += 1
+            return None
+
+
+_current_budget: contextvars.ContextVar[RetryBudget | None] = contextvars.ContextVar("bdr_retry_budget", default=None)
+
+
+@contextmanager
+def retry_budget(budget: RetryBudget):
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+class RetryPolicy:
+    """
+    `retry_on`: các loại lỗi được retry. Delay = max(retryDelay của server, decorrelated
+    jitter trong [base_delay, 3 × delay trước]) và không quá max_delay.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 5.0, max_delay: float = 120.0,
+                 retry_on: frozenset[str] = frozenset({RATE_LIMIT, SERVER, TIMEOUT, TRANSPORT})):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def next_delay(self, error: Exception, attempt: int, previous: float) -> float | None:
+        """Delay trước lần retry thứ `attempt` (1-based), None = không retry nữa."""
+        kind = classify(error)
+        if kind not in self.retry_on or attempt > self.max_attempts:
+            return None
+        jitter = min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+        server = server_retry_delay(error)
+        # Server bảo chờ bao lâu thì chờ ít nhất chừng đó, cộng jitter nhỏ để các thread lệch nhau
+        delay = max(jitter, server + random.uniform(0, self.base_delay)) if server is not None else jitter
+        budget = _current_budget.get()
+        refusal = budget.take(delay) if budget is not None else None
+        if refusal:
+            log(f"  ⛔ Không retry ({kind}): {refusal}")
+            return None
+        emit(RetryScheduled(attempt=attempt, max_retries=self.max_attempts, delay=delay, reason=kind))
+        return delay
+
+    def call(self, func):
+        previous = self.base_delay
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                attempt += 1
+                delay = self.next_delay(e, attempt, previous)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                previous = delay
+
+
+DEFAULT_POLICY = RetryPolicy(base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY)
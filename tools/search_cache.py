@@ -1,56 +1,427 @@
 """
-Search Cache - Lưu kết quả search vào file, TTL 24h.
+Search Cache - Lưu kết quả search vào SQLite (1 file), TTL 24h.
 Tránh tốn API khi chạy lại cùng query.
+- WAL + busy_timeout → nhiều web worker / bulk job dùng chung 1 file an toàn
+- Upsert trong 1 câu lệnh (atomic), không còn file JSON ghi dở
+- Cột có index: key, namespace, created, accessed, size (phục vụ dọn dẹp / thống kê)
+- Giới hạn tổng + theo namespace (số entry / MB), bỏ entry LRU hoặc LFU; sweep nền định kỳ
+  xoá entry hết TTL rồi evict phần vượt giới hạn (python main.py --sweep-cache để chạy tay)
+- Query gần trùng (diễn đạt lại, đổi thứ tự, khác stop word) dùng lại kết quả có sẵn nếu
+  similarity ≥ SEARCH_CACHE_SIMILARITY (tools.query_match, local); CacheHit ghi key đã trả lời.
+  Câu hỏi sinh từ template (SUBQ/BATCH, chỉ khác phân khúc) chỉ khớp sau chuẩn hoá, không khớp mờ
+- Stale-while-revalidate: quá TTL nhưng còn trong SEARCH_CACHE_STALE_GRACE → trả kết quả cũ ngay
+  (CacheHit stale=True), caller làm mới ở nền qua refresh_in_background (vẫn qua rate limiter)
+Cache JSON cũ (cache/*.json) import bằng: python main.py --migrate-cache
 """
 import hashlib
 import json
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from config import (
+    CACHE_DIR, SEARCH_CACHE_EVICTION, SEARCH_CACHE_LIMITS, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_MB,
+    SEARCH_CACHE_SIMILARITY, SEARCH_CACHE_STALE_GRACE, SEARCH_CACHE_SWEEP_SECONDS, SEARCH_CACHE_TTL,
+)
+from tools.events import emit, CacheHit
+from tools.rate_limits import call_priority
+from tools.query_match import band_hashes, normalize_query, similarity
 
-CACHE_DIR = Path(__file__).parent.parent / "cache"
-DEFAULT_TTL = 86400  # 24 hours
+DEFAULT_TTL = SEARCH_CACHE_TTL
+DB_PATH = CACHE_DIR / "search.sqlite3"
+REFRESH_PRIORITY = 100  # Làm mới nền xếp hàng rate limiter sau mọi call của run (priority nhỏ chạy trước)
 
+# Thứ tự giữ lại (entry đầu danh sách được giữ, phần vượt giới hạn ở cuối bị evict)
+_KEEP_ORDER = {
+    "lru": "accessed DESC, key",
+    "lfu": "hits DESC, accessed DESC, key",
+}
 
-def _get_cache_path(query: str) -> Path:
-    key = hashlib.sha256(query.encode()).hexdigest()[:16]
-    return CACHE_DIR / f"{key}.json"
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key       TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    query     TEXT NOT NULL,
+    result    TEXT NOT NULL,
+    created   REAL NOT NULL,
+    accessed  REAL NOT NULL,
+    size      INTEGER NOT NULL,
+    hits      INTEGER NOT NULL DEFAULT 0,
+    scope     TEXT,
+    norm      TEXT
+);
+CREATE TABLE IF NOT EXISTS bands (
+    hash TEXT NOT NULL,
+    key  TEXT NOT NULL REFERENCES entries (key) ON DELETE CASCADE,
+    PRIMARY KEY (hash, key)
+);
+CREATE INDEX IF NOT EXISTS bands_key ON bands (key);
+CREATE INDEX IF NOT EXISTS entries_namespace ON entries (namespace);
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+CREATE INDEX IF NOT EXISTS entries_scope_norm ON entries (scope, norm);
+"""
+# Cột thêm sau khi DB đã có thể tồn tại → ALTER TABLE khi mở
+_ADDED_COLUMNS = {
+    "hits": "INTEGER NOT NULL DEFAULT 0",
+    "scope": "TEXT",
+    "norm": "TEXT",
+}
+
+
+def cache_key(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+_NAMESPACE_PREFIXES = {"BATCH:": "batch", "SUBQ:": "subquery"}
+
+
+def namespace_of(query: str) -> str:
+    """Search lẻ, từng câu trả lời của batch ("SUBQ:...") và batch không tách được ("BATCH:...") tách namespace riêng."""
+    for prefix, namespace in _NAMESPACE_PREFIXES.items():
+        if query.startswith(prefix):
+            return namespace
+    return "search"
+
+
+def query_scope(query: str) -> tuple[str, str]:
+    """
+    (phạm vi phải khớp chính xác, phần so khớp gần trùng). Key "SUBQ:{topic}:{câu hỏi}" chỉ so
+    câu hỏi trong cùng topic — token của topic không làm 2 câu hỏi khác nhau trông giống nhau.
+    """
+    for prefix in _NAMESPACE_PREFIXES:
+        if query.startswith(prefix):
+            topic, _, text = query[len(prefix):].partition(":")
+            return prefix + topic, text
+    return "search", query
+
+
+class SearchCache:
+    def __init__(self, path: Path, ttl: float = DEFAULT_TTL, max_entries: int = 0, max_mb: float = 0,
+                 limits: dict[str, tuple[int, float]] | None = None, eviction: str = "lru",
+                 sweep_interval: float = 0, similarity: float = 0, stale_grace: float = 0):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_mb = max_mb
+        self.limits = limits or {}  # namespace → (max entries, max MB)
+        self.keep_order = _KEEP_ORDER.get(eviction, _KEEP_ORDER["lru"])
+        self.sweep_interval = sweep_interval
+        self.similarity = similarity  # 0 = chỉ khớp chính xác
+        self.stale_grace = stale_grace  # Giữ thêm sau TTL để trả stale (sweep chưa xoá)
+        self._local = threading.local()
+        self._sweep_lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _conn(self) -> sqlite3.Connection:
+        """1 connection / thread (sqlite3 connection không dùng chung giữa thread)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            for column, spec in _ADDED_COLUMNS.items():
+                if columns and column not in columns:
+                    conn.execute(f"ALTER TABLE entries ADD COLUMN {column} {spec}")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, query: str, ttl: float | None = None) -> str | None:
+        hit = self.lookup(query, ttl)
+        return hit[0] if hit else None
+
+    def lookup(self, query: str, ttl: float | None = None,
+               allow_stale: bool = False) -> tuple[str, str, float, float] | None:
+        """
+        Tra cache: khớp chính xác → khớp sau chuẩn hoá → gần trùng (LSH + Jaccard ≥ similarity).
+        `allow_stale`: nhận cả entry quá TTL nhưng còn trong stale_grace.
+        Trả về (result, query của entry đã trả lời, similarity, created) hoặc None.
+        """
+        self._maybe_sweep()
+        min_created = time.time() - (self.ttl if ttl is None else ttl) - (self.stale_grace if allow_stale else 0)
+        try:
+            row = self._conn().execute(
+                "SELECT key, query, result, created FROM entries WHERE key = ? AND created > ?",
+                (cache_key(query), min_created),
+            ).fetchone()
+            hit = (row, 1.0) if row else None
+            if hit is None and self.similarity:
+                hit = self._similar(query, min_created)
+        except sqlite3.Error:
+            return None
+        if hit is None:
+            return None
+        (key, matched, result, created), score = hit
+        try:
+            self._conn().execute("UPDATE entries SET accessed = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        except sqlite3.Error:
+            pass
+        return result, matched, score, created
+
+    def _similar(self, query: str, min_created: float) -> tuple[tuple, float] | None:
+        scope, text = query_scope(query)
+        norm = normalize_query(text)
+        if not norm:
+            return None
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT key, query, result, created FROM entries WHERE scope = ? AND norm = ? AND created > ? "
+            "ORDER BY created DESC LIMIT 1",
+            (scope, norm, min_created),
+        ).fetchone()
+        if row:
+            return row, 1.0
+        if scope != "search":
+            return None  # "cho SME" vs "cho spa": Jaccard cao nhưng là 2 câu hỏi khác nhau
+        hashes = band_hashes(norm)
+        rows = conn.execute(
+            "SELECT DISTINCT e.key, e.query, e.result, e.created, e.norm FROM bands b JOIN entries e ON e.key = b.key "
+            f"WHERE b.hash IN ({', '.join('?' * len(hashes))}) AND e.scope = ? AND e.created > ?",
+            (*hashes, scope, min_created),
+        ).fetchall()
+        best = max(((r[:4], similarity(norm, r[4])) for r in rows), key=lambda c: c[1], default=None)
+        return best if best and best[1] >= self.similarity else None
+
+    def put(self, query: str, result: str, namespace: str | None = None, created: float | None = None):
+        now = time.time()
+        created = now if created is None else created
+        key = cache_key(query)
+        scope, text = query_scope(query)
+        norm = normalize_query(text)
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO entries (key, namespace, query, result, created, accessed, size, scope, norm) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET namespace = excluded.namespace, query = excluded.query, "
+                "result = excluded.result, created = excluded.created, accessed = excluded.accessed, "
+                "size = excluded.size, scope = excluded.scope, norm = excluded.norm "
+                "WHERE excluded.created >= entries.created",
+                (key, namespace or namespace_of(query), query, result, created, now,
+                 len(result.encode("utf-8")), scope, norm),
+            )
+            if scope == "search":  # Chỉ search lẻ được khớp mờ → chỉ nó cần index LSH
+                conn.executemany("INSERT OR IGNORE INTO bands (hash, key) VALUES (?, ?)",
+                                 [(h, key) for h in band_hashes(norm)])
+        except sqlite3.Error as e:
+            print(f"  ⚠️ Search cache write failed: {e}")
+        self._maybe_sweep()
+
+    # --- Sweep / eviction ---
+    def _maybe_sweep(self):
+        """Đến chu kỳ thì sweep ở thread nền (không chặn lookup)."""
+        if not self.sweep_interval:
+            return
+        now = time.time()
+        with self._sweep_lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+
+        def _run():
+            try:
+                report = self.sweep()
+            except sqlite3.Error as e:
+                print(f"  ⚠️ Search cache sweep failed: {e}")
+                return
+            if report:
+                print(format_sweep_report(report))
+
+        threading.Thread(target=_run, name="search-cache-sweep", daemon=True).start()
+
+    def _delete(self, conn: sqlite3.Connection, where: str, params: tuple, reason: str, report: dict):
+        rows = conn.execute(
+            f"SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE {where} GROUP BY namespace",
+            params,
+        ).fetchall()
+        if not rows:
+            return
+        conn.execute(f"DELETE FROM entries WHERE {where}", params)
+        for namespace, count, size in rows:
+            stats = report.setdefault(reason, {}).setdefault(namespace, {"entries": 0, "bytes": 0})
+            stats["entries"] += count
+            stats["bytes"] += size
+
+    def _evict_over(self, conn: sqlite3.Connection, namespace: str | None, max_entries: int,
+                    max_mb: float, report: dict):
+        """Evict entry cuối thứ tự giữ lại (LRU/LFU) cho tới khi trong giới hạn entry + MB."""
+        over = []
+        if max_entries:
+            over.append(f"rank > {int(max_entries)}")
+        if max_mb:
+            over.append(f"total > {int(max_mb * 1024 * 1024)}")
+        if not over:
+            return
+        scope, params = ("WHERE namespace = ?", (namespace,)) if namespace else ("", ())
+        self._delete(
+            conn,
+            "key IN (SELECT key FROM ("
+            f"SELECT key, ROW_NUMBER() OVER (ORDER BY {self.keep_order}) AS rank, "
+            f"SUM(size) OVER (ORDER BY {self.keep_order} ROWS UNBOUNDED PRECEDING) AS total "
+            f"FROM entries {scope}) WHERE {' OR '.join(over)})",
+            params, "evicted", report,
+        )
 
+    def sweep(self) -> dict:
+        """
+        Xoá entry hết TTL + stale grace, rồi evict theo giới hạn từng namespace, rồi giới hạn tổng.
+        Trả về {"expired" | "evicted": {namespace: {"entries", "bytes"}}} (rỗng nếu không xoá gì).
+        """
+        report: dict = {}
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")  # 1 process sweep tại 1 thời điểm
+        try:
+            self._delete(conn, "created < ?", (time.time() - self.ttl - self.stale_grace,), "expired", report)
+            for namespace, (max_entries, max_mb) in self.limits.items():
+                self._evict_over(conn, namespace, max_entries, max_mb, report)
+            self._evict_over(conn, None, self.max_entries, self.max_mb, report)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return report
 
-def get_cached(query: str, ttl: int = DEFAULT_TTL) -> str | None:
-    """Get cached search result if still valid."""
-    CACHE_DIR.mkdir(exist_ok=True)
-    path = _get_cache_path(query)
-    
-    if not path.exists():
+    def delete(self, query: str) -> int:
+        """Xoá entry của query + entry khớp sau chuẩn hoá (lookup có thể trả về các entry đó)."""
+        scope, text = query_scope(query)
+        try:
+            return self._conn().execute(
+                "DELETE FROM entries WHERE key = ? OR (scope = ? AND norm = ?)",
+                (cache_key(query), scope, normalize_query(text)),
+            ).rowcount
+        except sqlite3.Error:
+            return 0
+
+    def clear(self) -> int:
+        return self._conn().execute("DELETE FROM entries").rowcount
+
+    def stats(self) -> dict:
+        """Số entry + dung lượng theo namespace."""
+        rows = self._conn().execute(
+            "SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY namespace"
+        ).fetchall()
+        return {namespace: {"entries": count, "bytes": size} for namespace, count, size in rows}
+
+    def migrate_json(self, directory: Path, delete: bool = False) -> tuple[int, int]:
+        """
+        Import cache JSON cũ ({query, result, timestamp} / file). Giữ nguyên timestamp gốc
+        → TTL vẫn tính như cũ. Trả về (số entry import, số file lỗi bỏ qua).
+        """
+        imported = skipped = 0
+        for path in sorted(Path(directory).glob("*.json")):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+                query, result, created = data["query"], data["result"], float(data["timestamp"])
+            except (OSError, ValueError, KeyError, TypeError):
+                skipped += 1
+                continue
+            self.put(query, result, created=created)
+            imported += 1
+            if delete:
+                path.unlink(missing_ok=True)
+        return imported, skipped
+
+
+_cache = SearchCache(
+    DB_PATH,
+    ttl=SEARCH_CACHE_TTL,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    max_mb=SEARCH_CACHE_MAX_MB,
+    limits=SEARCH_CACHE_LIMITS,
+    eviction=SEARCH_CACHE_EVICTION,
+    sweep_interval=SEARCH_CACHE_SWEEP_SECONDS,
+    similarity=SEARCH_CACHE_SIMILARITY,
+    stale_grace=SEARCH_CACHE_STALE_GRACE,
+)
+_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+def format_sweep_report(report: dict) -> str:
+    if not report:
+        return "  🧹 Search cache sweep: nothing to remove"
+    parts = []
+    for reason in ("expired", "evicted"):
+        for namespace, stats in sorted(report.get(reason, {}).items()):
+            parts.append(f"{reason} {namespace} {stats['entries']} ({stats['bytes'] / 1024 / 1024:.1f} MB)")
+    return "  🧹 Search cache sweep: " + ", ".join(parts)
+
+
+def get_cached(query: str, ttl: float | None = None, on_stale=None) -> str | None:
+    """
+    Get cached search result if still valid (kể cả query gần trùng, xem SearchCache.lookup).
+    `on_stale`: có thì nhận cả kết quả quá TTL (trong stale grace) và gọi on_stale() để caller
+    lên lịch làm mới (thường qua refresh_in_background). Không có → quá TTL là miss như cũ.
+    """
+    hit = _cache.lookup(query, ttl, allow_stale=on_stale is not None)
+    if hit is None:
         return None
-    
-    try:
-        data = json.loads(path.read_text(encoding="utf-8"))
-        if time.time() - data["timestamp"] < ttl:
-            print(f"  💾 Cache hit: {query[:50]}...")
-            return data["result"]
-    except (json.JSONDecodeError, KeyError):
-        pass
-    
-    return None
+    result, matched, score, created = hit
+    age = time.time() - created
+    stale = age >= (_cache.ttl if ttl is None else ttl)
+    emit(CacheHit(key=query, matched=matched if matched != query else "", similarity=round(score, 3),
+                  stale=stale, age=round(age)))
+    if stale:
+        on_stale()
+    return result
+
+
+def refresh_in_background(key: str, refresh):
+    """
+    Chạy refresh() ở thread nền (1 lần / key cùng lúc). Thread không mang context của run →
+    không emit vào event bus / không tốn retry budget của run; API call xếp hàng REFRESH_PRIORITY.
+    refresh() tự ghi kết quả mới vào cache.
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def _run():
+        try:
+            with call_priority(REFRESH_PRIORITY):
+                refresh()
+        except Exception as e:
+            print(f"  ⚠️ Background cache refresh failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _refresh_pool.submit(_run)
 
 
 def set_cached(query: str, result: str):
     """Save search result to cache."""
-    CACHE_DIR.mkdir(exist_ok=True)
-    path = _get_cache_path(query)
-    
-    data = {
-        "query": query,
-        "result": result,
-        "timestamp": time.time(),
-    }
-    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    _cache.put(query, result)
+
+
+def drop_cached(query: str):
+    """Bỏ kết quả đã cache của query (VD: kết quả stale đã được thay bằng key khác)."""
+    _cache.delete(query)
 
 
 def clear_cache():
     """Clear all cached results."""
-    if CACHE_DIR.exists():
-        for f in CACHE_DIR.glob("*.json"):
-            f.unlink()
-        print("  🗑️ Cache cleared")
+    removed = _cache.clear()
+    print(f"  🗑️ Cache cleared ({removed} entries)")
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
+
+
+def sweep_cache() -> dict:
+    """Chạy sweep ngay (TTL + giới hạn), trả về report entry đã xoá."""
+    return _cache.sweep()
+
+
+def migrate_json_cache(directory: Path = CACHE_DIR, delete: bool = False) -> tuple[int, int]:
+    """Import cache/*.json (định dạng cũ, 1 file / key) vào SQLite."""
+    return _cache.migrate_json(directory, delete=delete)
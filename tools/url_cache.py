@@ -0,0 +1,146 @@
+"""
+URL Cache — redirect URL → URL thật, lưu SQLite dùng chung giữa các process.
+- CLI, web worker, bulk job cùng đọc/ghi 1 file (WAL + busy_timeout → an toàn đa process)
+- TTL riêng cho kết quả thành công và thất bại (thất bại chỉ nhớ ngắn rồi thử lại)
+- Giới hạn số entry, bỏ entry ít dùng nhất (LRU theo thời điểm đọc gần nhất)
+- Lớp nhớ trong process (LRU nhỏ) để không hit SQLite cho mỗi lần tra
+Interface kiểu dict (`in`, `get`, `[]`) để thay thế dict cũ trong tools.gemini_search.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+MEMORY_ENTRIES = 2048
+TOUCH_INTERVAL = 3600  # Chỉ ghi lại thời điểm đọc nếu đã cũ hơn chừng này (giảm ghi đĩa)
+PRUNE_EVERY = 200      # Số lần ghi giữa 2 lần dọn entry hết hạn / vượt giới hạn
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    redirect TEXT PRIMARY KEY,
+    final    TEXT NOT NULL,
+    ok       INTEGER NOT NULL,
+    created  REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_accessed ON urls (accessed);
+"""
+
+
+class UrlCache:
+    def __init__(self, path: Path, max_entries: int = 50_000, ttl: float = 30 * 86400,
+                 negative_ttl: float = 3600):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._local = threading.local()
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()  # url → (final, hết hạn lúc)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        """1 connection / thread (sqlite3 connection không dùng chung giữa thread)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, url: str, final: str, expires: float):
+        with self._lock:
+            self._memory[url] = (final, expires)
+            self._memory.move_to_end(url)
+            while len(self._memory) > MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
+
+    def get(self, url: str, default=None):
+        now = time.time()
+        with self._lock:
+            hit = self._memory.get(url)
+        if hit is not None and hit[1] > now:
+            return hit[0]
+        try:
+            row = self._conn().execute(
+                "SELECT final, ok, created, accessed FROM urls WHERE redirect = ?", (url,)
+            ).fetchone()
+        except sqlite3.Error:
+            return default
+        if row is None:
+            return default
+        final, ok, created, accessed = row
+        expires = created + (self.ttl if ok else self.negative_ttl)
+        if expires <= now:
+            return default
+        if now - accessed > TOUCH_INTERVAL:
+            try:
+                self._conn().execute("UPDATE urls SET accessed = ? WHERE redirect = ?", (now, url))
+            except sqlite3.Error:
+                pass
+        self._remember(url, final, expires)
+        return final
+
+    def put(self, url: str, final: str):
+        """Lưu kết quả resolve; `final == url` = resolve thất bại (negative TTL)."""
+        now = time.time()
+        ok = final != url
+        if not ok:
+            with self._lock:
+                hit = self._memory.get(url)
+            if hit is not None and hit[0] != url and hit[1] > now:
+                return  # Đã có kết quả thành công còn hạn
+        self._remember(url, final, now + (self.ttl if ok else self.negative_ttl))
+        try:
+            # Process khác đã resolve thành công thì thất bại của mình không ghi đè
+            self._conn().execute(
+                "INSERT INTO urls (redirect, final, ok, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(redirect) DO UPDATE SET final = excluded.final, ok = excluded.ok, "
+                "created = excluded.created, accessed = excluded.accessed "
+                "WHERE excluded.ok = 1 OR urls.ok = 0",
+                (url, final, int(ok), now, now),
+            )
+        except sqlite3.Error:
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> int:
+        """Xoá entry hết hạn + entry ít dùng nhất vượt max_entries. Trả về số entry đã xoá."""
+        now = time.time()
+        conn = self._conn()
+        try:
+            removed = conn.execute(
+                "DELETE FROM urls WHERE (ok = 1 AND created < ?) OR (ok = 0 AND created < ?)",
+                (now - self.ttl, now - self.negative_ttl),
+            ).rowcount
+            removed += conn.execute(
+                "DELETE FROM urls WHERE redirect IN (SELECT redirect FROM urls ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        except sqlite3.Error:
+            return 0
+        return removed
+
+    def __contains__(self, url: str) -> bool:
+        return self.get(url) is not None
+
+    def __getitem__(self, url: str) -> str:
+        final = self.get(url)
+        if final is None:
+            raise KeyError(url)
+        return final
+
+    def __setitem__(self, url: str, final: str):
+        self.put(url, final)
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM urls").fetchone()[0]
@@ -2,9 +2,11 @@
 Utility functions: load knowledge files, search tools, output formatting.
 """
 import os
+import re
+from datetime import datetime
 from pathlib import Path
 from typing import Optional
-from config import FRAMEWORKS_DIR, INDUSTRIES_DIR, MARKETS_DIR
+from config import FRAMEWORKS_DIR, INDUSTRIES_DIR, MARKETS_DIR, INDUSTRY_FRAMEWORKS
 
 
 def load_framework(name: str) -> str:
@@ -51,6 +53,43 @@ def save_output(content: str, filename: str, output_dir: Path) -> Path:
     return filepath
 
 
+def format_report_header(idea: str, industry: str, market: str, stale_cache: int = 0) -> str:
+    """
+    YAML front matter cho file business plan xuất từ CLI.
+    `stale_cache`: số kết quả search lấy từ cache quá TTL (stale-while-revalidate, xem RunSummary).
+    """
+    return f"""---
+title: Business Plan - {idea}
+industry: {industry}
+market: {market}
+generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+engine: Gemini API + Google Search Grounding (v4)
+frameworks: {", ".join(INDUSTRY_FRAMEWORKS.get(industry, []))}
+version: v4
+{stale_cache_metadata(stale_cache)}---
+
+"""
+
+
+def stale_cache_metadata(stale_cache: int) -> str:
+    """Dòng front matter đánh dấu report dùng dữ liệu search cũ ("" nếu không có)."""
+    return f"stale_cache: {stale_cache}  # kết quả search quá TTL, đã làm mới ở nền cho lần chạy sau\n" if stale_cache else ""
+
+
+VERDICT_PATTERN = re.compile(
+    r"VERDICT[^A-Za-z\n]{0,20}(NO[- ]GO|CONDITIONAL GO|GO|INVEST|CONDITIONAL|PASS)",
+    re.IGNORECASE,
+)
+
+
+def extract_verdict(plan: str) -> str:
+    """Verdict cuối cùng trong plan (GO / NO-GO / INVEST / PASS...), "" nếu không tìm thấy."""
+    matches = VERDICT_PATTERN.findall(plan or "")
+    if not matches:
+        return ""
+    return matches[-1].upper().replace("NO GO", "NO-GO")
+
+
 def format_investment_verdict(score: float) -> str:
     """Format investment decision based on score."""
     if score >= 7.0:
@@ -129,6 +129,95 @@ export default function ChatPage() {
 
   const startNewChat = () => { setMessages([]); setActiveConv(null); setCompareMode(false); setCompareResults([]); inputRef.current?.focus(); };
 
+  /* === SSE: apply pipeline event to last assistant message === */
+  const applyRunEvent = (data) => {
+    if (data.event === 'job' && data.job_id) {
+      localStorage.setItem('dr_active_job', data.job_id);
+    }
+    if (data.event === 'done') localStorage.removeItem('dr_active_job');
+    setMessages(prev => {
+      const upd = [...prev];
+      const last = { ...upd[upd.length - 1] };
+      switch (data.event) {
+        case 'job':
+          last.jobId = data.job_id; last.jobStatus = data.status;
+          if (data.status === 'queued' && data.position > 0) {
+            last.logs = [...(last.logs || []), { type: 'log', text: `⏳ Đang chờ trong hàng đợi (vị trí ${data.position})` }];
+          }
+          break;
+        case 'step':
+          last.step = data.step; last.totalSteps = data.total; last.stepName = data.name;
+          last.logs = [...(last.logs || []), { type: 'step', text: `Step ${data.step}/${data.total}: ${data.name}` }];
+          break;
+        case 'log':
+          last.logs = [...(last.logs || []), { type: 'log', text: data.message }];
+          break;
+        case 'delta': {
+          // Token đang stream của step hiện tại; reset = backend retry/fallback → bỏ phần cũ
+          const key = data.step ?? 0;
+          const prevDraft = data.reset ? '' : (last.drafts?.[key] || '');
+          last.drafts = { ...(last.drafts || {}), [key]: prevDraft + (data.text || '') };
+          last.draftStep = key;
+          break;
+        }
+        case 'result':
+          last.content = data.content; last.filename = data.filename; last.streaming = false;
+          last.scorecard = extractScorecard(data.content);
+          break;
+        case 'error':
+          last.content = `❌ **Error**: ${data.message}`; last.streaming = false; break;
+        case 'done':
+          last.streaming = false; break;
+        default:
+          // Typed pipeline events (search, cache_hit, retry, tokens...) → log line
+          if (data.message) last.logs = [...(last.logs || []), { type: data.event, text: data.message }];
+      }
+      upd[upd.length - 1] = last;
+      return upd;
+    });
+  };
+
+  const consumeRunStream = async (response) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = '';
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, { stream: true });
+      const chunks = buf.split('\n\n');
+      buf = chunks.pop();
+
+      for (const chunk of chunks) {
+        const line = chunk.split('\n').find(l => l.startsWith('data: '));
+        if (!line) continue;
+        try { applyRunEvent(JSON.parse(line.slice(6))); } catch { }
+      }
+    }
+  };
+
+  /* === Re-attach to a running job after page refresh === */
+  useEffect(() => {
+    const jobId = localStorage.getItem('dr_active_job');
+    if (!jobId) return;
+    (async () => {
+      try {
+        const job = await fetch(`${API}/api/jobs/${jobId}`).then(r => (r.ok ? r.json() : null));
+        if (!job) { localStorage.removeItem('dr_active_job'); return; }
+        setMessages([
+          { role: 'user', content: job.idea, timestamp: new Date(job.created_at * 1000).toISOString() },
+          { role: 'assistant', content: '', step: 0, totalSteps: 5, stepName: '', logs: [], streaming: true, filename: '', jobId },
+        ]);
+        setStreaming(true);
+        // Replay toàn bộ events từ offset 0 để dựng lại progress + logs
+        const response = await fetch(`${API}/api/jobs/${jobId}/events?offset=0`);
+        await consumeRunStream(response);
+      } catch { }
+      setStreaming(false);
+    })();
+  }, []);
+
   /* === CORE: Run Pipeline === */
   const runPipeline = async (idea, existingMsgs = null) => {
     const userMsg = { role: 'user', content: idea, timestamp: new Date().toISOString() };
@@ -164,47 +253,11 @@ export default function ChatPage() {
         }),
       });
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      let buf = '';
-
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        buf += decoder.decode(value, { stream: true });
-        const lines = buf.split('\n\n');
-        buf = lines.pop();
-
-        for (const line of lines) {
-          if (!line.startsWith('data: ')) continue;
-          try {
-            const data = JSON.parse(line.slice(6));
-            setMessages(prev => {
-              const upd = [...prev];
-              const last = { ...upd[upd.length - 1] };
-              switch (data.event) {
-                case 'step':
-                  last.step = data.step; last.totalSteps = data.total; last.stepName = data.name;
-                  last.logs = [...(last.logs || []), { type: 'step', text: `Step ${data.step}/${data.total}: ${data.name}` }];
-                  break;
-                case 'log':
-                  last.logs = [...(last.logs || []), { type: 'log', text: data.message }];
-                  break;
-                case 'result':
-                  last.content = data.content; last.filename = data.filename; last.streaming = false;
-                  last.scorecard = extractScorecard(data.content);
-                  break;
-                case 'error':
-                  last.content = `❌ **Error**: ${data.message}`; last.streaming = false; break;
-                case 'done':
-                  last.streaming = false; break;
-              }
-              upd[upd.length - 1] = last;
-              return upd;
-            });
-          } catch { }
-        }
+      if (response.status === 429) {
+        const err = await response.json().catch(() => ({}));
+        throw new Error(err.detail || 'Server đang bận, thử lại sau');
       }
+      await consumeRunStream(response);
     } catch (err) {
       setMessages(prev => {
         const upd = [...prev];
@@ -298,8 +351,9 @@ export default function ChatPage() {
           buf += decoder.decode(value, { stream: true });
           const lines = buf.split('\n\n');
           buf = lines.pop();
-          for (const line of lines) {
-            if (!line.startsWith('data: ')) continue;
+          for (const chunk of lines) {
+            const line = chunk.split('\n').find(l => l.startsWith('data: '));
+            if (!line) continue;
             try {
               const data = JSON.parse(line.slice(6));
               if (data.event === 'result') content = data.content;
@@ -462,6 +516,9 @@ export default function ChatPage() {
                             ))}
                           </div>
                         )}
+                        {msg.drafts?.[msg.draftStep] && (
+                          <div className="step-draft">{msg.drafts[msg.draftStep].slice(-1200)}</div>
+                        )}
                         <span className="streaming-dot" />
                       </div>
                     ) : (